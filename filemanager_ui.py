@@ -1,9 +1,15 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+from tkinter import filedialog, messagebox, simpledialog, ttk
 import os
 from wasabi_config import WasabiConfigDialog
-import sync_metadata
-import wasabi_client
+from model import bandwidth
+from model.replication import create_sync_client
+from model.sync_job import DONE, PLANNED, RUNNING, SyncJob
+from model.sync_metadata import SyncMetadata
+from model.sync_roots import folder_client
+
+# How often the main loop polls a running sync
+POLL_MS = 200
 
 class FileManagerApp(tk.Tk):
     def __init__(self):
@@ -11,14 +17,31 @@ class FileManagerApp(tk.Tk):
         self.title("Wasabi Filemanager")
         self.geometry("800x500")
         self.folder = None
-        self.sync_meta = {}
+        self.sync_meta = None
+        self.job = None
+        # One client (and connection pool) for the whole session
+        self.client = None
         self.create_menu()
         self.create_widgets()
+        self.connect()
+
+    def connect(self):
+        """(Re)create the sync client from the saved settings, showing what is wrong if that fails"""
+        try:
+            self.client = create_sync_client()
+        except Exception as e:
+            self.client = None
+            messagebox.showerror(
+                "Wasabi Configuration",
+                f"Could not set up the Wasabi client: {e}\nFix it under Config > Wasabi Configuration.",
+            )
+        return self.client is not None
 
     def create_menu(self):
         menubar = tk.Menu(self)
         config_menu = tk.Menu(menubar, tearoff=0)
         config_menu.add_command(label="Wasabi Configuration", command=self.open_wasabi_config)
+        config_menu.add_command(label="Bandwidth Limits", command=self.set_bandwidth)
         menubar.add_cascade(label="Config", menu=config_menu)
         self.config(menu=menubar)
 
@@ -26,7 +49,8 @@ class FileManagerApp(tk.Tk):
         top_frame = tk.Frame(self)
         top_frame.pack(fill=tk.X, padx=10, pady=5)
         tk.Button(top_frame, text="Select Folder", command=self.select_folder).pack(side=tk.LEFT)
-        tk.Button(top_frame, text="Sync Now", command=self.sync_now).pack(side=tk.LEFT, padx=5)
+        self.sync_button = tk.Button(top_frame, text="Sync Now", command=self.sync_now)
+        self.sync_button.pack(side=tk.LEFT, padx=5)
         self.folder_label = tk.Label(top_frame, text="No folder selected")
         self.folder_label.pack(side=tk.LEFT, padx=10)
 
@@ -36,29 +60,62 @@ class FileManagerApp(tk.Tk):
         self.tree.bind("<Button-3>", self.show_context_menu)
         self.tree.bind("<Double-1>", self.toggle_sync_status)
 
+        bottom_frame = tk.Frame(self)
+        bottom_frame.pack(fill=tk.X, padx=10, pady=5)
+        self.progress_bar = ttk.Progressbar(bottom_frame, maximum=1.0)
+        self.progress_bar.pack(fill=tk.X)
+        self.status_label = tk.Label(bottom_frame, text="", anchor="w")
+        self.status_label.pack(fill=tk.X)
+
         self.context_menu = tk.Menu(self, tearoff=0)
         self.context_menu.add_command(label="Save Local Storage", command=self.save_local_storage)
 
     def open_wasabi_config(self):
         WasabiConfigDialog(self)
+        # Pick up the saved settings; the old client is otherwise reused for every transfer
+        if not (self.job and self.job.busy):
+            self.connect()
+
+    def set_bandwidth(self):
+        """Live upload/download caps in MB/s; a running sync slows down or speeds up at once"""
+        policy = bandwidth.BandwidthPolicy.from_config(self.client.config if self.client else None)
+        limits = {}
+        for name, current in zip(("upload", "download"), policy.limits()):
+            text = simpledialog.askstring(
+                "Bandwidth Limits", f"{name.capitalize()} limit in MB/s (empty for none):",
+                initialvalue=f"{current / (1024 * 1024):g}" if current else "", parent=self)
+            if text is None:
+                return
+            try:
+                limits[name] = int(float(text) * 1024 * 1024) if text.strip() else None
+            except ValueError:
+                messagebox.showerror("Bandwidth Limits", "Limits must be numbers of MB/s.")
+                return
+        bandwidth.set_override(**limits)
+        bandwidth.activate(policy)
 
     def select_folder(self):
+        if self.job and self.job.busy:
+            return
         folder = filedialog.askdirectory()
         if folder:
             self.folder = folder
             self.folder_label.config(text=folder)
+            if self.sync_meta:
+                self.sync_meta.close()
+            self.sync_meta = SyncMetadata.from_config(folder, self.client.config if self.client else None)
             self.load_files()
 
     def load_files(self):
         self.tree.delete(*self.tree.get_children())
         if not self.folder:
             return
-        self.sync_meta = sync_metadata.load_sync_metadata(self.folder)
-        for fname in os.listdir(self.folder):
-            fpath = os.path.join(self.folder, fname)
-            if os.path.isfile(fpath):
-                status = self.sync_meta.get(fname, "both")
-                self.tree.insert("", "end", iid=fname, values=(status,))
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    status = self.sync_meta.get_status(entry.name)
+                    self.tree.insert("", "end", iid=entry.name, values=(status,))
+        self.status_label.config(text=self.sync_meta.folder_rollup().summary())
 
     def toggle_sync_status(self, event):
         item = self.tree.identify_row(event.y)
@@ -66,8 +123,7 @@ class FileManagerApp(tk.Tk):
             current = self.tree.set(item, "status")
             new_status = "object_storage_only" if current == "both" else "both"
             self.tree.set(item, "status", new_status)
-            self.sync_meta[item] = new_status
-            sync_metadata.save_sync_metadata(self.folder, self.sync_meta)
+            self.sync_meta.set_status(item, new_status)
 
     def show_context_menu(self, event):
         item = self.tree.identify_row(event.y)
@@ -77,50 +133,91 @@ class FileManagerApp(tk.Tk):
 
     def save_local_storage(self):
         selected = self.tree.selection()
-        if not selected:
+        if not selected or not self.sync_meta:
+            return
+        if self.job and self.job.busy:
             return
+        # Mark the files cloud-only; the sync uploads them and removes only their local copies
         for fname in selected:
-            fpath = os.path.join(self.folder, fname)
-            # Upload to Wasabi
-            wasabi_client.upload_file(fpath, fname)
-            # Delete local file
-            os.remove(fpath)
-            # Update sync status
-            self.sync_meta[fname] = "object_storage_only"
-        sync_metadata.save_sync_metadata(self.folder, self.sync_meta)
-        self.load_files()
-        messagebox.showinfo("Done", "Selected files uploaded and deleted locally.")
+            self.sync_meta.set_status(fname, "object_storage_only")
+            self.tree.set(fname, "status", "object_storage_only")
+        self.start_sync(remove_only=list(selected))
 
     def sync_now(self):
         if not self.folder:
             messagebox.showwarning("No folder", "Please select a folder first.")
             return
-        errors = []
-        for fname in os.listdir(self.folder):
-            fpath = os.path.join(self.folder, fname)
-            if not os.path.isfile(fpath):
-                continue
-            status = self.sync_meta.get(fname, "both")
-            try:
-                if status == "both":
-                    wasabi_client.upload_file(fpath, fname)
-                    # File remains locally
-                elif status == "object_storage_only":
-                    wasabi_client.upload_file(fpath, fname)
-                    if os.path.exists(fpath):
-                        resp = messagebox.askyesno(
-                            "Delete Local File?",
-                            f"'{fname}' is set to object storage only. Delete local copy after upload?"
-                        )
-                        if resp:
-                            os.remove(fpath)
-                            self.sync_meta[fname] = "object_storage_only"
-            except Exception as e:
-                errors.append(f"{fname}: {e}")
-        sync_metadata.save_sync_metadata(self.folder, self.sync_meta)
+        self.start_sync()
+
+    def start_sync(self, remove_only=None):
+        """Plan and run a sync; local copies are removed only for remove_only, else only if confirmed"""
+        if self.job and self.job.busy:
+            return
+        if self.client is None and not self.connect():
+            return
+        try:
+            # The folder's sync root, or the prefix it has synced to, decides its keys
+            client = folder_client(self.folder, self.client, self.sync_meta)
+        except Exception as e:
+            messagebox.showerror("Remote Prefix", str(e))
+            return
+        self.job = SyncJob(client, self.sync_meta, self.client.config)
+        self.remove_only = remove_only
+        self.sync_button.config(state=tk.DISABLED)
+        self.progress_bar["value"] = 0
+        self.status_label.config(text="Scanning folder...")
+        self.job.plan()
+        self.after(POLL_MS, self.poll_sync)
+
+    def poll_sync(self):
+        """Runs on the Tk main loop while the job works in the background"""
+        job = self.job
+        if job.state == PLANNED:
+            keep_local = False
+            removals = job.local_removals
+            if removals and self.remove_only is None:
+                # One decision for every cloud-only file instead of one dialog per file
+                keep_local = not messagebox.askyesno(
+                    "Delete Local Copies?",
+                    f"{removals} file(s) are set to object storage only.\n"
+                    "Delete their local copies after they are uploaded?",
+                )
+            summary = job.plan_result.summary().replace("\n", ", ")
+            self.status_label.config(text=("Resuming: " if job.resumed else "") + summary)
+            job.execute(keep_local=keep_local, remove_only=self.remove_only)
+        elif job.state == RUNNING and job.progress:
+            progress = job.progress
+            self.progress_bar["value"] = progress.fraction
+            eta = progress.eta
+            eta_text = f" - ETA {int(eta)}s" if eta is not None else ""
+            self.status_label.config(
+                text=f"Synced: {progress.done_files}/{progress.total_files}{eta_text} - {progress.current}"
+            )
+        if job.finished:
+            self.finish_sync(job)
+        else:
+            self.after(POLL_MS, self.poll_sync)
+
+    def finish_sync(self, job):
+        self.sync_button.config(state=tk.NORMAL)
+        self.progress_bar["value"] = 1.0 if job.state == DONE else 0
         self.load_files()
+        if job.state != DONE:
+            self.status_label.config(text="Sync failed")
+            messagebox.showerror("Sync Failed", str(job.error))
+            return
+        errors = job.engine.errors
+        health_issues = job.engine.health_issues
+        self.status_label.config(
+            text=f"Sync complete: {job.progress.synced} files synced, {errors.count} errors"
+        )
         if errors:
-            messagebox.showerror("Sync Errors", "Some files failed to sync:\n" + "\n".join(errors))
+            error_text = "Some files failed to sync:\n" + "\n".join(errors.sample)
+            if errors.truncated:
+                error_text += f"\n... full list in {errors.path}"
+            messagebox.showerror("Sync Errors", error_text)
+        elif health_issues:
+            messagebox.showwarning("Health Issues", "\n".join(health_issues.sample))
         else:
             messagebox.showinfo("Sync Complete", "All files synced successfully.")
 
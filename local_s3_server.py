@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+"""
+Local S3-compatible server with fault injection, for load and resilience tests
+
+Keeps buckets in memory and speaks enough of the S3 REST API for the app:
+PUT/GET (with ranges)/HEAD/DELETE objects, CopyObject, multipart uploads
+including UploadPartCopy, ListObjectsV2 and DeleteObjects. Requests are
+not authenticated. Latency, a shared bandwidth cap, 503 SlowDown replies
+and dropped connections can be injected to exercise retries and resume.
+
+Point WasabiClient at it with "endpoint": "http://127.0.0.1:<port>".
+"""
+
+import argparse
+import bisect
+import hashlib
+import random
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+S3_XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+# Response bodies and request bodies move through the bandwidth cap in pieces this size
+IO_CHUNK = 64 * 1024
+DEFAULT_BUCKET = "test-bucket"
+
+
+class Faults:
+    """What to inject: per-request latency, a shared bandwidth cap, 503 SlowDown and dropped connections
+
+    Rates are probabilities per request. operations limits the errors and
+    drops to the named S3 operations (e.g. {"PutObject", "UploadPart"});
+    latency and bandwidth always apply. A fixed seed makes runs repeatable.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, slowdown_rate=0.0, drop_rate=0.0,
+                 operations=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        # Bytes per second shared by all connections, in both directions; None is unlimited
+        self.bandwidth = bandwidth
+        self.slowdown_rate = slowdown_rate
+        self.drop_rate = drop_rate
+        self.operations = set(operations) if operations else None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_free = 0.0
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self._lock:
+                extra = self._random.uniform(0, self.jitter) if self.jitter else 0
+            time.sleep(self.latency + extra)
+
+    def pick(self, operation):
+        """'drop', 'slowdown' or None for one request"""
+        if self.operations is not None and operation not in self.operations:
+            return None
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.drop_rate:
+            return "drop"
+        if roll < self.drop_rate + self.slowdown_rate:
+            return "slowdown"
+        return None
+
+    def throttle(self, nbytes):
+        """Block until nbytes fit through the shared bandwidth cap"""
+        if not self.bandwidth:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_free)
+            self._next_free = start + nbytes / self.bandwidth
+            wait = self._next_free - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class StoredObject:
+    def __init__(self, data, metadata=None, content_type=None, etag=None):
+        self.data = data
+        self.metadata = metadata or {}
+        self.content_type = content_type or "binary/octet-stream"
+        self.etag = etag or hashlib.md5(data).hexdigest()
+        self.last_modified = time.time()
+
+
+class Bucket:
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        # Kept sorted so listings page through without sorting every time
+        self.keys = []
+        self.uploads = {}
+
+    def put(self, key, obj):
+        if key not in self.objects:
+            bisect.insort(self.keys, key)
+        self.objects[key] = obj
+
+    def delete(self, key):
+        if self.objects.pop(key, None) is not None:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+
+class S3Error(Exception):
+    def __init__(self, status, code, message=""):
+        super().__init__(message or code)
+        self.status = status
+        self.code = code
+        self.message = message or code
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    """The server; start() runs it on a background thread and returns the endpoint URL"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, faults=None, buckets=(DEFAULT_BUCKET,)):
+        super().__init__((host, port), S3RequestHandler)
+        self.faults = faults or Faults()
+        self.buckets = {name: Bucket(name) for name in buckets}
+        self.lock = threading.Lock()
+        # Requests per operation, injected faults and bytes moved, for scenario assertions
+        self.stats = {}
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="local-s3", daemon=True)
+        self._thread.start()
+        return self.endpoint
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def bucket(self, name):
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            raise S3Error(404, "NoSuchBucket", f"The bucket {name} does not exist")
+        return bucket
+
+
+def _decode_aws_chunked(body):
+    """Strip aws-chunked framing (chunk sizes, signatures, trailing checksums) from a request body"""
+    out = bytearray()
+    pos = 0
+    while True:
+        end = body.index(b"\r\n", pos)
+        size = int(body[pos:end].split(b";")[0], 16)
+        pos = end + 2
+        if size == 0:
+            return bytes(out)
+        out += body[pos:pos + size]
+        pos += size + 2
+
+
+def _xml(root, children):
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n<{root} xmlns="{S3_XMLNS}">{children}</{root}>'.encode()
+
+
+def _tag(name, value):
+    return f"<{name}>{escape(str(value))}</{name}>"
+
+
+def _iso(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _strip_ns(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "LocalS3"
+
+    def log_message(self, format, *args):
+        pass
+
+    # --- plumbing -------------------------------------------------------
+
+    def _parse(self):
+        parts = urlsplit(self.path)
+        self.query = {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+        path = parts.path.lstrip("/")
+        bucket, _, key = path.partition("/")
+        self.bucket_name = unquote(bucket)
+        self.key = unquote(key)
+
+    def _read_body(self):
+        faults = self.server.faults
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            faults.throttle(len(body))
+            body = bytes(body)
+        else:
+            remaining = int(self.headers.get("Content-Length") or 0)
+            pieces = []
+            while remaining > 0:
+                piece = self.rfile.read(min(IO_CHUNK, remaining))
+                if not piece:
+                    break
+                faults.throttle(len(piece))
+                pieces.append(piece)
+                remaining -= len(piece)
+            body = b"".join(pieces)
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            body = _decode_aws_chunked(body)
+        self.server.count("bytes_in", len(body))
+        return body
+
+    def _send(self, status, body=b"", headers=None, head_only=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-amz-request-id", uuid.uuid4().hex[:16])
+        self.end_headers()
+        if head_only:
+            return
+        faults = self.server.faults
+        view = memoryview(body)
+        for offset in range(0, len(view), IO_CHUNK):
+            piece = view[offset:offset + IO_CHUNK]
+            faults.throttle(len(piece))
+            self.wfile.write(piece)
+        self.server.count("bytes_out", len(body))
+
+    def _error(self, status, code, message, head_only=False):
+        body = b"" if head_only else (
+            b'<?xml version="1.0" encoding="UTF-8"?>\n<Error>' + _tag("Code", code).encode()
+            + _tag("Message", message).encode() + b"</Error>")
+        self._send(status, body, {"Content-Type": "application/xml"}, head_only=head_only)
+
+    def _drop(self):
+        """Cut the connection without a reply, as a flaky network or overloaded proxy would"""
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _object_headers(self, obj):
+        headers = {
+            "ETag": f'"{obj.etag}"',
+            "Last-Modified": formatdate(obj.last_modified, usegmt=True),
+            "Content-Type": obj.content_type,
+            "Accept-Ranges": "bytes",
+        }
+        for name, value in obj.metadata.items():
+            headers[f"x-amz-meta-{name}"] = value
+        return headers
+
+    def _metadata(self):
+        return {name[len("x-amz-meta-"):].lower(): value
+                for name, value in self.headers.items() if name.lower().startswith("x-amz-meta-")}
+
+    def _copy_source(self):
+        source = unquote(self.headers["x-amz-copy-source"].split("?")[0]).lstrip("/")
+        bucket, _, key = source.partition("/")
+        obj = self.server.bucket(bucket).objects.get(key)
+        if obj is None:
+            raise S3Error(404, "NoSuchKey", f"The copy source {source} does not exist")
+        if_match = self.headers.get("x-amz-copy-source-if-match")
+        if if_match and if_match.strip('"') != obj.etag:
+            raise S3Error(412, "PreconditionFailed", "At least one of the pre-conditions you specified did not hold")
+        return obj
+
+    def _operation(self):
+        method, q = self.command, self.query
+        if not self.bucket_name:
+            return "ListBuckets"
+        if not self.key:
+            if method == "POST" and "delete" in q:
+                return "DeleteObjects"
+            return {"GET": "ListObjectsV2", "HEAD": "HeadBucket", "PUT": "CreateBucket"}.get(method, method)
+        if method == "POST":
+            return "CreateMultipartUpload" if "uploads" in q else "CompleteMultipartUpload"
+        if method == "PUT" and "uploadId" in q:
+            return "UploadPartCopy" if "x-amz-copy-source" in self.headers else "UploadPart"
+        if method == "PUT":
+            return "CopyObject" if "x-amz-copy-source" in self.headers else "PutObject"
+        if method == "DELETE":
+            return "AbortMultipartUpload" if "uploadId" in q else "DeleteObject"
+        return {"GET": "GetObject", "HEAD": "HeadObject"}[method]
+
+    def _handle(self):
+        self._parse()
+        operation = self._operation()
+        body = self._read_body() if self.command in ("PUT", "POST") else b""
+        server = self.server
+        server.count(operation)
+        server.faults.delay()
+        fault = server.faults.pick(operation)
+        if fault == "drop":
+            server.count("dropped")
+            return self._drop()
+        head_only = self.command == "HEAD"
+        if fault == "slowdown":
+            server.count("slowdowns")
+            return self._error(503, "SlowDown", "Please reduce your request rate.", head_only)
+        try:
+            handler = getattr(self, "op_" + operation, None)
+            if handler is None:
+                raise S3Error(501, "NotImplemented", f"{operation} is not supported")
+            with server.lock:
+                reply = handler(body)
+            self._send(*reply, head_only=head_only)
+        except S3Error as e:
+            self._error(e.status, e.code, e.message, head_only)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+    # --- operations; each runs under the server lock and returns (status, body, headers) ---
+
+    def op_ListBuckets(self, body):
+        buckets = "".join(f"<Bucket>{_tag('Name', name)}{_tag('CreationDate', _iso(0))}</Bucket>"
+                          for name in self.server.buckets)
+        return 200, _xml("ListAllMyBucketsResult", f"<Buckets>{buckets}</Buckets>"), {}
+
+    def op_CreateBucket(self, body):
+        self.server.buckets.setdefault(self.bucket_name, Bucket(self.bucket_name))
+        return 200, b"", {"Location": "/" + self.bucket_name}
+
+    def op_HeadBucket(self, body):
+        self.server.bucket(self.bucket_name)
+        return 200, b"", {}
+
+    def op_PutObject(self, body):
+        obj = StoredObject(body, self._metadata(), self.headers.get("Content-Type"))
+        self.server.bucket(self.bucket_name).put(self.key, obj)
+        return 200, b"", {"ETag": f'"{obj.etag}"'}
+
+    def op_CopyObject(self, body):
+        source = self._copy_source()
+        if self.headers.get("x-amz-metadata-directive", "COPY").upper() == "REPLACE":
+            metadata, content_type = self._metadata(), self.headers.get("Content-Type")
+        else:
+            metadata, content_type = dict(source.metadata), source.content_type
+        obj = StoredObject(source.data, metadata, content_type, source.etag)
+        self.server.bucket(self.bucket_name).put(self.key, obj)
+        result = _tag("ETag", f'"{obj.etag}"') + _tag("LastModified", _iso(obj.last_modified))
+        return 200, _xml("CopyObjectResult", result), {}
+
+    def _range(self, size):
+        header = self.headers.get("Range")
+        if not header or not header.startswith("bytes="):
+            return None
+        first, _, last = header[len("bytes="):].partition("-")
+        if not first:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            raise S3Error(416, "InvalidRange", "The requested range is not satisfiable")
+        return start, end
+
+    def _get_object(self):
+        obj = self.server.bucket(self.bucket_name).objects.get(self.key)
+        if obj is None:
+            raise S3Error(404, "NoSuchKey", "The specified key does not exist.")
+        return obj
+
+    def op_GetObject(self, body):
+        obj = self._get_object()
+        headers = self._object_headers(obj)
+        byte_range = self._range(len(obj.data))
+        if byte_range is None:
+            return 200, obj.data, headers
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(obj.data)}"
+        return 206, obj.data[start:end + 1], headers
+
+    def op_HeadObject(self, body):
+        # _send() writes the full Content-Length but no body for HEAD
+        obj = self._get_object()
+        return 200, obj.data, self._object_headers(obj)
+
+    def op_DeleteObject(self, body):
+        self.server.bucket(self.bucket_name).delete(self.key)
+        return 204, b"", {}
+
+    def op_DeleteObjects(self, body):
+        bucket = self.server.bucket(self.bucket_name)
+        root = ElementTree.fromstring(body)
+        quiet = False
+        deleted = []
+        for child in root:
+            if _strip_ns(child.tag) == "Quiet":
+                quiet = child.text.strip().lower() == "true"
+            elif _strip_ns(child.tag) == "Object":
+                key = next(el.text for el in child if _strip_ns(el.tag) == "Key")
+                bucket.delete(key)
+                deleted.append(key)
+        result = "" if quiet else "".join(f"<Deleted>{_tag('Key', key)}</Deleted>" for key in deleted)
+        return 200, _xml("DeleteResult", result), {}
+
+    def op_ListObjectsV2(self, body):
+        bucket = self.server.bucket(self.bucket_name)
+        q = self.query
+        prefix = q.get("prefix", "")
+        delimiter = q.get("delimiter", "")
+        max_keys = int(q.get("max-keys", 1000))
+        token = q.get("continuation-token")
+        after = token or q.get("start-after") or ""
+        if token and delimiter and token.endswith(delimiter):
+            # The previous page ended on a common prefix; resume after every key under it
+            start = bisect.bisect_left(bucket.keys, token[:-1] + chr(ord(delimiter[-1]) + 1))
+        elif after:
+            start = bisect.bisect_right(bucket.keys, after)
+        else:
+            start = bisect.bisect_left(bucket.keys, prefix)
+        contents, prefixes, last = [], [], None
+        truncated = False
+        i = start
+        while i < len(bucket.keys):
+            key = bucket.keys[i]
+            if not key.startswith(prefix):
+                break
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter, 1)[0] + delimiter
+                prefixes.append(common)
+                last = common
+                # Skip every key under this common prefix
+                i = bisect.bisect_left(bucket.keys, common[:-1] + chr(ord(delimiter[-1]) + 1))
+                continue
+            obj = bucket.objects[key]
+            contents.append(
+                "<Contents>" + _tag("Key", key) + _tag("LastModified", _iso(obj.last_modified))
+                + _tag("ETag", f'"{obj.etag}"') + _tag("Size", len(obj.data))
+                + _tag("StorageClass", "STANDARD") + "</Contents>"
+            )
+            last = key
+            i += 1
+        result = (
+            _tag("Name", bucket.name) + _tag("Prefix", prefix) + _tag("KeyCount", len(contents) + len(prefixes))
+            + _tag("MaxKeys", max_keys) + _tag("IsTruncated", "true" if truncated else "false")
+            + (_tag("Delimiter", delimiter) if delimiter else "")
+            + "".join(contents)
+            + "".join(f"<CommonPrefixes>{_tag('Prefix', p)}</CommonPrefixes>" for p in prefixes)
+            + (_tag("NextContinuationToken", last) if truncated else "")
+        )
+        return 200, _xml("ListBucketResult", result), {}
+
+    def op_CreateMultipartUpload(self, body):
+        bucket = self.server.bucket(self.bucket_name)
+        upload_id = uuid.uuid4().hex
+        bucket.uploads[upload_id] = {"key": self.key, "parts": {}, "metadata": self._metadata(),
+                                     "content_type": self.headers.get("Content-Type")}
+        result = _tag("Bucket", bucket.name) + _tag("Key", self.key) + _tag("UploadId", upload_id)
+        return 200, _xml("InitiateMultipartUploadResult", result), {}
+
+    def _upload(self):
+        upload = self.server.bucket(self.bucket_name).uploads.get(self.query.get("uploadId"))
+        if upload is None or upload["key"] != self.key:
+            raise S3Error(404, "NoSuchUpload", "The specified upload does not exist.")
+        return upload
+
+    def op_UploadPart(self, body):
+        upload = self._upload()
+        etag = hashlib.md5(body).hexdigest()
+        upload["parts"][int(self.query["partNumber"])] = (etag, body)
+        return 200, b"", {"ETag": f'"{etag}"'}
+
+    def op_UploadPartCopy(self, body):
+        upload = self._upload()
+        source = self._copy_source()
+        data = source.data
+        header = self.headers.get("x-amz-copy-source-range")
+        if header:
+            first, _, last = header[len("bytes="):].partition("-")
+            start, end = int(first), int(last)
+            if end >= len(data):
+                raise S3Error(400, "InvalidArgument", "Range specified is not valid for source object")
+            data = data[start:end + 1]
+        etag = hashlib.md5(data).hexdigest()
+        upload["parts"][int(self.query["partNumber"])] = (etag, data)
+        result = _tag("ETag", f'"{etag}"') + _tag("LastModified", _iso(time.time()))
+        return 200, _xml("CopyPartResult", result), {}
+
+    def op_CompleteMultipartUpload(self, body):
+        bucket = self.server.bucket(self.bucket_name)
+        upload = self._upload()
+        listed = []
+        for part in ElementTree.fromstring(body):
+            fields = {_strip_ns(el.tag): el.text for el in part}
+            listed.append((int(fields["PartNumber"]), fields["ETag"].strip('"')))
+        data = bytearray()
+        digests = b""
+        for number, etag in listed:
+            stored = upload["parts"].get(number)
+            if stored is None or stored[0] != etag:
+                raise S3Error(400, "InvalidPart", f"Part {number} was not uploaded or its ETag does not match")
+            data += stored[1]
+            digests += bytes.fromhex(etag)
+        etag = f"{hashlib.md5(digests).hexdigest()}-{len(listed)}"
+        bucket.put(self.key, StoredObject(bytes(data), upload["metadata"], upload["content_type"], etag))
+        del bucket.uploads[self.query["uploadId"]]
+        result = _tag("Bucket", bucket.name) + _tag("Key", self.key) + _tag("ETag", f'"{etag}"')
+        return 200, _xml("CompleteMultipartUploadResult", result), {}
+
+    def op_AbortMultipartUpload(self, body):
+        bucket = self.server.bucket(self.bucket_name)
+        bucket.uploads.pop(self.query.get("uploadId"), None)
+        return 204, b"", {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local S3-compatible server with fault injection")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--bucket", action="append", help=f"bucket to create (default {DEFAULT_BUCKET})")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--bandwidth", type=float, default=None, help="shared cap in MB/s")
+    parser.add_argument("--slowdown-rate", type=float, default=0.0, help="fraction of requests answered 503 SlowDown")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of connections cut without a reply")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    faults = Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        bandwidth=args.bandwidth * 1024 * 1024 if args.bandwidth else None,
+        slowdown_rate=args.slowdown_rate,
+        drop_rate=args.drop_rate,
+        seed=args.seed,
+    )
+    server = LocalS3Server(args.host, args.port, faults, buckets=args.bucket or (DEFAULT_BUCKET,))
+    print(f"Local S3 listening on {server.endpoint} (buckets: {', '.join(server.buckets)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,14 @@ from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager
 from ui.filemanager_screen import FileManagerScreen
 from ui.wasabi_config_screen import WasabiConfigScreen
+from ui.remote_browser_screen import RemoteBrowserScreen
 
 class WasabiFileManagerApp(App):
     def build(self):
         sm = ScreenManager()
         sm.add_widget(FileManagerScreen(name='filemanager'))
         sm.add_widget(WasabiConfigScreen(name='wasabi_config'))
+        sm.add_widget(RemoteBrowserScreen(name='remote_browser'))
         return sm
 
 if __name__ == '__main__':
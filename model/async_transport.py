@@ -0,0 +1,271 @@
+import asyncio
+import os
+import ssl
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote
+
+from botocore.auth import S3SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+from model import tracing
+from model.bandwidth import DOWNLOADS, UPLOADS
+from model.compression import CHUNK_SIZE, CODEC_METADATA_KEY, decompress_stream
+from model.encryption import ENCRYPTION_METADATA_KEY
+from model.ignore import PARTIAL_SUFFIX
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+# Requests in flight at once; tiny objects need hundreds to fill the link
+DEFAULT_CONCURRENCY = 256
+# Larger files are left to the threaded boto3 path, which streams and splits them into parts
+DEFAULT_MAX_OBJECT_SIZE = 8 * 1024 * 1024
+# Threads reading, hashing and signing files so the event loop never blocks on disk
+DEFAULT_IO_WORKERS = 16
+# Bytes sent or received between bandwidth checks
+PACE_CHUNK_SIZE = 64 * 1024
+# Attempts per request on connection errors and 5xx/503 SlowDown replies
+DEFAULT_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.2
+
+
+class AsyncTransport:
+    """S3 requests on an asyncio event loop, for many small objects at once
+
+    One event loop runs on a background thread with a pooled aiohttp
+    session. Requests are signed with botocore's SigV4 signer and sent
+    path-style; file reads, signing and writes run on a small thread pool.
+    Coroutines can be driven from ordinary threads with run(), or in bulk
+    with imap(), which keeps up to `concurrency` of them in flight.
+    """
+
+    def __init__(self, config, concurrency=DEFAULT_CONCURRENCY, max_object_size=DEFAULT_MAX_OBJECT_SIZE,
+                 io_workers=DEFAULT_IO_WORKERS):
+        if aiohttp is None:
+            raise Exception("The async transport needs aiohttp, which is not installed.")
+        self.config = config
+        self.bucket = config["bucket_name"]
+        self.endpoint = config["endpoint"].rstrip("/")
+        self.region = config["region"]
+        self.credentials = Credentials(config["access_key"], config["secret_key"])
+        self.concurrency = concurrency
+        self.max_object_size = max_object_size
+        self.io_workers = io_workers
+        self.io_pool = None
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """The transport selected by "transport": "async", or None for the threaded boto3 path
+
+        Falls back to None when aiohttp is not installed.
+        """
+        if not config or config.get("transport") != "async" or aiohttp is None:
+            return None
+        return cls(
+            config,
+            concurrency=config.get("async_concurrency", DEFAULT_CONCURRENCY),
+            max_object_size=config.get("async_max_object_size", DEFAULT_MAX_OBJECT_SIZE),
+        )
+
+    def _ssl(self):
+        if self.config.get("ca_file"):
+            return ssl.create_default_context(cafile=self.config["ca_file"])
+        return None if self.config.get("ssl_verify", True) else False
+
+    @property
+    def loop(self):
+        """The transport's event loop, started on first use and again after close()"""
+        with self._lock:
+            if self._loop is None:
+                self.io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="async-io")
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=_run_loop, args=(loop,), name="async-transport", daemon=True).start()
+                self._loop = loop
+                self._session = self.run(self._open_session())
+        return self._loop
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ssl=self._ssl())
+        return aiohttp.ClientSession(connector=connector, auto_decompress=False)
+
+    def run(self, coro):
+        """Run a coroutine on the transport's loop from any other thread and return its result"""
+        loop = self._loop or self.loop
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def imap(self, fn, items, max_in_flight=None):
+        """bounded_imap for coroutine functions: yields (item, result, error) as each finishes
+
+        items is consumed lazily on the calling thread, and at most
+        max_in_flight (default: concurrency) coroutines are pending at once.
+        """
+        max_in_flight = max_in_flight or self.concurrency
+        loop = self.loop
+        items = iter(items)
+        pending = {}
+
+        def submit_next():
+            for item in items:
+                pending[asyncio.run_coroutine_threadsafe(fn(item), loop)] = item
+                return True
+            return False
+
+        try:
+            while len(pending) < max_in_flight and submit_next():
+                pass
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    error = future.exception()
+                    yield item, (None if error else future.result()), error
+                    submit_next()
+        finally:
+            # The caller stopped early or failed: don't leave coroutines running unowned
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        """Close the session and stop the loop; the next request opens them again"""
+        with self._lock:
+            loop, session, self._loop, self._session = self._loop, self._session, None, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(_shutdown(session), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self.io_pool.shutdown(wait=False)
+
+    def url_for(self, key):
+        return f"{self.endpoint}/{self.bucket}/{quote(key, safe='/~')}"
+
+    def sign(self, method, key, headers=None, body=b""):
+        """Return (url, headers) for a SigV4-signed request; runs on the I/O pool for bodies"""
+        request = AWSRequest(method=method, url=self.url_for(key), headers=dict(headers or {}), data=body)
+        S3SigV4Auth(self.credentials, "s3", self.region).add_auth(request)
+        return request.url, dict(request.headers.items())
+
+    async def offload(self, fn, *args):
+        """Run a blocking call on the I/O pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.io_pool, fn, *args)
+
+    async def request(self, method, key, headers=None, body=b"", handler=None):
+        """Send a signed request, retrying connection errors and 5xx replies
+
+        handler(response) is awaited for a successful reply and its result
+        returned; without one, the response headers are. A 404 returns None.
+        While tracing, each request is recorded on its own async track.
+        """
+        tracer = tracing.active()
+        if tracer is None:
+            return await self._send(method, key, headers, body, handler)
+        began = tracer.now()
+        try:
+            return await self._send(method, key, headers, body, handler)
+        finally:
+            tracer.interval(method, "s3", began, tracer.now(), {"key": key})
+
+    async def _send(self, method, key, headers, body, handler):
+        url, signed = await self.offload(self.sign, method, key, headers, body)
+        if body:
+            # A paced body is streamed, so its length has to be given up front
+            signed["Content-Length"] = str(len(body))
+        for attempt in range(DEFAULT_ATTEMPTS):
+            try:
+                async with self._session.request(method, URL(url, encoded=True), headers=signed,
+                                                 data=_paced_body(body) if body else None) as resp:
+                    if resp.status == 404:
+                        return None
+                    if resp.status < 300:
+                        return await handler(resp) if handler else resp.headers
+                    if resp.status < 500 or attempt == DEFAULT_ATTEMPTS - 1:
+                        raise Exception(f"{method} {key} failed: HTTP {resp.status} {await resp.text()}")
+            except aiohttp.ClientError:
+                if attempt == DEFAULT_ATTEMPTS - 1:
+                    raise
+            await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+
+    async def upload_file(self, filepath, key, metadata=None):
+        """PUT a small file as key, with metadata as x-amz-meta-* headers"""
+        def read():
+            with open(filepath, "rb") as f:
+                return f.read()
+
+        body = await self.offload(read)
+        headers = {f"x-amz-meta-{name}": value for name, value in (metadata or {}).items()}
+        await self.request("PUT", key, headers, body)
+
+    async def head_object(self, key):
+        """Response headers of key, or None if it does not exist"""
+        return await self.request("HEAD", key)
+
+    async def download_file(self, key, filepath):
+        """GET key into filepath through a partial file, decompressing it if it was stored compressed"""
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        tmp_path = filepath + PARTIAL_SUFFIX
+
+        async def save(resp):
+            if resp.headers.get(f"x-amz-meta-{ENCRYPTION_METADATA_KEY}"):
+                # The transport has no key; WasabiClient downloads these itself when encryption is on
+                raise Exception(f"GET {key}: object is encrypted")
+            codec = resp.headers.get(f"x-amz-meta-{CODEC_METADATA_KEY}")
+            out = await self.offload(open, tmp_path, "wb")
+            try:
+                async for chunk in resp.content.iter_chunked(PACE_CHUNK_SIZE):
+                    wait = DOWNLOADS.reserve(len(chunk))
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    await self.offload(out.write, chunk)
+            finally:
+                await self.offload(out.close)
+            if codec:
+                await self.offload(_decompress_file, tmp_path, filepath, codec)
+            else:
+                os.replace(tmp_path, filepath)
+            return True
+
+        try:
+            if await self.request("GET", key, handler=save) is None:
+                raise Exception(f"GET {key} failed: object not found")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+async def _shutdown(session):
+    """Cancel whatever is still running on the loop, then close the session"""
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await session.close()
+
+
+def _run_loop(loop):
+    loop.run_forever()
+    # Stopped by close()
+    loop.close()
+
+
+async def _paced_body(body):
+    """body in PACE_CHUNK_SIZE slices, each sent once the upload limiter allows; the loop never blocks"""
+    view = memoryview(body)
+    for offset in range(0, len(view), PACE_CHUNK_SIZE):
+        chunk = view[offset:offset + PACE_CHUNK_SIZE]
+        wait = UPLOADS.reserve(len(chunk))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        yield bytes(chunk)
+
+
+def _decompress_file(src, dst, codec):
+    unpacked = dst + ".unpacked" + PARTIAL_SUFFIX
+    with open(src, "rb") as f, open(unpacked, "wb") as out:
+        decompress_stream(iter(lambda: f.read(CHUNK_SIZE), b""), out, codec)
+    os.replace(unpacked, dst)
@@ -0,0 +1,217 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# Smallest burst a limiter allows, so one socket write never has to be split
+MIN_BURST = 64 * 1024
+# Fraction of a second's worth of bytes that may go out at once after an idle spell
+BURST_SECONDS = 0.1
+# How often a running policy re-reads its schedule and the override file
+CHECK_SECONDS = 5
+# Limits set live from the UI or set_bandwidth.py, next to .wasabi_config.json
+OVERRIDE_FILE = ".wasabi_bandwidth.json"
+DAY_NAMES = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+class BandwidthLimiter:
+    """Token bucket shared by every thread sending through it
+
+    Senders call consume(n) as each chunk goes out; once the bucket is
+    empty they sleep until enough tokens have refilled at rate bytes per
+    second. burst (default a tenth of a second's worth) bounds how far
+    ahead of the rate a sender can get after an idle spell, so throughput
+    stays even instead of arriving in bursts. A rate of None means
+    unlimited and consume() returns at once.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self.rate = rate or None
+            self.burst = burst or (max(MIN_BURST, int(rate * BURST_SECONDS)) if rate else None)
+            self._tokens = self.burst or 0
+            self._last = time.monotonic()
+
+    def reserve(self, nbytes):
+        """Take nbytes from the bucket; returns the seconds the caller should wait before sending them"""
+        if self.rate is None or nbytes <= 0:
+            # Retried transfers report negative progress; that is never credited back
+            return 0
+        with self._lock:
+            if self.rate is None:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= nbytes
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def consume(self, nbytes):
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Every transfer in the process goes through these, so concurrent syncs share the caps
+UPLOADS = BandwidthLimiter()
+DOWNLOADS = BandwidthLimiter()
+
+
+def _minutes(text):
+    hours, minutes = text.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+class BandwidthWindow:
+    """Limits that apply on some days between start and end, e.g. office hours
+
+    A window whose end is before its start runs past midnight. None for a
+    limit leaves that direction at the policy's default.
+    """
+
+    def __init__(self, start, end, days=None, upload=None, download=None):
+        self.start = _minutes(start)
+        self.end = _minutes(end)
+        self.days = [DAY_NAMES.index(day[:3].lower()) for day in days] if days else list(range(7))
+        self.upload = upload
+        self.download = download
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(cfg["start"], cfg["end"], cfg.get("days"), cfg.get("upload"), cfg.get("download"))
+
+    def covers(self, now):
+        minute = now.hour * 60 + now.minute
+        if self.start <= self.end:
+            return now.weekday() in self.days and self.start <= minute < self.end
+        if minute >= self.start:
+            return now.weekday() in self.days
+        # The early-morning part belongs to the window that started the day before
+        return (now.weekday() - 1) % 7 in self.days and minute < self.end
+
+
+class BandwidthPolicy:
+    """Upload and download caps in bytes per second, by time of day, adjustable while running
+
+    The caps are the first schedule window covering the current time,
+    else the defaults. Any limit in the override file wins over both;
+    the file is written by set_override() from the UI or set_bandwidth.py
+    and picked up within CHECK_SECONDS by a running policy.
+    """
+
+    def __init__(self, upload=None, download=None, windows=None, override_path=OVERRIDE_FILE):
+        self.upload = upload
+        self.download = download
+        self.windows = windows or []
+        self.override_path = override_path
+        self._applied = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Build from the "bandwidth" setting; a bare "max_bandwidth" is the default upload cap
+
+        e.g. {"upload": 2000000, "windows": [{"days": ["mon", "tue", "wed", "thu", "fri"],
+        "start": "08:00", "end": "18:00", "upload": 500000, "download": 4000000}]}
+        """
+        cfg = cfg or {}
+        bandwidth = cfg.get("bandwidth") or {}
+        return cls(
+            upload=bandwidth.get("upload", cfg.get("max_bandwidth")),
+            download=bandwidth.get("download"),
+            windows=[BandwidthWindow.from_config(window) for window in bandwidth.get("windows", [])],
+        )
+
+    def limits(self, now=None):
+        """(upload, download) caps for now; None means unlimited"""
+        now = now or datetime.now()
+        upload, download = self.upload, self.download
+        for window in self.windows:
+            if window.covers(now):
+                if window.upload is not None:
+                    upload = window.upload
+                if window.download is not None:
+                    download = window.download
+                break
+        override = read_override(self.override_path)
+        upload = override.get("upload", upload)
+        download = override.get("download", download)
+        return upload or None, download or None
+
+    def apply(self, now=None):
+        """Set UPLOADS and DOWNLOADS to the current caps; returns them"""
+        limits = self.limits(now)
+        if limits != self._applied:
+            UPLOADS.set_rate(limits[0])
+            DOWNLOADS.set_rate(limits[1])
+            self._applied = limits
+        return limits
+
+
+_active = None
+_active_lock = threading.Lock()
+
+
+def activate(policy):
+    """Make policy the one in force and keep it applied on a background thread until replaced"""
+    global _active
+    policy.apply()
+    with _active_lock:
+        started = _active is not None
+        _active = policy
+    if not started:
+        threading.Thread(target=_keep_applied, name="bandwidth", daemon=True).start()
+    return policy
+
+
+def _keep_applied():
+    while True:
+        time.sleep(CHECK_SECONDS)
+        with _active_lock:
+            policy = _active
+        try:
+            policy.apply()
+        except Exception:
+            # A half-written or malformed override file is read again next time
+            pass
+
+
+def read_override(path=OVERRIDE_FILE):
+    """Limits in the override file, e.g. {"upload": 1000000}; {} if there is none"""
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {name: data[name] for name in ("upload", "download") if name in data}
+
+
+def set_override(path=OVERRIDE_FILE, **limits):
+    """Override upload and/or download caps until cleared; None is unlimited"""
+    data = read_override(path)
+    data.update(limits)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+    with _active_lock:
+        policy = _active
+    if policy is not None:
+        policy.apply()
+    return data
+
+
+def clear_override(path=OVERRIDE_FILE):
+    """Go back to the configured caps and schedule"""
+    if os.path.exists(path):
+        os.remove(path)
+    with _active_lock:
+        policy = _active
+    if policy is not None:
+        policy.apply()
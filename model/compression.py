@@ -0,0 +1,162 @@
+import mimetypes
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Object metadata key recording which codec an upload was stored with
+CODEC_METADATA_KEY = "wasabi-codec"
+CHUNK_SIZE = 1024 * 1024
+
+# Formats that are already compressed; recompressing them only burns CPU
+SKIP_EXTENSIONS = {
+    ".7z", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic",
+    ".jpeg", ".jpg", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".pdf",
+    ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz",
+    ".zip", ".zst",
+}
+SKIP_MIME_PREFIXES = ("image/", "video/", "audio/")
+COMPRESSIBLE_MIME_PREFIXES = ("text/",)
+COMPRESSIBLE_MIME_TYPES = {
+    "application/json", "application/xml", "application/javascript",
+    "application/x-sh", "application/sql", "application/x-ndjson",
+}
+COMPRESSIBLE_EXTENSIONS = {
+    ".csv", ".tsv", ".log", ".txt", ".json", ".jsonl", ".xml", ".yaml",
+    ".yml", ".sql", ".md", ".html", ".htm", ".css", ".js", ".py", ".ini",
+}
+
+
+def available_codecs():
+    """Return the codecs usable in this environment, best first"""
+    codecs = ["gzip"]
+    if zstandard is not None:
+        codecs.insert(0, "zstd")
+    return codecs
+
+
+class CompressionPolicy:
+    """Decide per file whether and how to compress it before upload"""
+
+    def __init__(self, enabled=True, codec="auto", min_size=1024, level=None):
+        self.enabled = enabled
+        self.codec = codec
+        self.min_size = min_size
+        self.level = level
+
+    @classmethod
+    def from_config(cls, cfg):
+        cfg = cfg or {}
+        return cls(
+            enabled=cfg.get("enabled", True),
+            codec=cfg.get("codec", "auto"),
+            min_size=cfg.get("min_size", 1024),
+            level=cfg.get("level"),
+        )
+
+    def is_compressible(self, filepath):
+        ext = os.path.splitext(filepath)[1].lower()
+        if ext in SKIP_EXTENSIONS:
+            return False
+        if ext in COMPRESSIBLE_EXTENSIONS:
+            return True
+        mime, encoding = mimetypes.guess_type(filepath)
+        if encoding or not mime:
+            return False
+        if mime.startswith(SKIP_MIME_PREFIXES):
+            return False
+        return mime.startswith(COMPRESSIBLE_MIME_PREFIXES) or mime in COMPRESSIBLE_MIME_TYPES
+
+    def choose_codec(self, filepath):
+        """Return the codec name to use for filepath, or None to send it raw"""
+        if not self.enabled or not self.is_compressible(filepath):
+            return None
+        if os.path.getsize(filepath) < self.min_size:
+            return None
+        codecs = available_codecs()
+        if self.codec == "auto":
+            return codecs[0]
+        if self.codec in codecs:
+            return self.codec
+        # Requested codec is not installed here, fall back to stdlib gzip
+        return "gzip"
+
+
+def _compressor(codec, level=None):
+    if codec == "gzip":
+        # wbits=31 produces a gzip container, readable by gunzip and gzip.open
+        return zlib.compressobj(level if level is not None else 6, zlib.DEFLATED, 31)
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("zstd codec requested but zstandard is not installed.")
+        return zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+    raise Exception(f"Unknown compression codec: {codec}")
+
+
+def _decompressor(codec):
+    if codec == "gzip":
+        return zlib.decompressobj(31)
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("Object is zstd compressed but zstandard is not installed.")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise Exception(f"Unknown compression codec: {codec}")
+
+
+class CompressingReader:
+    """Read-only file object that yields the compressed form of another stream
+
+    Compression happens lazily in CHUNK_SIZE steps, so memory use stays
+    bounded no matter how large the source file is.
+    """
+
+    def __init__(self, fileobj, codec, level=None, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self._compressor = _compressor(codec, level)
+        self._buffer = bytearray()
+        self._eof = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self.fileobj.read(self.chunk_size)
+            if not chunk:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+                break
+            self.bytes_in += len(chunk)
+            self._buffer += self._compressor.compress(chunk)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        self.bytes_out += len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+def decompress_stream(chunks, out, codec):
+    """Decompress an iterable of byte chunks into the writable file out"""
+    decompressor = _decompressor(codec)
+    for chunk in chunks:
+        out.write(decompressor.decompress(chunk))
+    if hasattr(decompressor, "flush"):
+        out.write(decompressor.flush())
@@ -0,0 +1,37 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from model import tracing
+
+
+def bounded_imap(fn, items, max_workers, max_queued=None, thread_name_prefix=""):
+    """Run fn over items on a thread pool, yielding (item, result, error) as each finishes
+
+    items is consumed lazily and at most max_queued calls (default twice the
+    worker count) are queued or running at once, so an arbitrarily long
+    input never piles up futures in memory. error is the exception fn
+    raised, or None. While tracing, each item's wait for a free worker is
+    recorded under the pool's thread_name_prefix.
+    """
+    max_queued = max_queued or max_workers * 2
+    items = iter(items)
+    tracer = tracing.active()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix) as pool:
+        pending = {}
+
+        def submit_next():
+            for item in items:
+                if tracer is None:
+                    pending[pool.submit(fn, item)] = item
+                else:
+                    pending[pool.submit(tracer.dequeued, fn, item, tracer.now(), thread_name_prefix)] = item
+                return True
+            return False
+
+        while len(pending) < max_queued and submit_next():
+            pass
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield item, (None if error else future.result()), error
+                submit_next()
@@ -0,0 +1,103 @@
+import os
+from model.pull_sync import relpath_to_key
+
+# Refuse to delete more than this share of the tracked files without force=True
+DEFAULT_MAX_DELETE_FRACTION = 0.25
+# ...but always allow this many, so small folders are not blocked outright
+MIN_DELETE_ALLOWANCE = 10
+
+
+class DeleteThresholdError(Exception):
+    """Raised when a deletion run exceeds the safety threshold"""
+
+    def __init__(self, count, tracked, limit):
+        super().__init__(
+            f"Refusing to delete {count} of {tracked} tracked files remotely (limit {limit})."
+        )
+        self.count = count
+        self.tracked = tracked
+        self.limit = limit
+
+
+class DeleteSync:
+    """Propagate local deletions to the bucket with batched DeleteObjects calls"""
+
+    def __init__(self, client, sync_meta, max_fraction=DEFAULT_MAX_DELETE_FRACTION, max_count=None):
+        self.client = client
+        self.sync_meta = sync_meta
+        self.max_fraction = max_fraction
+        self.max_count = max_count
+
+    def find_deleted(self):
+        """Return (relpaths deleted locally, number of tracked files)
+
+        Cloud-only and no-sync entries are excluded: a missing local copy is
+        expected for those and must not remove the remote object.
+        """
+        deleted = []
+        tracked = 0
+        for relpath, info in self.sync_meta.iter_file_infos():
+            tracked += 1
+            if self.is_deleted(relpath):
+                deleted.append(relpath)
+        return deleted, tracked
+
+    def is_deleted(self, relpath):
+        # Ignored files are outside sync altogether; their remote copies are left alone
+        if self.sync_meta.ignore.is_path_ignored(relpath):
+            return False
+        if self.sync_meta.get_effective_status(relpath) != "both":
+            return False
+        return not os.path.lexists(os.path.join(self.sync_meta.folder, relpath))
+
+    def iter_deleted(self, force=False):
+        """Yield locally deleted relpaths one at a time, without building a list
+
+        Unless force, DeleteThresholdError is raised after the last one if
+        there were more than limit(), so a caller collecting them (e.g. into
+        a plan) can discard what it has. An emptied or unmounted folder
+        therefore never turns into a bucket-wide delete.
+        """
+        deleted = tracked = 0
+        for relpath, info in self.sync_meta.iter_file_infos():
+            tracked += 1
+            if self.is_deleted(relpath):
+                deleted += 1
+                yield relpath
+        limit = self.limit(tracked)
+        if deleted > limit and not force:
+            raise DeleteThresholdError(deleted, tracked, limit)
+
+    def limit(self, tracked):
+        limit = max(int(tracked * self.max_fraction), MIN_DELETE_ALLOWANCE)
+        if self.max_count is not None:
+            limit = min(limit, self.max_count)
+        return limit
+
+    def preview(self):
+        """Dry run: describe what run() would delete without touching the bucket"""
+        self.sync_meta.check_remote_prefix(self.client.key_prefix)
+        deleted, tracked = self.find_deleted()
+        limit = self.limit(tracked)
+        return {
+            "keys": [relpath_to_key(relpath) for relpath in deleted],
+            "tracked": tracked,
+            "limit": limit,
+            "exceeds_threshold": len(deleted) > limit,
+        }
+
+    def run(self, dry_run=False, force=False):
+        """Delete remote copies of locally deleted files; returns a summary dict"""
+        self.sync_meta.check_remote_prefix(self.client.key_prefix)
+        deleted, tracked = self.find_deleted()
+        limit = self.limit(tracked)
+        if len(deleted) > limit and not force and not dry_run:
+            raise DeleteThresholdError(len(deleted), tracked, limit)
+        keys = {relpath_to_key(relpath): relpath for relpath in deleted}
+        if dry_run or not keys:
+            return {"deleted": [], "would_delete": list(keys), "errors": []}
+        removed, errors = self.client.delete_objects(list(keys))
+        with self.sync_meta.batch():
+            for key in removed:
+                self.sync_meta.remove_file_info(keys[key])
+        return {"deleted": removed, "would_delete": [], "errors": errors}
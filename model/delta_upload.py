@@ -0,0 +1,94 @@
+import math
+from model.hashing import BUFFER_SIZE, new_hasher
+
+# Files at least this large get per-chunk hashes and delta re-uploads
+DEFAULT_DELTA_THRESHOLD = 256 * 1024 * 1024
+# Chunk (= multipart part) size; must be a multiple of BUFFER_SIZE and at least S3's 5 MiB part minimum
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+# S3 allows at most this many parts per multipart upload
+MAX_PARTS = 10000
+CHUNK_ALGORITHM = "sha256"
+
+
+class DeltaUnavailable(Exception):
+    """The remote object cannot serve as the base of a delta; upload the whole file instead"""
+
+
+def chunk_size_for(file_size, previous=None):
+    """Chunk size for a file, keeping the previous one while it still fits in MAX_PARTS"""
+    if previous and math.ceil(file_size / previous["chunk_size"]) <= MAX_PARTS:
+        return previous["chunk_size"]
+    needed = math.ceil(file_size / MAX_PARTS)
+    # Round up to whole read buffers so chunk boundaries line up with reads
+    needed = math.ceil(needed / BUFFER_SIZE) * BUFFER_SIZE
+    return max(DEFAULT_CHUNK_SIZE, needed)
+
+
+def hash_chunks(filepath, chunk_size, algorithm=CHUNK_ALGORITHM):
+    """Hash filepath per chunk and as a whole in a single read
+
+    Returns a chunk info dict (chunk_size, algorithm, hashes, file_size,
+    sha256), as stored with SyncMetadata.update_file_info(..., chunks=...)
+    and read back by get_chunk_info.
+    """
+    file_hasher = new_hasher("sha256")
+    hashes = []
+    chunk_hasher = None
+    in_chunk = 0
+    size = 0
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    try:
+        with open(filepath, "rb", buffering=0) as f:
+            while True:
+                n = f.readinto(view)
+                if not n:
+                    break
+                data = view[:n]
+                file_hasher.update(data)
+                if chunk_hasher is None:
+                    chunk_hasher = new_hasher(algorithm)
+                chunk_hasher.update(data)
+                in_chunk += n
+                size += n
+                if in_chunk >= chunk_size:
+                    hashes.append(chunk_hasher.hexdigest())
+                    chunk_hasher = None
+                    in_chunk = 0
+    finally:
+        view.release()
+    if chunk_hasher is not None:
+        hashes.append(chunk_hasher.hexdigest())
+    return {
+        "chunk_size": chunk_size,
+        "algorithm": algorithm,
+        "hashes": hashes,
+        "file_size": size,
+        "sha256": file_hasher.hexdigest(),
+    }
+
+
+def plan_parts(chunks, previous):
+    """Yield (part_number, offset, length, copy) for every part of the new object
+
+    copy is True when the same bytes sit at the same offset of the previous
+    object, so the part can be copied server-side instead of uploaded.
+    Chunks are compared at fixed offsets: in-place edits (VM images,
+    database files) reuse everything else, insertions that shift the rest
+    of the file do not.
+    """
+    chunk_size = chunks["chunk_size"]
+    file_size = chunks["file_size"]
+    comparable = (
+        previous is not None
+        and previous.get("chunk_size") == chunk_size
+        and previous.get("algorithm") == chunks["algorithm"]
+    )
+    old_hashes = previous["hashes"] if comparable else []
+    for index, digest in enumerate(chunks["hashes"]):
+        offset = index * chunk_size
+        length = min(chunk_size, file_size - offset)
+        old_length = min(chunk_size, previous["file_size"] - offset) if comparable else 0
+        copy = index < len(old_hashes) and old_hashes[index] == digest and old_length == length
+        yield index + 1, offset, length, copy
+
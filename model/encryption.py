@@ -0,0 +1,260 @@
+import hashlib
+import hmac
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = None
+
+# Object metadata recording how an object was encrypted
+ENCRYPTION_METADATA_KEY = "wasabi-enc"
+CHUNK_METADATA_KEY = "wasabi-enc-chunk"
+OBJECT_ID_METADATA_KEY = "wasabi-enc-id"
+KEY_ID_METADATA_KEY = "wasabi-enc-key"
+# Keyed MAC of the plaintext SHA-256, stored in its place so the bucket cannot confirm guesses of the content
+CONTENT_MAC_METADATA_KEY = "wasabi-enc-sha256-mac"
+ALGORITHM = "aes-256-gcm-chunked"
+# The app's own secret.key is shipped with it, so anyone could open objects sealed with a key derived from it
+BUNDLED_KEY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "secret.key")
+# Plaintext bytes per encrypted chunk; each is sealed on its own, so any chunk can be fetched and opened alone
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+NONCE_SIZE = 12
+TAG_SIZE = 16
+# Bytes each chunk grows by: its random nonce in front and the GCM tag behind
+CHUNK_OVERHEAD = NONCE_SIZE + TAG_SIZE
+OBJECT_ID_SIZE = 16
+KDF_INFO = b"wasabi-filemanager chunked encryption v1"
+MAC_KDF_INFO = b"wasabi-filemanager content mac v1"
+
+
+def encrypted_size(size, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stored size of size plaintext bytes"""
+    chunks = max(1, -(-size // chunk_size))
+    return size + chunks * CHUNK_OVERHEAD
+
+
+def plaintext_size(stored_size, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Plaintext size of an object stored_size bytes long"""
+    full, rest = divmod(stored_size, chunk_size + CHUNK_OVERHEAD)
+    return full * chunk_size + max(0, rest - CHUNK_OVERHEAD)
+
+
+def chunk_range(start, length, chunk_size=DEFAULT_CHUNK_SIZE):
+    """(first chunk, stored byte range start, stored byte range end inclusive) covering a plaintext range"""
+    first = start // chunk_size
+    last = (start + length - 1) // chunk_size
+    sealed = chunk_size + CHUNK_OVERHEAD
+    return first, first * sealed, (last + 1) * sealed - 1
+
+
+class ChunkCipher:
+    """AES-256-GCM over fixed-size chunks, each with its own random nonce
+
+    A stored object is the concatenation of its sealed chunks: nonce,
+    ciphertext, tag. The authenticated data binds every chunk to its
+    object (a random id kept in the object metadata), its position and
+    whether it is the last one, so chunks cannot be reordered, swapped
+    between objects or cut off. Chunk i of any object starts at byte
+    i * (chunk_size + CHUNK_OVERHEAD), so ranged GETs need only the
+    chunks they cover. Streams are sealed and opened on a thread pool
+    of `workers`, in order.
+    """
+
+    def __init__(self, key, chunk_size=DEFAULT_CHUNK_SIZE, workers=None):
+        if AESGCM is None:
+            raise Exception("Client-side encryption needs the cryptography package, which is not installed.")
+        self.aead = AESGCM(key)
+        self.key_id = hashlib.sha256(key).hexdigest()[:16]
+        self.mac_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=MAC_KDF_INFO).derive(key)
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 4
+        self._pool = None
+
+    @classmethod
+    def from_key_file(cls, path, chunk_size=DEFAULT_CHUNK_SIZE, workers=None):
+        """Derive the key from the contents of a key file, whatever its format"""
+        if AESGCM is None:
+            raise Exception("Client-side encryption needs the cryptography package, which is not installed.")
+        if os.path.abspath(path) == BUNDLED_KEY_FILE:
+            raise Exception(f"'{path}' ships with the app and is not secret; create a key file of your own.")
+        if not os.path.exists(path):
+            raise Exception(f"Encryption key file '{path}' not found.")
+        with open(path, "rb") as f:
+            material = f.read().strip()
+        if not material:
+            raise Exception(f"Encryption key file '{path}' is empty.")
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=KDF_INFO).derive(material)
+        return cls(key, chunk_size, workers)
+
+    @classmethod
+    def from_config(cls, cfg):
+        """The cipher of an enabled "encryption" setting, or None to store objects as they are
+
+        e.g. {"enabled": true, "key_file": "~/.wasabi/objects.key", "chunk_size": 1048576}
+        """
+        cfg = cfg or {}
+        if not cfg.get("enabled"):
+            return None
+        if not cfg.get("key_file"):
+            raise Exception("Encryption is enabled but no \"key_file\" is set.")
+        return cls.from_key_file(os.path.expanduser(cfg["key_file"]), cfg.get("chunk_size", DEFAULT_CHUNK_SIZE),
+                                 cfg.get("workers"))
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="crypt")
+        return self._pool
+
+    def new_object(self, sha256):
+        """Metadata for a new object of plaintext sha256; its id goes into every chunk's authenticated data"""
+        return {
+            ENCRYPTION_METADATA_KEY: ALGORITHM,
+            CHUNK_METADATA_KEY: str(self.chunk_size),
+            OBJECT_ID_METADATA_KEY: os.urandom(OBJECT_ID_SIZE).hex(),
+            KEY_ID_METADATA_KEY: self.key_id,
+            CONTENT_MAC_METADATA_KEY: self.content_mac(sha256),
+        }
+
+    def content_mac(self, sha256):
+        return hmac.new(self.mac_key, sha256.encode(), hashlib.sha256).hexdigest()
+
+    def check_content(self, metadata, sha256):
+        """'ok', 'mismatch' or 'unverified' (no MAC, or another key's) for an object whose plaintext should be sha256"""
+        mac = metadata.get(CONTENT_MAC_METADATA_KEY)
+        if not mac or metadata.get(KEY_ID_METADATA_KEY) != self.key_id:
+            return "unverified"
+        return "ok" if hmac.compare_digest(mac, self.content_mac(sha256)) else "mismatch"
+
+    def check(self, metadata):
+        """Raise unless this cipher can open an object with metadata; returns (object id, chunk size)"""
+        if metadata.get(ENCRYPTION_METADATA_KEY) != ALGORITHM:
+            raise Exception(f"Unsupported encryption: {metadata.get(ENCRYPTION_METADATA_KEY)}")
+        if metadata.get(KEY_ID_METADATA_KEY) != self.key_id:
+            raise Exception("Object was encrypted with a different key.")
+        return bytes.fromhex(metadata[OBJECT_ID_METADATA_KEY]), int(metadata[CHUNK_METADATA_KEY])
+
+    @staticmethod
+    def _aad(object_id, index, last):
+        return object_id + struct.pack(">QB", index, last)
+
+    def seal(self, object_id, index, data, last):
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, bytes(data), self._aad(object_id, index, last))
+
+    def open(self, object_id, index, sealed, last):
+        sealed = bytes(sealed)
+        try:
+            return self.aead.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], self._aad(object_id, index, last))
+        except Exception:
+            raise Exception(f"Encrypted chunk {index} failed authentication.") from None
+
+    def seal_range(self, object_id, data, first_index, last_index):
+        """Seal data, which starts at chunk first_index, chunk by chunk; last_index is the object's final chunk"""
+        out = bytearray()
+        view = memoryview(data)
+        for n, offset in enumerate(range(0, max(len(view), 1), self.chunk_size)):
+            index = first_index + n
+            out += self.seal(object_id, index, view[offset:offset + self.chunk_size], index == last_index)
+        return bytes(out)
+
+    def ordered(self, fn, items):
+        """fn over items on the pool, yielding results in order with a bounded read-ahead"""
+        pending = deque()
+        for item in items:
+            pending.append(self.pool.submit(fn, *item))
+            if len(pending) >= self.workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def seal_stream(self, object_id, chunks):
+        """Sealed chunks of a plaintext stream given as an iterable of chunk_size pieces"""
+        def numbered():
+            index, previous = 0, None
+            for chunk in chunks:
+                if previous is not None:
+                    yield object_id, index, previous, False
+                    index += 1
+                previous = chunk
+            yield object_id, index, previous or b"", True
+
+        return self.ordered(self.seal, numbered())
+
+    def open_stream(self, object_id, chunk_size, sealed_chunks, first_index=0, last_index=None):
+        """Plaintext chunks of a stream of sealed bytes, which starts at chunk first_index
+
+        The stream is taken to run to the end of the object unless the
+        object's last_index is given, as it must be for a ranged GET.
+        """
+        block = chunk_size + CHUNK_OVERHEAD
+
+        def numbered():
+            index, buffer = first_index, bytearray()
+            for data in sealed_chunks:
+                buffer += data
+                # Keep one sealed chunk back: only at the end is it known to be the last
+                while len(buffer) > block:
+                    yield object_id, index, bytes(buffer[:block]), index == last_index
+                    del buffer[:block]
+                    index += 1
+            if buffer:
+                yield object_id, index, bytes(buffer), last_index is None or index == last_index
+
+        return self.ordered(self.open, numbered())
+
+
+class EncryptingReader:
+    """Read-only file object that yields the sealed form of another stream
+
+    Chunks are sealed ahead of the reader on the cipher's pool, a few per
+    worker at most, so memory stays bounded however large the source is.
+    """
+
+    def __init__(self, fileobj, cipher, object_id):
+        self.fileobj = fileobj
+        source = iter(lambda: fileobj.read(cipher.chunk_size), b"")
+        self._sealed = cipher.seal_stream(object_id, _exact_chunks(source, cipher.chunk_size))
+        self._buffer = bytearray()
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = next(self._sealed, None)
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer += chunk
+        if size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _exact_chunks(pieces, chunk_size):
+    """Regroup byte pieces of any size (e.g. compressor output) into chunk_size chunks"""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+    if buffer:
+        yield bytes(buffer)
@@ -0,0 +1,121 @@
+import hashlib
+import mmap
+import os
+import threading
+from model import tracing
+from model.concurrency import bounded_imap
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# SHA-256 stays the default: it is what existing metadata was written with
+DEFAULT_ALGORITHM = "sha256"
+BUFFER_SIZE = 1024 * 1024
+# Files at least this large are hashed through mmap instead of read() calls
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# Slice size fed to the hasher from an mmap; hashlib drops the GIL per update
+MMAP_SLICE = 8 * 1024 * 1024
+
+ALGORITHMS = {
+    "sha256": hashlib.sha256,
+    "sha1": hashlib.sha1,
+    "md5": hashlib.md5,
+    "blake2b": hashlib.blake2b,
+    "blake2s": hashlib.blake2s,
+}
+if xxhash is not None:
+    ALGORITHMS["xxh64"] = xxhash.xxh64
+    ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+
+_local = threading.local()
+
+
+def register_algorithm(name, factory):
+    """Register a hasher factory returning an object with update()/hexdigest()"""
+    ALGORITHMS[name] = factory
+
+
+def is_supported(algorithm):
+    return algorithm in ALGORITHMS
+
+
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    if algorithm not in ALGORITHMS:
+        raise Exception(f"Unsupported hash algorithm: {algorithm}")
+    return ALGORITHMS[algorithm]()
+
+
+def _read_buffer(size):
+    """Return a per-thread reusable read buffer of at least size bytes"""
+    buf = getattr(_local, "buffer", None)
+    if buf is None or len(buf) < size:
+        buf = bytearray(size)
+        _local.buffer = buf
+    return buf
+
+
+def hash_file(filepath, algorithm=DEFAULT_ALGORITHM, buffer_size=BUFFER_SIZE, use_mmap=None):
+    """Hash a file with the named algorithm and return the hex digest
+
+    Small files are read into a reused per-thread buffer with readinto();
+    large files are mapped into memory so no copy is made at all.
+    Returns None if the file does not exist.
+    """
+    try:
+        size = os.path.getsize(filepath)
+    except OSError:
+        return None
+    hasher = new_hasher(algorithm)
+    if use_mmap is None:
+        use_mmap = size >= MMAP_THRESHOLD
+    with open(filepath, "rb", buffering=0) as f:
+        if use_mmap and size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(view), MMAP_SLICE):
+                        hasher.update(view[offset:offset + MMAP_SLICE])
+                finally:
+                    view.release()
+        else:
+            buf = _read_buffer(buffer_size)
+            view = memoryview(buf)[:buffer_size]
+            try:
+                while True:
+                    n = f.readinto(view)
+                    if not n:
+                        break
+                    hasher.update(view[:n])
+            finally:
+                view.release()
+    return hasher.hexdigest()
+
+
+def default_workers():
+    return os.cpu_count() or 4
+
+
+def hash_files(jobs, max_workers=None, max_open_files=None):
+    """Hash many files concurrently, yielding (path, algorithm, digest, error) as they finish
+
+    jobs is an iterable of (path, algorithm) pairs and is consumed lazily:
+    only twice as many jobs as workers are queued at once, so memory stays
+    bounded however long the job list is. Each worker holds a single file
+    open, so max_open_files caps the worker count. Threads are used rather
+    than processes because hashlib and readinto() release the GIL.
+    A file that cannot be read yields digest None and the OSError.
+    """
+    max_workers = max_workers or default_workers()
+    if max_open_files:
+        max_workers = max(1, min(max_workers, max_open_files))
+
+    def run(job):
+        with tracing.span("hash", "scan", path=job[0], algorithm=job[1]):
+            return hash_file(job[0], job[1])
+
+    for (path, algorithm), digest, error in bounded_imap(run, jobs, max_workers, thread_name_prefix="hash"):
+        if error is not None and not isinstance(error, OSError):
+            raise error
+        yield path, algorithm, digest, error
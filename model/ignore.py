@@ -0,0 +1,198 @@
+import os
+import re
+
+# Per-folder pattern file, .gitignore syntax; rules apply to that folder and below
+IGNORE_FILENAME = ".wasabiignore"
+
+# Ending of the temporary files downloads are written to before being moved into place
+PARTIAL_SUFFIX = ".wasabi-part"
+
+# The app's own state and temporary files; always excluded, whatever the settings
+INTERNAL_IGNORES = [
+    ".wasabi_sync.json*",
+    ".wasabi_sync.db*",
+    ".wasabi_sync_*",
+    ".wasabi_last_plan.jsonl*",
+    ".wasabi_verify.jsonl",
+    ".wasabi_index.db*",
+    "*" + PARTIAL_SUFFIX,
+]
+
+# Junk excluded unless "default_ignores" is turned off
+DEFAULT_IGNORES = [
+    ".git/",
+    ".hg/",
+    ".svn/",
+    "__pycache__/",
+    "*.pyc",
+    ".DS_Store",
+    "Thumbs.db",
+    "desktop.ini",
+    "*.swp",
+    "*.swo",
+    "*~",
+    ".#*",
+    "~$*",
+    "*.tmp",
+]
+
+# Directories whose ignore matchers are kept for path lookups (pull, deletes)
+MATCHER_CACHE_SIZE = 4096
+
+
+def _translate(pattern):
+    """Regex source for one gitignore glob, matched against a '/'-separated relative path"""
+    anchored = "/" in pattern.rstrip("/")
+    pattern = pattern.strip("/")
+    i, out = 0, []
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == len(pattern):
+            out.append("/.*")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[" + body.replace("\\", "\\\\") + "]")
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    body = "".join(out)
+    # Patterns without a slash match a name at any depth
+    return body if anchored else "(?:.*/)?" + body
+
+
+class IgnoreRules:
+    """One pattern list (a .wasabiignore file or built-in list), compiled
+
+    Consecutive rules of the same kind (ignore / negate, any path / dirs
+    only) are merged into one alternation regex, so matching costs a few
+    regex calls per path however many patterns there are. As in git, the
+    last matching rule wins.
+    """
+
+    def __init__(self, patterns):
+        groups = []
+        for line in patterns:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            kind = (negate, dir_only)
+            if groups and groups[-1][0] == kind:
+                groups[-1][1].append(_translate(line))
+            else:
+                groups.append((kind, [_translate(line)]))
+        # Evaluated last-to-first so the first hit is the rule that wins
+        self.groups = [
+            (negate, dir_only, re.compile("(?:" + "|".join(sources) + ")$"))
+            for (negate, dir_only), sources in reversed(groups)
+        ]
+
+    @classmethod
+    def from_file(cls, path):
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                return cls(f.readlines())
+        except OSError:
+            return None
+
+    def match(self, relpath, is_dir):
+        """True (ignored), False (re-included by a ! rule) or None (no rule applies)"""
+        for negate, dir_only, regex in self.groups:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath):
+                return not negate
+        return None
+
+
+class IgnoreMatcher:
+    """The ignore rules in effect for one directory of the synced tree
+
+    Each directory's matcher chains its own .wasabiignore (if any) onto its
+    parent's, so deeper files override shallower ones. The scanner asks
+    is_ignored() before descending, which prunes whole junk trees
+    (.git, node_modules, ...) without ever listing them.
+    """
+
+    def __init__(self, root, layers, reldir=""):
+        self.root = root
+        # (base reldir, IgnoreRules), deepest last
+        self.layers = layers
+        self.reldir = reldir
+        self._cache = {}
+
+    @classmethod
+    def for_folder(cls, root, patterns=None, use_defaults=True):
+        """Matcher for the sync root: built-in rules, configured patterns, then the root .wasabiignore"""
+        builtin = list(INTERNAL_IGNORES)
+        if use_defaults:
+            builtin += DEFAULT_IGNORES
+        layers = [("", IgnoreRules(builtin))]
+        if patterns:
+            layers.append(("", IgnoreRules(patterns)))
+        rules = IgnoreRules.from_file(os.path.join(root, IGNORE_FILENAME))
+        if rules is not None:
+            layers.append(("", rules))
+        return cls(root, layers)
+
+    def child(self, name):
+        """Matcher for the subdirectory name, picking up its .wasabiignore if it has one"""
+        reldir = f"{self.reldir}/{name}" if self.reldir else name
+        rules = IgnoreRules.from_file(os.path.join(self.root, reldir, IGNORE_FILENAME))
+        if rules is None:
+            return IgnoreMatcher(self.root, self.layers, reldir)
+        return IgnoreMatcher(self.root, self.layers + [(reldir, rules)], reldir)
+
+    def is_ignored(self, name, is_dir):
+        """Whether the entry name, directly inside this matcher's directory, is excluded"""
+        relpath = f"{self.reldir}/{name}" if self.reldir else name
+        for base, rules in reversed(self.layers):
+            result = rules.match(relpath[len(base) + 1:] if base else relpath, is_dir)
+            if result is not None:
+                return result
+        return False
+
+    def is_path_ignored(self, relpath, is_dir=False):
+        """Whether the entry at relpath (from the sync root) is excluded, itself or through a parent"""
+        parts = relpath.replace(os.sep, "/").split("/")
+        matcher = self
+        for depth, name in enumerate(parts[:-1]):
+            if matcher.is_ignored(name, True):
+                return True
+            key = "/".join(parts[:depth + 1])
+            cached = self._cache.get(key)
+            if cached is None:
+                if len(self._cache) >= MATCHER_CACHE_SIZE:
+                    self._cache.clear()
+                cached = self._cache[key] = matcher.child(name)
+            matcher = cached
+        return matcher.is_ignored(parts[-1], is_dir)
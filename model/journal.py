@@ -0,0 +1,144 @@
+import json
+import os
+from model import tracing
+from model.sync_plan import LAST_PLAN_FILENAME, SyncPlan, build_plan
+
+JOURNAL_FILENAME = ".wasabi_sync_journal.jsonl"
+
+
+class JournalState:
+    """What an interrupted run had got to, read back from its journal
+
+    Actions are numbered by their line in the plan. Everything up to
+    high_seq was started; of those, only the ones in unfinished have no
+    successful completion record. Actions that failed stay unfinished, so
+    a resumed run tries them again. Since the engine keeps a bounded number of actions
+    in flight, unfinished stays small however large the plan is.
+    """
+
+    def __init__(self, header):
+        self.plan_path = header["plan"]
+        self.plan_created = header["created"]
+        self.keep_local = header.get("keep_local", False)
+        self.high_seq = -1
+        self.unfinished = {}
+
+    def is_done(self, seq):
+        return seq <= self.high_seq and seq not in self.unfinished
+
+
+class OperationJournal:
+    """Write-ahead journal of one SyncPlan execution
+
+    The first line names the plan being executed. Before an action starts
+    an "intent" line is written, and once its result has been applied to
+    the metadata a "done" line follows, carrying what is needed to apply it
+    again. Lines are flushed as they are written and the file is fsynced
+    at every metadata checkpoint, so after a crash or kill the next run
+    can tell finished, in-flight and untouched actions apart. The journal
+    is removed when a run completes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def _read_lines(self):
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A line torn by the crash; everything before it is intact
+                    return
+
+    def load(self):
+        """Return the JournalState of an unfinished run, or None"""
+        if not os.path.exists(self.path):
+            return None
+        lines = self._read_lines()
+        header = next(lines, None)
+        if not header or header.get("op") != "begin":
+            return None
+        state = JournalState(header)
+        for record in lines:
+            seq = record.get("seq")
+            if record["op"] == "intent":
+                state.unfinished[seq] = record["relpath"]
+                state.high_seq = max(state.high_seq, seq)
+            elif record["op"] == "done" and not record.get("error"):
+                state.unfinished.pop(seq, None)
+        return state
+
+    def iter_done(self):
+        """Yield the "done" records of the journal, for re-applying them to metadata"""
+        lines = self._read_lines()
+        next(lines, None)
+        for record in lines:
+            if record["op"] == "done" and not record.get("error"):
+                yield record
+
+    def resumable_plan(self):
+        """The plan an unfinished run was executing, if it is still on disk unchanged"""
+        state = self.load()
+        if state is None or not os.path.exists(state.plan_path):
+            return None
+        try:
+            plan = SyncPlan.load(state.plan_path)
+        except Exception:
+            return None
+        return plan if plan.created == state.plan_created else None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def begin(self, plan, keep_local=False):
+        self._file = open(self.path, "w")
+        self._write({"op": "begin", "plan": plan.path, "created": plan.created, "keep_local": keep_local})
+        self.sync()
+
+    def reopen(self):
+        """Continue appending to the journal of an interrupted run"""
+        self._file = open(self.path, "a")
+
+    def intent(self, entry):
+        self._write({"op": "intent", "seq": entry["seq"], "action": entry["action"], "relpath": entry["relpath"]})
+
+    def done(self, entry, result=None, error=None):
+        record = {"op": "done", "seq": entry["seq"], "action": entry["action"], "relpath": entry["relpath"]}
+        if error is not None:
+            record["error"] = str(error)
+        elif result and result.get("hash"):
+            record.update(hash=result["hash"], algorithm=entry["algorithm"], sha256=result["sha256"])
+        self._write(record)
+
+    def sync(self):
+        """Force the journal to disk; called at every metadata checkpoint"""
+        if self._file is not None:
+            with tracing.span("fsync", "journal"):
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """The run completed; nothing is left to resume"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def resume_or_build_plan(sync_meta, include_deletes=False, **options):
+    """Return (plan, resumed): the plan of an interrupted run, or a freshly built one
+
+    options are passed on to build_plan, e.g. plan_options(cfg).
+    """
+    journal = OperationJournal(os.path.join(sync_meta.folder, JOURNAL_FILENAME))
+    plan = journal.resumable_plan()
+    if plan is not None:
+        return plan, True
+    path = os.path.join(sync_meta.folder, LAST_PLAN_FILENAME)
+    return build_plan(sync_meta, path, include_deletes=include_deletes, **options), False
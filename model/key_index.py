@@ -0,0 +1,219 @@
+import sqlite3
+import threading
+import time
+
+INDEX_FILE = ".wasabi_index.db"
+# Rows written per transaction while ingesting a listing
+INGEST_BATCH = 5000
+
+
+def _has_trigram(conn):
+    """FTS5 with the trigram tokenizer needs SQLite 3.34 or newer"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.trigram_probe USING fts5(k, tokenize='trigram')")
+        conn.execute("DROP TABLE temp.trigram_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _prefix_bound(prefix):
+    """Smallest string above every key starting with prefix, or None if there is none
+
+    Keys compare by code point (SQLite's BINARY collation on UTF-8), so
+    key >= prefix AND key < bound selects exactly the keys under prefix,
+    case-sensitively and through the primary key index.
+    """
+    stripped = prefix.rstrip(chr(0x10FFFF))
+    if not stripped:
+        return None
+    return stripped[:-1] + chr(ord(stripped[-1]) + 1)
+
+
+class KeyIndex:
+    """Local SQLite index of remote keys for instant substring and glob search
+
+    Keys are stored with size, LastModified and ETag. Where SQLite supports
+    it, an FTS5 trigram index makes substring, LIKE and GLOB searches
+    index-backed, so they stay in the milliseconds over millions of keys.
+    Older SQLite builds fall back to plain LIKE/GLOB scans.
+    """
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.fts = _has_trigram(self.conn)
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                " bucket TEXT NOT NULL, key TEXT NOT NULL, size INTEGER,"
+                " last_modified REAL, etag TEXT, generation INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (bucket, key))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS listings ("
+                " bucket TEXT NOT NULL, prefix TEXT NOT NULL, generation INTEGER NOT NULL,"
+                " refreshed REAL, PRIMARY KEY (bucket, prefix))"
+            )
+            if not self.fts:
+                return
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS objects_fts USING fts5("
+                " key, content='objects', content_rowid='rowid', tokenize='trigram')"
+            )
+            # Keep the external-content FTS table in step with objects
+            self.conn.executescript(
+                """
+                CREATE TRIGGER IF NOT EXISTS objects_ai AFTER INSERT ON objects BEGIN
+                    INSERT INTO objects_fts(rowid, key) VALUES (new.rowid, new.key);
+                END;
+                CREATE TRIGGER IF NOT EXISTS objects_ad AFTER DELETE ON objects BEGIN
+                    INSERT INTO objects_fts(objects_fts, rowid, key) VALUES ('delete', old.rowid, old.key);
+                END;
+                CREATE TRIGGER IF NOT EXISTS objects_au AFTER UPDATE OF key ON objects BEGIN
+                    INSERT INTO objects_fts(objects_fts, rowid, key) VALUES ('delete', old.rowid, old.key);
+                    INSERT INTO objects_fts(rowid, key) VALUES (new.rowid, new.key);
+                END;
+                """
+            )
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    # Ingestion
+
+    def _upsert(self, bucket, objects, generation):
+        self.conn.executemany(
+            "INSERT INTO objects (bucket, key, size, last_modified, etag, generation)"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(bucket, key) DO UPDATE SET size=excluded.size,"
+            " last_modified=excluded.last_modified, etag=excluded.etag, generation=excluded.generation",
+            [
+                (bucket, obj["Key"], obj.get("Size"), obj["LastModified"].timestamp() if obj.get("LastModified") else None,
+                 obj.get("ETag"), generation)
+                for obj in objects
+            ],
+        )
+
+    def refresh(self, client, prefix="", progress_callback=None):
+        """Re-list prefix into the index; keys no longer in the bucket are removed
+
+        Rows are written in batches as pages arrive, so the index is usable
+        (with the previous data) while a long refresh is still running.
+        Returns the number of keys seen.
+        """
+        bucket = client.config["bucket_name"]
+        generation = int(time.time() * 1000)
+        seen = 0
+        batch = []
+        for obj in client.list_objects(prefix):
+            batch.append(obj)
+            if len(batch) >= INGEST_BATCH:
+                with self._lock, self.conn:
+                    self._upsert(bucket, batch, generation)
+                seen += len(batch)
+                batch = []
+                if progress_callback:
+                    progress_callback(seen)
+        with self._lock, self.conn:
+            self._upsert(bucket, batch, generation)
+            seen += len(batch)
+            bound = _prefix_bound(prefix)
+            if bound is None:
+                self.conn.execute(
+                    "DELETE FROM objects WHERE bucket = ? AND key >= ? AND generation < ?",
+                    (bucket, prefix, generation),
+                )
+            else:
+                self.conn.execute(
+                    "DELETE FROM objects WHERE bucket = ? AND key >= ? AND key < ? AND generation < ?",
+                    (bucket, prefix, bound, generation),
+                )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO listings (bucket, prefix, generation, refreshed) VALUES (?, ?, ?, ?)",
+                (bucket, prefix, generation, time.time()),
+            )
+        return seen
+
+    def add_objects(self, bucket, objects):
+        """Record objects known to exist, e.g. right after uploading them"""
+        with self._lock, self.conn:
+            self._upsert(bucket, objects, int(time.time() * 1000))
+
+    def remove_keys(self, bucket, keys):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM objects WHERE bucket = ? AND key = ?", [(bucket, key) for key in keys]
+            )
+
+    def last_refreshed(self, bucket, prefix=""):
+        row = self.conn.execute(
+            "SELECT refreshed FROM listings WHERE bucket = ? AND prefix = ?", (bucket, prefix)
+        ).fetchone()
+        return row[0] if row else None
+
+    def count(self, bucket):
+        return self.conn.execute("SELECT COUNT(*) FROM objects WHERE bucket = ?", (bucket,)).fetchone()[0]
+
+    # Search
+
+    # Queries below use CROSS JOIN so SQLite drives from the FTS match rather
+    # than scanning every object of the bucket and probing the index per row.
+
+    def _rows(self, sql, params):
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [
+            {"Key": key, "Size": size, "LastModified": last_modified, "ETag": etag}
+            for key, size, last_modified, etag in rows
+        ]
+
+    def search(self, bucket, text, limit=200):
+        """Keys containing text (case-insensitive)"""
+        if self.fts and len(text) >= 3:
+            # A quoted trigram phrase matches any key containing the text
+            phrase = '"' + text.replace('"', '""') + '"'
+            return self._rows(
+                "SELECT o.key, o.size, o.last_modified, o.etag FROM objects_fts f"
+                " CROSS JOIN objects o ON o.rowid = f.rowid"
+                " WHERE objects_fts MATCH ? AND o.bucket = ? ORDER BY o.key LIMIT ?",
+                (phrase, bucket, limit),
+            )
+        return self._rows(
+            "SELECT key, size, last_modified, etag FROM objects"
+            " WHERE bucket = ? AND key LIKE ? ESCAPE '\\' ORDER BY key LIMIT ?",
+            (bucket, "%" + _escape_like(text) + "%", limit),
+        )
+
+    def glob(self, bucket, pattern, limit=200):
+        """Keys matching a shell-style pattern such as 'logs/*2024*.csv'"""
+        if self.fts:
+            # The trigram index serves GLOB directly when the pattern has 3+ literal characters
+            return self._rows(
+                "SELECT o.key, o.size, o.last_modified, o.etag FROM objects_fts f"
+                " CROSS JOIN objects o ON o.rowid = f.rowid"
+                " WHERE f.key GLOB ? AND o.bucket = ? ORDER BY o.key LIMIT ?",
+                (pattern, bucket, limit),
+            )
+        return self._rows(
+            "SELECT key, size, last_modified, etag FROM objects"
+            " WHERE bucket = ? AND key GLOB ? ORDER BY key LIMIT ?",
+            (bucket, pattern, limit),
+        )
+
+    def query(self, bucket, query, limit=200):
+        """Glob search if query contains wildcards, substring search otherwise"""
+        if any(ch in query for ch in "*?["):
+            return self.glob(bucket, query, limit)
+        return self.search(bucket, query, limit)
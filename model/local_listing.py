@@ -0,0 +1,252 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+DEFAULT_MAX_FOLDERS = 256
+# Entries listed per folder until more are asked for
+DEFAULT_PAGE_SIZE = 500
+# Sibling and child folders of a shown folder that are listed in the background
+PREWARM_FOLDERS = 8
+# A snapshot taken this soon after its folder's mtime may have missed a change within the same timestamp tick
+RACY_SECONDS = 2
+
+
+class DirectoryEntry:
+    """One row of a folder: size is 0 for folders, status is the entry's effective sync status"""
+
+    def __init__(self, name, path, is_dir, size, status):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.status = status
+
+
+class DirectorySnapshot:
+    """The first entries of one folder as of its mtime_ns
+
+    scanned is how many directory entries the listing has read (entries
+    removed while listing are read but not kept); complete is False while
+    there may be more after them.
+    """
+
+    def __init__(self, path, mtime_ns, entries, scanned, complete):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.scanned = scanned
+        self.complete = complete
+        self.taken = time.time()
+
+    @property
+    def folders(self):
+        return [entry.path for entry in self.entries if entry.is_dir]
+
+    def fresh(self, mtime_ns):
+        """Whether the snapshot still describes a folder whose mtime is now mtime_ns
+
+        Adding, removing or renaming an entry changes its folder's mtime,
+        but a change in the same tick as the listing would not, so a
+        snapshot taken that close to the mtime is never trusted.
+        """
+        return mtime_ns == self.mtime_ns and self.taken - mtime_ns / 1e9 >= RACY_SECONDS
+
+
+class DirectoryCache:
+    """LRU cache of local folder listings with their sync statuses
+
+    A cached folder is revalidated with one stat() of the folder itself
+    instead of a listing and a status lookup per entry, which is what
+    makes going back and forth in large trees on network mounts instant.
+    Only the first page_size entries of a folder are listed; asking for
+    more continues the listing where it stopped. Changes that leave the
+    folder's mtime alone (a file growing, a status toggled in the UI) are
+    reported with invalidate_path(); with the optional watchdog package,
+    watch() does that for every change under root. Sibling and child
+    folders of each folder shown are listed in the background, ready for
+    the next click.
+    """
+
+    def __init__(self, root, open_statuses, max_folders=DEFAULT_MAX_FOLDERS, page_size=DEFAULT_PAGE_SIZE,
+                 prewarm_workers=2):
+        self.root = os.path.abspath(root)
+        # Opens the cache's own status reader (get_status, get_effective_status, close), e.g. a StatusReader
+        self.open_statuses = open_statuses
+        self._statuses = None
+        self.max_folders = max_folders
+        self.page_size = page_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a background listing that raced one is not stored
+        self._generation = 0
+        self._prewarming = set()
+        self._prewarm_pool = ThreadPoolExecutor(max_workers=prewarm_workers, thread_name_prefix="prewarm")
+        self._observer = None
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    @property
+    def statuses(self):
+        with self._lock:
+            if self._statuses is None:
+                self._statuses = self.open_statuses()
+            return self._statuses
+
+    def _list(self, path, limit, base=None):
+        """Snapshot of the first limit entries of path, continuing base if it is still fresh"""
+        # The mtime is read first, so a change made while listing makes the snapshot stale
+        mtime_ns = os.stat(path).st_mtime_ns
+        if base is not None and base.fresh(mtime_ns):
+            entries, scanned = list(base.entries), base.scanned
+        else:
+            entries, scanned = [], 0
+        relpath = os.path.relpath(path, self.root)
+        # A folder's no_sync or object_storage_only status holds for everything in it
+        inherited = "both" if relpath == os.curdir else self.statuses.get_effective_status(relpath)
+        complete = True
+        with os.scandir(path) as scan:
+            # Unchanged since base was listed, so the folder is read back in the same order
+            deque(islice(scan, scanned), maxlen=0)
+            for entry in scan:
+                if len(entries) >= limit:
+                    complete = False
+                    break
+                scanned += 1
+                try:
+                    is_dir = entry.is_dir()
+                    size = 0 if is_dir else entry.stat().st_size
+                except OSError:
+                    # Removed while listing
+                    continue
+                status = inherited
+                if status == "both":
+                    status = self.statuses.get_status(os.path.relpath(entry.path, self.root))
+                entries.append(DirectoryEntry(entry.name, entry.path, is_dir, size, status))
+        return DirectorySnapshot(self._key(path), mtime_ns, entries, scanned, complete)
+
+    def _store(self, snapshot, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[snapshot.path] = snapshot
+            self._entries.move_to_end(snapshot.path)
+            while len(self._entries) > self.max_folders:
+                self._entries.popitem(last=False)
+
+    def cached(self, path):
+        key = self._key(path)
+        with self._lock:
+            snapshot = self._entries.get(key)
+            if snapshot is not None:
+                self._entries.move_to_end(key)
+            return snapshot
+
+    def get(self, path, limit=None, prewarm=True):
+        """Return a DirectorySnapshot of path with at least its first limit (default page_size) entries
+
+        The folder is listed only if it changed since it was cached, or
+        further than before if more entries are asked for than it holds.
+        """
+        limit = limit or self.page_size
+        snapshot = self.cached(path)
+        if snapshot is None or not snapshot.fresh(os.stat(path).st_mtime_ns):
+            snapshot = self._list(path, limit)
+            self._store(snapshot)
+        elif not snapshot.complete and len(snapshot.entries) < limit:
+            snapshot = self._list(path, limit, snapshot)
+            self._store(snapshot)
+        if prewarm:
+            self.prewarm(snapshot)
+        return snapshot
+
+    def prewarm(self, snapshot):
+        """List the first child folders of snapshot, its parent and the siblings after it in the background"""
+        candidates = snapshot.folders[:PREWARM_FOLDERS]
+        if snapshot.path != self.root:
+            parent = os.path.dirname(snapshot.path)
+            candidates.append(parent)
+            siblings = self.cached(parent)
+            if siblings is not None:
+                folders = siblings.folders
+                start = folders.index(snapshot.path) + 1 if snapshot.path in folders else 0
+                # Wrap around, so the last folder's siblings are the first ones
+                candidates += (folders[start:] + folders[:start])[:PREWARM_FOLDERS]
+        for path in candidates:
+            with self._lock:
+                if path == snapshot.path or path in self._entries or path in self._prewarming:
+                    continue
+                self._prewarming.add(path)
+                generation = self._generation
+            self._prewarm_pool.submit(self._prewarm_one, path, generation)
+
+    def _prewarm_one(self, path, generation):
+        try:
+            self._store(self._list(path, self.page_size), generation)
+        except Exception:
+            # Prewarming is best effort; a real navigation will surface the error
+            pass
+        finally:
+            with self._lock:
+                self._prewarming.discard(path)
+
+    def invalidate(self, path=None):
+        """Drop one folder from the cache, or everything when path is None"""
+        with self._lock:
+            self._generation += 1
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self._key(path), None)
+
+    def invalidate_path(self, path):
+        """Drop every cached listing that shows path, or path or anything below it"""
+        key = self._key(path)
+        self.invalidate(os.path.dirname(key))
+        with self._lock:
+            self._generation += 1
+            # Statuses set on a folder show on everything below it
+            for cached in [cached for cached in self._entries if cached == key or cached.startswith(key + os.sep)]:
+                del self._entries[cached]
+
+    def watch(self):
+        """Invalidate on every change under root as it happens; False if watchdog is not installed"""
+        if Observer is None:
+            return False
+        if self._observer is None:
+            self._observer = Observer()
+            self._observer.schedule(_Invalidator(self), self.root, recursive=True)
+            self._observer.start()
+        return True
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        # Prewarming still running finishes before the status reader it uses is closed
+        self._prewarm_pool.shutdown(wait=True, cancel_futures=True)
+        if self._statuses is not None:
+            self._statuses.close()
+            self._statuses = None
+
+
+class _Invalidator:
+    """watchdog event handler dropping the listings an event affects"""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def dispatch(self, event):
+        self.cache.invalidate_path(event.src_path)
+        dest_path = getattr(event, "dest_path", None)
+        if dest_path:
+            self.cache.invalidate_path(dest_path)
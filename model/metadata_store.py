@@ -0,0 +1,304 @@
+import json
+import os
+import sqlite3
+import threading
+
+# Rows fetched per query when iterating, so iteration never loads the whole store
+PAGE_SIZE = 1000
+
+
+class MetadataStore:
+    """Dict-like SyncMetadata storage backed by SQLite
+
+    Entries keep the same shape as the old JSON file ("<relpath>" -> status,
+    "<relpath>_info" -> dict), but only the rows being accessed are in
+    memory. Iteration is paged by key, and the content hash of each _info
+    entry is indexed so duplicate content can be looked up without a scan.
+    Folder-wide settings live in a table of their own, apart from the paths.
+    Writes become durable on commit().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level="DEFERRED")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, content_hash TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_content_hash ON entries (content_hash)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+
+    @staticmethod
+    def _content_hash(key, value):
+        if key.endswith("_info") and isinstance(value, dict) and value.get("hash"):
+            return f"{value.get('algorithm', 'sha256')}:{value['hash']}"
+        return None
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, content_hash) VALUES (?, ?, ?)",
+                (key, json.dumps(value), self._content_hash(key, value)),
+            )
+
+    def __delitem__(self, key):
+        if self.pop(key, KeyError) is KeyError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self.get(key, default)
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        return value
+
+    def update(self, items):
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, content_hash) VALUES (?, ?, ?)",
+                ((key, json.dumps(value), self._content_hash(key, value)) for key, value in items),
+            )
+
+    def items(self, suffix=""):
+        """Yield (key, value) pairs in key order, PAGE_SIZE rows at a time"""
+        last = ""
+        pattern = "%" + suffix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT key, value FROM entries WHERE key > ? AND key LIKE ? ESCAPE '\\' ORDER BY key LIMIT ?",
+                    (last, pattern, PAGE_SIZE),
+                ).fetchall()
+            if not rows:
+                return
+            for key, value in rows:
+                yield key, json.loads(value)
+            last = rows[-1][0]
+
+    def get_setting(self, name, default=None):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_setting(self, name, value):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, json.dumps(value)))
+
+    def find_content(self, algorithm, digest):
+        """Return (key, value) of an _info entry with this content hash, or None"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT key, value FROM entries WHERE content_hash = ? LIMIT 1", (f"{algorithm}:{digest}",)
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+# Per-file sync states counted by FolderRollups
+ROLLUP_STATES = ("synced", "pending", "cloud", "excluded")
+
+
+def _parent_folders(relpath):
+    """relpath's folders from the nearest up to the root, which is ''"""
+    parent = os.path.dirname(relpath)
+    while parent:
+        yield parent
+        parent = os.path.dirname(parent)
+    yield ""
+
+
+class FolderRollup:
+    """Files and bytes in each sync state under one folder"""
+
+    def __init__(self, folder, counts=None):
+        self.folder = folder
+        self.counts = {state: {"files": 0, "bytes": 0} for state in ROLLUP_STATES}
+        for state, files, nbytes in counts or ():
+            self.counts[state] = {"files": files, "bytes": nbytes}
+
+    def files(self, state):
+        return self.counts[state]["files"]
+
+    def bytes(self, state):
+        return self.counts[state]["bytes"]
+
+    @property
+    def total_files(self):
+        return sum(count["files"] for count in self.counts.values())
+
+    def summary(self):
+        labels = {"pending": "pending", "synced": "synced", "cloud": "cloud-only", "excluded": "excluded"}
+        parts = []
+        for state in ("pending", "synced", "cloud", "excluded"):
+            if self.files(state):
+                parts.append(f"{self.files(state)} {labels[state]} ({self.bytes(state) / (1024 * 1024):.1f} MB)")
+        return ", ".join(parts) or "No files"
+
+
+class FolderRollups:
+    """Per-folder totals of synced, pending, cloud-only and excluded files, kept in the metadata database
+
+    Every file's state and size is a row; every folder has one row per
+    state with the files and bytes below it. Changing a file adjusts the
+    totals of its ancestors only, so reading any folder's totals is one
+    small indexed query however large the tree is. Adjustments are summed
+    in memory and written by flush(), which runs before every commit.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = store._lock
+        # (folder, state) -> [files, bytes] not yet written
+        self._deltas = {}
+        conn = store.conn
+        with self._lock:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_states "
+                "(relpath TEXT PRIMARY KEY, state TEXT NOT NULL, size INTEGER NOT NULL, scan INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rollups "
+                "(folder TEXT NOT NULL, state TEXT NOT NULL, files INTEGER NOT NULL, bytes INTEGER NOT NULL, "
+                "PRIMARY KEY (folder, state))"
+            )
+            conn.commit()
+            self.scan = conn.execute("SELECT COALESCE(MAX(scan), 0) FROM file_states").fetchone()[0]
+
+    @staticmethod
+    def _normalize(relpath):
+        return "" if relpath in ("", os.curdir) else relpath
+
+    def _adjust(self, relpath, state, files, nbytes):
+        for folder in _parent_folders(relpath):
+            delta = self._deltas.setdefault((folder, state), [0, 0])
+            delta[0] += files
+            delta[1] += nbytes
+
+    def get(self, relpath):
+        """(state, size) recorded for a file, or None"""
+        with self._lock:
+            row = self.store.conn.execute(
+                "SELECT state, size FROM file_states WHERE relpath = ?", (relpath,)).fetchone()
+        return tuple(row) if row else None
+
+    def set(self, relpath, state, size=None):
+        """Record a file's state; size None keeps the size already recorded"""
+        with self._lock:
+            previous = self.get(relpath)
+            if size is None:
+                size = previous[1] if previous else 0
+            if previous != (state, size):
+                if previous:
+                    self._adjust(relpath, previous[0], -1, -previous[1])
+                self._adjust(relpath, state, 1, size)
+            self.store.conn.execute(
+                "INSERT OR REPLACE INTO file_states (relpath, state, size, scan) VALUES (?, ?, ?, ?)",
+                (relpath, state, size, self.scan),
+            )
+
+    def remove(self, relpath):
+        with self._lock:
+            previous = self.get(relpath)
+            if previous:
+                self._adjust(relpath, previous[0], -1, -previous[1])
+                self.store.conn.execute("DELETE FROM file_states WHERE relpath = ?", (relpath,))
+
+    def iter_under(self, folder):
+        """Yield (relpath, state, size) for every file recorded below folder, PAGE_SIZE rows at a time"""
+        folder = self._normalize(folder)
+        last = folder + os.sep if folder else ""
+        end = folder + chr(ord(os.sep) + 1) if folder else None
+        while True:
+            with self._lock:
+                if end is None:
+                    rows = self.store.conn.execute(
+                        "SELECT relpath, state, size FROM file_states WHERE relpath > ? ORDER BY relpath LIMIT ?",
+                        (last, PAGE_SIZE)).fetchall()
+                else:
+                    rows = self.store.conn.execute(
+                        "SELECT relpath, state, size FROM file_states WHERE relpath > ? AND relpath < ? "
+                        "ORDER BY relpath LIMIT ?", (last, end, PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    def folder(self, relpath=""):
+        """FolderRollup of everything below relpath ('' is the sync root)"""
+        relpath = self._normalize(relpath)
+        with self._lock:
+            self.flush()
+            rows = self.store.conn.execute(
+                "SELECT state, files, bytes FROM rollups WHERE folder = ?", (relpath,)).fetchall()
+        return FolderRollup(relpath, rows)
+
+    def begin_scan(self):
+        """Start a full scan of the tree; files it does not set are dropped by end_scan()"""
+        with self._lock:
+            self.scan += 1
+        return self.scan
+
+    def end_scan(self, scan):
+        """Forget local files the finished scan did not see; cloud-only files are never on disk to be seen
+
+        The unseen rows are read PAGE_SIZE at a time for the folder totals
+        and dropped with one DELETE, so losing a huge subtree does not load
+        it into memory.
+        """
+        with self._lock:
+            last = ""
+            while True:
+                rows = self.store.conn.execute(
+                    "SELECT relpath, state, size FROM file_states WHERE relpath > ? AND scan < ? AND state != 'cloud' "
+                    "ORDER BY relpath LIMIT ?", (last, scan, PAGE_SIZE)).fetchall()
+                if not rows:
+                    break
+                for relpath, state, size in rows:
+                    self._adjust(relpath, state, -1, -size)
+                last = rows[-1][0]
+            self.store.conn.execute("DELETE FROM file_states WHERE scan < ? AND state != 'cloud'", (scan,))
+
+    def flush(self):
+        with self._lock:
+            deltas = [(folder, state, files, nbytes)
+                      for (folder, state), (files, nbytes) in self._deltas.items() if files or nbytes]
+            self._deltas = {}
+            self.store.conn.executemany(
+                "INSERT INTO rollups (folder, state, files, bytes) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (folder, state) DO UPDATE SET files = files + excluded.files, "
+                "bytes = bytes + excluded.bytes",
+                deltas,
+            )
+            self.store.conn.executemany(
+                "DELETE FROM rollups WHERE folder = ? AND state = ? AND files = 0 AND bytes = 0",
+                [(folder, state) for folder, state, _, _ in deltas],
+            )
@@ -0,0 +1,131 @@
+import io
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+
+# Bytes of part data mapped at once across all uploads, unless "memory_budget" says otherwise
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+class MemoryBudget:
+    """Caps the bytes of part data in flight across concurrent uploads
+
+    Each part reserves its length before its window is mapped and releases
+    it once the part has been sent, so however many workers there are,
+    at most limit bytes are mapped. A part larger than the whole budget
+    still runs, alone.
+    """
+
+    def __init__(self, limit=DEFAULT_MEMORY_BUDGET):
+        self.limit = limit
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        with self._cond:
+            while self.in_flight and self.in_flight + nbytes > self.limit:
+                self._cond.wait()
+            self.in_flight += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= nbytes
+                self._cond.notify_all()
+
+
+class PacedBytes(io.BytesIO):
+    """An in-memory part body whose first reads of each byte are reported to on_read, like PartWindow's"""
+
+    def __init__(self, data, on_read=None):
+        super().__init__(data)
+        self.on_read = on_read
+        self.high_water = 0
+
+    def read(self, size=-1):
+        start = self.tell()
+        data = super().read(size)
+        self.high_water = _report_new(self.on_read, start, start + len(data), self.high_water)
+        return data
+
+
+def _report_new(on_read, start, end, high_water):
+    """Report the bytes of start:end past high_water to on_read; returns the new high-water offset"""
+    if end <= high_water:
+        return high_water
+    if on_read:
+        on_read(end - max(start, high_water))
+    return end
+
+
+class PartWindow(io.RawIOBase):
+    """A read-only, seekable view of length bytes at offset in a file, backed by mmap
+
+    Reads return memoryview slices of the mapping, so part data goes from
+    the page cache to the socket and the hashers without being copied into
+    Python buffers. The window is unmapped on close, releasing its pages.
+    on_read(n), if given, is called as reads first reach n more bytes, e.g.
+    to pace them: botocore reads a body to hash it and again to send it, or
+    after a retry, and those bytes must count once.
+    """
+
+    def __init__(self, filepath, offset, length, on_read=None):
+        super().__init__()
+        self.length = length
+        self.on_read = on_read
+        self.position = 0
+        self.high_water = 0
+        # mmap offsets must be multiples of the allocation granularity
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self._skip = offset - start
+        with open(filepath, "rb") as f:
+            if os.fstat(f.fileno()).st_size < offset + length:
+                raise Exception(f"{filepath} changed while uploading")
+            self._mapped = mmap.mmap(f.fileno(), self._skip + length, offset=start, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mapped)[self._skip:self._skip + length]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def __len__(self):
+        return self.length
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("read from a closed part window")
+        end = self.length if size is None or size < 0 else min(self.length, self.position + size)
+        data = self._view[self.position:end]
+        self.high_water = _report_new(self.on_read, self.position, end, self.high_water)
+        self.position = end
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            try:
+                self._mapped.close()
+            except BufferError:
+                # A slice handed out by read() is still referenced; the mapping goes when it does
+                pass
+        super().close()
@@ -0,0 +1,148 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from model import bandwidth
+
+CONFLICT_RULES = ("newer_wins", "remote_wins", "local_wins", "keep_both")
+DEFAULT_CONFLICT_RULE = "newer_wins"
+# Uploads reset the recorded ETag, so an object with no ETag on record that is
+# no newer than the last local sync (plus slack for clock skew) is our own
+# upload: its ETag is adopted instead of downloading it again.
+ADOPT_SLACK_SECONDS = 120
+
+
+def key_to_relpath(key):
+    return key.replace("/", os.sep)
+
+
+def relpath_to_key(relpath):
+    return relpath.replace(os.sep, "/")
+
+
+def conflict_copy_path(path):
+    root, ext = os.path.splitext(path)
+    return f"{root} (remote copy){ext}"
+
+
+class PullSync:
+    """Bring remote changes made from other machines into the local folder
+
+    The remote listing (ETag, size, LastModified) is diffed against the state
+    recorded in SyncMetadata, and only new or changed objects are downloaded
+    on a bounded worker pool.
+    """
+
+    def __init__(self, client, sync_meta, conflict_rule=DEFAULT_CONFLICT_RULE, max_workers=8):
+        if conflict_rule not in CONFLICT_RULES:
+            raise Exception(f"Unknown conflict rule: {conflict_rule}")
+        self.client = client
+        self.sync_meta = sync_meta
+        self.conflict_rule = conflict_rule
+        self.max_workers = max_workers
+
+    def local_path(self, key):
+        return os.path.join(self.sync_meta.folder, key_to_relpath(key))
+
+    def is_excluded(self, key):
+        if key.endswith("/") or self.sync_meta.ignore.is_path_ignored(key_to_relpath(key)):
+            return True
+        status = self.sync_meta.get_effective_status(key_to_relpath(key))
+        return status in ("no_sync", "object_storage_only")
+
+    def classify(self, obj):
+        """Return (action, local_path) for one remote listing entry
+
+        action is one of "download", "conflict_copy", "adopt" or "skip".
+        """
+        path = self.local_path(obj["Key"])
+        info = self.sync_meta.get_file_info(path)
+        etag = obj["ETag"]
+        if info.get("etag") == etag:
+            return "skip", path
+        local_exists = os.path.isfile(path)
+        if not local_exists:
+            return "download", path
+        local_changed = self.sync_meta.needs_sync(path)
+        if info and not info.get("etag") and not local_changed:
+            remote_mtime = obj["LastModified"].timestamp()
+            if remote_mtime <= info.get("timestamp", 0) + ADOPT_SLACK_SECONDS:
+                return "adopt", path
+        if not local_changed:
+            return "download", path
+        return self.resolve_conflict(obj, path), path
+
+    def resolve_conflict(self, obj, path):
+        if self.conflict_rule == "remote_wins":
+            return "download"
+        if self.conflict_rule == "local_wins":
+            return "skip"
+        if self.conflict_rule == "keep_both":
+            return "conflict_copy"
+        if obj["LastModified"].timestamp() > os.path.getmtime(path):
+            return "download"
+        return "skip"
+
+    def plan(self, prefix=""):
+        """Yield (action, obj, local_path) for every remote object under prefix"""
+        for obj in self.client.list_objects(prefix):
+            if self.is_excluded(obj["Key"]):
+                continue
+            action, path = self.classify(obj)
+            yield action, obj, path
+
+    def _download(self, obj, target):
+        self.client.download_file(obj["Key"], target, obj["Size"])
+        # Hash on the worker so the merging thread never touches file data
+        return self.sync_meta.get_file_hash(target)
+
+    def run(self, prefix="", progress_callback=None):
+        """Pull remote changes; returns a summary dict"""
+        result = {"downloaded": 0, "adopted": 0, "conflicts": 0, "skipped": 0, "errors": []}
+        # Pulled files are tracked under their keys, so the folder is bound to this prefix like a push
+        self.sync_meta.check_remote_prefix(self.client.key_prefix, record=True)
+        bandwidth.activate(bandwidth.BandwidthPolicy.from_config(self.client.config))
+        max_queued = self.max_workers * 2
+
+        with self.sync_meta.batch(), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = {}
+
+            def finish(future):
+                obj, path, action = pending.pop(future)
+                try:
+                    file_hash = future.result()
+                except Exception as e:
+                    result["errors"].append(f"{obj['Key']}: {e}")
+                    return
+                if action == "conflict_copy":
+                    result["conflicts"] += 1
+                else:
+                    self.sync_meta.update_file_info(path, file_hash, time.time())
+                    result["downloaded"] += 1
+                self.sync_meta.update_remote_info(
+                    path, obj["ETag"], obj["Size"], obj["LastModified"].timestamp()
+                )
+                if progress_callback:
+                    progress_callback(obj["Key"], result)
+
+            for action, obj, path in self.plan(prefix):
+                if action == "skip":
+                    result["skipped"] += 1
+                    continue
+                if action == "adopt":
+                    self.sync_meta.update_remote_info(
+                        path, obj["ETag"], obj["Size"], obj["LastModified"].timestamp()
+                    )
+                    result["adopted"] += 1
+                    continue
+                target = conflict_copy_path(path) if action == "conflict_copy" else path
+                future = pool.submit(self._download, obj, target)
+                pending[future] = (obj, path, action)
+                while len(pending) >= max_queued:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+        return result
@@ -0,0 +1,192 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TTL = 60
+DEFAULT_PAGE_SIZE = 500
+# Child prefixes of a listing whose first page is fetched in the background
+PREFETCH_CHILDREN = 8
+
+
+def parent_prefix(key):
+    """The folder prefix containing key: 'a/b/c.txt' -> 'a/b/', 'a/' -> ''"""
+    stripped = key.rstrip("/")
+    if "/" not in stripped:
+        return ""
+    return stripped.rsplit("/", 1)[0] + "/"
+
+
+def page_signature(page):
+    """Identity of a page's contents; ETags change whenever an object changes"""
+    return (
+        tuple(page["prefixes"]),
+        tuple((obj["Key"], obj.get("ETag")) for obj in page["objects"]),
+    )
+
+
+class PrefixListing:
+    """The pages of one prefix fetched so far
+
+    generation identifies this copy of the listing; a reloaded prefix
+    gets a new one, so pages requested for an older copy can be told apart.
+    """
+
+    def __init__(self, prefix, pages, generation=0):
+        self.prefix = prefix
+        self.pages = list(pages)
+        self.next_token = self.pages[-1]["next_token"]
+        self.generation = generation
+        self.fetched = time.time()
+
+    @property
+    def complete(self):
+        return self.next_token is None
+
+    @property
+    def prefixes(self):
+        return [p for page in self.pages for p in page["prefixes"]]
+
+    @property
+    def objects(self):
+        return [obj for page in self.pages for obj in page["objects"]]
+
+
+class ListingCache:
+    """LRU cache of bucket listings per prefix, loaded one page at a time
+
+    A cached prefix older than ttl is revalidated page by page: its loaded
+    pages are fetched again in order and kept while their keys and ETags
+    are unchanged. From the first page that differs the listing is cut
+    off, and later pages are loaded again as the user scrolls. Local
+    uploads and deletes invalidate the affected prefix directly via
+    invalidate_key().
+    """
+
+    def __init__(self, client, ttl=DEFAULT_TTL, max_prefixes=256, page_size=DEFAULT_PAGE_SIZE, prefetch_workers=2,
+                 index=None):
+        self.client = client
+        # Optional KeyIndex kept up to date with every page we list anyway
+        self.index = index
+        self.ttl = ttl
+        self.max_prefixes = max_prefixes
+        self.page_size = page_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._prefetching = set()
+        self._generations = itertools.count(1)
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="prefetch")
+
+    def _fetch(self, prefix, token=None):
+        page = self.client.list_page(prefix, continuation_token=token, max_keys=self.page_size)
+        if self.index is not None and page["objects"]:
+            self.index.add_objects(self.client.config["bucket_name"], page["objects"])
+        return page
+
+    def _new_listing(self, prefix, pages):
+        return PrefixListing(prefix, pages, next(self._generations))
+
+    def _store(self, listing):
+        with self._lock:
+            self._entries[listing.prefix] = listing
+            self._entries.move_to_end(listing.prefix)
+            while len(self._entries) > self.max_prefixes:
+                self._entries.popitem(last=False)
+
+    def cached(self, prefix):
+        with self._lock:
+            listing = self._entries.get(prefix)
+            if listing is not None:
+                self._entries.move_to_end(prefix)
+            return listing
+
+    def get(self, prefix, prefetch=True):
+        """Return the PrefixListing for prefix, with at least its first page loaded"""
+        listing = self.cached(prefix)
+        if listing is None:
+            listing = self._new_listing(prefix, [self._fetch(prefix)])
+            self._store(listing)
+        elif time.time() - listing.fetched > self.ttl:
+            listing = self._revalidate(listing)
+        if prefetch:
+            self.prefetch_children(listing)
+        return listing
+
+    def _revalidate(self, listing):
+        """Refetch the loaded pages of a stale listing, keeping it as long as they are unchanged"""
+        pages, token, changed = [], None, False
+        for old in listing.pages:
+            page = self._fetch(listing.prefix, token)
+            pages.append(page)
+            if page_signature(page) != page_signature(old):
+                # Later pages were listed after a different continuation; load them again on scroll
+                changed = True
+                break
+            token = page["next_token"]
+        if not changed:
+            listing.fetched = time.time()
+            return listing
+        listing = self._new_listing(listing.prefix, pages)
+        self._store(listing)
+        return listing
+
+    def load_more(self, prefix, generation=None):
+        """Fetch the next page of prefix; returns the new page, or None when there is none to add
+
+        With generation, the page is only added to that copy of the
+        listing: None is returned if the prefix was reloaded meanwhile, or
+        if another call already added the page.
+        """
+        listing = self.cached(prefix)
+        if listing is None or listing.complete or generation not in (None, listing.generation):
+            return None
+        token = listing.next_token
+        page = self._fetch(prefix, token)
+        with self._lock:
+            if self._entries.get(prefix) is not listing or listing.next_token != token:
+                return None
+            listing.pages.append(page)
+            listing.next_token = page["next_token"]
+        self.prefetch_children(listing, page)
+        return page
+
+    def prefetch_children(self, listing, page=None):
+        """Warm the first page of child prefixes in the background"""
+        children = (page or listing.pages[0])["prefixes"][:PREFETCH_CHILDREN]
+        for child in children:
+            with self._lock:
+                if child in self._entries or child in self._prefetching:
+                    continue
+                self._prefetching.add(child)
+            self._prefetch_pool.submit(self._prefetch_one, child)
+
+    def _prefetch_one(self, prefix):
+        try:
+            self._store(self._new_listing(prefix, [self._fetch(prefix)]))
+        except Exception:
+            # Prefetch is best effort; a real navigation will surface the error
+            pass
+        finally:
+            with self._lock:
+                self._prefetching.discard(prefix)
+
+    def invalidate(self, prefix=None):
+        """Drop one prefix from the cache, or everything when prefix is None"""
+        with self._lock:
+            if prefix is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(prefix, None)
+
+    def invalidate_key(self, key):
+        """Drop every cached listing that could show key"""
+        prefix = parent_prefix(key)
+        while True:
+            self.invalidate(prefix)
+            if not prefix:
+                break
+            prefix = parent_prefix(prefix)
+
+    def close(self):
+        self._prefetch_pool.shutdown(wait=False)
@@ -0,0 +1,271 @@
+import os
+import queue
+import threading
+from model.delta_upload import DeltaUnavailable
+from model.hashing import hash_file
+from model.wasabi_client import WasabiClient
+
+# Size of each chunk read from disk and handed to every target
+CHUNK_SIZE = 8 * 1024 * 1024
+# Chunks a target may fall behind before the reader waits for it
+MAX_BUFFERED_CHUNKS = 4
+_EOF = object()
+_ABORT = object()
+
+
+class SourceReadError(Exception):
+    """Raised to streaming uploads when reading the local file failed midway"""
+
+
+class QueueReader:
+    """File-like object fed chunk by chunk from a queue by another thread"""
+
+    def __init__(self, maxsize=MAX_BUFFERED_CHUNKS):
+        self.chunks = queue.Queue(maxsize=maxsize)
+        self._buffer = b""
+        self._eof = False
+        # Set once the consuming upload has finished or failed
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is _ABORT:
+                raise SourceReadError("Reading the local file failed.")
+            if chunk is _EOF:
+                self._eof = True
+            else:
+                self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def feed(self, chunk):
+        """Queue a chunk; returns False once the consuming upload has stopped"""
+        while not self.done:
+            try:
+                self.chunks.put(chunk, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class TargetProgress:
+    def __init__(self, name):
+        self.name = name
+        self.bytes_sent = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.last_error = None
+
+
+class ReplicaSet:
+    """Several WasabiClients presented as one, for replicating a folder to N profiles
+
+    Each file is read from disk once and its chunks are streamed to every
+    target in parallel through small bounded queues. Large files a target
+    sends uncompressed go up as its own multipart upload from mapped
+    windows instead, within the shared memory budget. A target that fails
+    is dropped from the shared stream and retried on its own afterwards,
+    so one slow or broken region never fails the upload to the others.
+    """
+
+    def __init__(self, clients, retries=2):
+        if not clients:
+            raise Exception("A replica set needs at least one client.")
+        self.clients = clients
+        self.retries = retries
+        self.progress = {client.name: TargetProgress(client.name) for client in clients}
+        # Sync sends through upload_file, which reaches every target; each client picks its own transport
+        self.transport = None
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return self.clients[0]
+
+    @property
+    def config(self):
+        return self.primary.config
+
+    def _count_bytes(self, name):
+        def callback(n):
+            with self._lock:
+                self.progress[name].bytes_sent += n
+        return callback
+
+    def _stream_upload(self, client, reader, filepath, filename, sha256, errors):
+        try:
+            client.upload_stream(reader, filepath, filename, sha256, callback=self._count_bytes(client.name))
+        except Exception as e:
+            errors[client.name] = e
+        finally:
+            # Unblock the feeder in case it is waiting on this target
+            reader.done = True
+
+    def _parts_upload(self, client, filepath, filename, sha256, errors):
+        try:
+            client.upload_parts(filepath, filename, sha256)
+        except Exception as e:
+            errors[client.name] = e
+        else:
+            with self._lock:
+                self.progress[client.name].bytes_sent += os.path.getsize(filepath)
+
+    def upload_file(self, filepath, filename, sha256=None):
+        """Upload one file to every target, reading it from disk once per stream; returns the SHA-256"""
+        sha256 = sha256 or hash_file(filepath, "sha256")
+        size = os.path.getsize(filepath)
+        # Large uncompressed files go up in parts mapped from disk; the rest share one read
+        parts = [client for client in self.clients if client.uses_parts(filepath, size)]
+        readers = {client.name: QueueReader() for client in self.clients if client not in parts}
+        errors = {}
+        threads = [
+            threading.Thread(
+                target=self._parts_upload,
+                args=(client, filepath, filename, sha256, errors),
+                name=f"replica-{client.name}",
+                daemon=True,
+            )
+            if client in parts else
+            threading.Thread(
+                target=self._stream_upload,
+                args=(client, readers[client.name], filepath, filename, sha256, errors),
+                name=f"replica-{client.name}",
+                daemon=True,
+            )
+            for client in self.clients
+        ]
+        for thread in threads:
+            thread.start()
+        end = _EOF
+        try:
+            with open(filepath, "rb") as f:
+                while readers:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not any([reader.feed(chunk) for reader in readers.values()]):
+                        break
+        except Exception:
+            # Never let a target complete an upload of a truncated stream
+            end = _ABORT
+            raise
+        finally:
+            for reader in readers.values():
+                reader.feed(end)
+            for thread in threads:
+                thread.join()
+
+        failed = []
+        for client in self.clients:
+            progress = self.progress[client.name]
+            error = errors.get(client.name)
+            for _ in range(self.retries if error else 0):
+                try:
+                    client.upload_file(filepath, filename, sha256)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+            # Several files may be uploading at once
+            with self._lock:
+                if error:
+                    progress.files_failed += 1
+                    progress.last_error = str(error)
+                else:
+                    progress.files_done += 1
+            if error:
+                failed.append(f"{client.name}: {error}")
+        if failed:
+            raise Exception("Replication failed for " + "; ".join(failed))
+        return sha256
+
+    def upload_delta(self, filepath, filename, chunks, previous):
+        """Delta re-upload to every target; targets without a usable base get the whole file
+
+        Raises DeltaUnavailable when no target can take a delta, so the
+        caller falls back to upload_file and its single shared read.
+        """
+        stats = {"copied_bytes": 0, "uploaded_bytes": 0}
+        fallback = []
+        for client in self.clients:
+            try:
+                result = client.upload_delta(filepath, filename, chunks, previous)
+            except DeltaUnavailable:
+                fallback.append(client)
+                continue
+            with self._lock:
+                self.progress[client.name].files_done += 1
+                self.progress[client.name].bytes_sent += result["uploaded_bytes"]
+            for name in stats:
+                stats[name] += result[name]
+        if len(fallback) == len(self.clients):
+            raise DeltaUnavailable("no target holds the previous version")
+        for client in fallback:
+            client.upload_file(filepath, filename, chunks["sha256"])
+            with self._lock:
+                self.progress[client.name].files_done += 1
+                self.progress[client.name].bytes_sent += chunks["file_size"]
+            stats["uploaded_bytes"] += chunks["file_size"]
+        return stats
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def copy_object(self, source_key, filename):
+        for client in self.clients:
+            client.copy_object(source_key, filename)
+
+    def verify_object(self, filename, sha256):
+        """Verify on every target; returns the first non-ok result, or 'ok'"""
+        for client in self.clients:
+            result = client.verify_object(filename, sha256)
+            if result != "ok":
+                return f"{result} on {client.name}"
+        return "ok"
+
+    def delete_objects(self, keys):
+        """Delete keys on every target; only keys gone everywhere count as deleted"""
+        deleted = set(keys)
+        errors = []
+        for client in self.clients:
+            removed, client_errors = client.delete_objects(keys)
+            deleted &= set(removed)
+            errors.extend(f"{client.name}: {err}" for err in client_errors)
+        return [key for key in keys if key in deleted], errors
+
+    def __getattr__(self, name):
+        # Reads (listing, download, head) are served by the primary target
+        return getattr(self.primary, name)
+
+
+def create_sync_client():
+    """Return the client sync should use
+
+    That is a plain WasabiClient, or a ReplicaSet of it plus every profile
+    listed under "replicate_profiles" in .wasabi_config.json.
+    """
+    client = WasabiClient()
+    names = (client.config or {}).get("replicate_profiles")
+    if not names:
+        return client
+    profiles = {profile["name"]: profile for profile in WasabiClient.load_profiles()}
+    clients = [client]
+    for name in names:
+        if name not in profiles:
+            raise Exception(f"Replication profile '{name}' not found in {WasabiClient.APP_CONFIG_FILE}.")
+        replica = WasabiClient.from_profile(profiles[name], client.config)
+        # Mapped parts count against one budget, whichever target they go to
+        replica.memory_budget = client.memory_budget
+        clients.append(replica)
+    return ReplicaSet(clients, retries=client.config.get("replication_retries", 2))
@@ -0,0 +1,194 @@
+import heapq
+import json
+import os
+import shutil
+import tempfile
+
+SCHEDULE_FILENAME = ".wasabi_sync_schedule.jsonl"
+DEFAULT_POLICY = "small_first"
+# Files at least this large go to their own lane and are interleaved with the rest
+DEFAULT_BIG_FILE_SIZE = 1024 * 1024 * 1024
+# Share of the bytes sent that goes to big files while small ones are waiting
+DEFAULT_BIG_FILE_SHARE = 0.25
+# Entries sorted in memory at once; longer schedules are merged from sorted runs on disk
+RUN_SIZE = 50000
+
+# name -> function(entry) returning the sort key within a priority class
+POLICIES = {
+    "plan": lambda entry: 0,
+    "small_first": lambda entry: entry.get("size", 0),
+    "recent_first": lambda entry: -entry.get("mtime_ns", 0),
+}
+
+
+def register_policy(name, key):
+    """Register an ordering policy; key(entry) must return a JSON-serializable sort key"""
+    POLICIES[name] = key
+
+
+class ExternalSorter:
+    """Sort (key, entry) pairs of any count in bounded memory
+
+    Pairs are collected into runs of run_size, each sorted and spilled to a
+    temporary JSONL file, and iteration merges the runs. Ties keep the
+    order in which pairs were added.
+    """
+
+    def __init__(self, tmpdir, run_size=RUN_SIZE):
+        self.tmpdir = tmpdir
+        self.run_size = run_size
+        self.runs = []
+        self.buffer = []
+
+    def add(self, key, entry):
+        self.buffer.append((key, entry))
+        if len(self.buffer) >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort(key=lambda pair: pair[0])
+        path = os.path.join(self.tmpdir, f"run{len(self.runs)}-{id(self)}.jsonl")
+        with open(path, "w") as f:
+            for pair in self.buffer:
+                f.write(json.dumps(pair) + "\n")
+        self.runs.append(path)
+        self.buffer = []
+
+    @staticmethod
+    def _read_run(path):
+        with open(path, "r") as f:
+            for line in f:
+                key, entry = json.loads(line)
+                yield key, entry
+
+    def __iter__(self):
+        if not self.runs:
+            # Everything fit in memory; round-trip keys through JSON so they compare like spilled ones
+            self.buffer.sort(key=lambda pair: pair[0])
+            return ((json.loads(json.dumps(key)), entry) for key, entry in self.buffer)
+        if self.buffer:
+            self._spill()
+        return heapq.merge(*(self._read_run(path) for path in self.runs), key=lambda pair: pair[0])
+
+
+class TransferScheduler:
+    """Decide the order in which a plan's transfers run
+
+    Within a priority class files are ordered by a pluggable policy
+    (small_first, recent_first, plan order, or anything registered with
+    register_policy). Files under pinned folders always come first, in the
+    order the folders are listed. With fair_share, top-level folders take
+    turns so one huge folder cannot hold back the others. Files of at least
+    big_file_size run in their own lane, receiving about big_file_share of
+    the bytes sent, so a 40 GB video neither goes first nor waits forever.
+
+    The schedule is written to a file, which keeps memory flat for
+    millions of files and lets an interrupted run resume in the same order.
+    """
+
+    def __init__(self, policy=DEFAULT_POLICY, pinned=None, fair_share=False,
+                 big_file_size=DEFAULT_BIG_FILE_SIZE, big_file_share=DEFAULT_BIG_FILE_SHARE, run_size=RUN_SIZE):
+        if policy not in POLICIES:
+            raise Exception(f"Unknown scheduling policy: {policy}")
+        self.policy = policy
+        self.pinned = [p.strip("/") for p in (pinned or []) if p.strip("/")]
+        self.fair_share = fair_share
+        self.big_file_size = big_file_size
+        self.big_file_share = big_file_share
+        self.run_size = run_size
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Build from the "schedule" setting, e.g. {"policy": "recent_first", "pinned": ["Contracts"]}"""
+        cfg = cfg or {}
+        return cls(
+            policy=cfg.get("policy", DEFAULT_POLICY),
+            pinned=cfg.get("pinned"),
+            fair_share=cfg.get("fair_share", False),
+            big_file_size=cfg.get("big_file_size", DEFAULT_BIG_FILE_SIZE),
+            big_file_share=cfg.get("big_file_share", DEFAULT_BIG_FILE_SHARE),
+        )
+
+    def pin_rank(self, relpath):
+        path = relpath.replace(os.sep, "/")
+        for rank, folder in enumerate(self.pinned):
+            if path == folder or path.startswith(folder + "/"):
+                return rank
+        return len(self.pinned)
+
+    @staticmethod
+    def top_folder(relpath):
+        parts = relpath.replace(os.sep, "/").split("/", 1)
+        return parts[0] if len(parts) > 1 else ""
+
+    def is_big(self, entry):
+        return bool(self.big_file_size) and entry.get("size", 0) >= self.big_file_size
+
+    def _ordered_lanes(self, entries, tmpdir):
+        """Sort entries into a small-file lane and a big-file lane; keys start with the pin rank"""
+        policy = POLICIES[self.policy]
+        first = {"small": ExternalSorter(tmpdir, self.run_size), "big": ExternalSorter(tmpdir, self.run_size)}
+        for index, entry in enumerate(entries):
+            lane = "big" if self.is_big(entry) else "small"
+            pin = self.pin_rank(entry["relpath"])
+            if self.fair_share:
+                key = [pin, self.top_folder(entry["relpath"]), policy(entry), index]
+            else:
+                key = [pin, policy(entry), index]
+            first[lane].add(key, entry)
+        if not self.fair_share:
+            return iter(first["small"]), iter(first["big"])
+
+        # Number each file within its folder, then order by that turn: folders go round-robin
+        lanes = []
+        for sorter in (first["small"], first["big"]):
+            second = ExternalSorter(tmpdir, self.run_size)
+            group, turn = None, 0
+            for key, entry in sorter:
+                turn = turn + 1 if key[:2] == group else 0
+                group = key[:2]
+                second.add([key[0], turn, key[1]], entry)
+            lanes.append(iter(second))
+        return lanes[0], lanes[1]
+
+    def _interleave(self, small, big):
+        """Merge the lanes, giving big files about big_file_share of the bytes"""
+        sent = {"small": 0, "big": 0}
+        heads = {"small": next(small, None), "big": next(big, None)}
+        lanes = {"small": small, "big": big}
+        while heads["small"] is not None or heads["big"] is not None:
+            if heads["big"] is None:
+                lane = "small"
+            elif heads["small"] is None:
+                lane = "big"
+            elif heads["small"][0][0] != heads["big"][0][0]:
+                # A pinned file comes first whichever lane it is in
+                lane = "small" if heads["small"][0][0] < heads["big"][0][0] else "big"
+            else:
+                total = sent["small"] + sent["big"]
+                lane = "big" if sent["big"] < self.big_file_share * total else "small"
+            entry = heads[lane][1]
+            sent[lane] += entry.get("size", 0)
+            heads[lane] = next(lanes[lane], None)
+            yield entry
+
+    def schedule(self, entries, path):
+        """Write entries to path in execution order; returns the number written"""
+        tmpdir = tempfile.mkdtemp(prefix=".wasabi_sync_sort", dir=os.path.dirname(os.path.abspath(path)))
+        count = 0
+        try:
+            small, big = self._ordered_lanes(entries, tmpdir)
+            with open(path + ".tmp", "w") as f:
+                for entry in self._interleave(small, big):
+                    f.write(json.dumps(entry) + "\n")
+                    count += 1
+            os.replace(path + ".tmp", path)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return count
+
+
+def iter_schedule(path):
+    with open(path, "r") as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,478 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from model import bandwidth, tracing
+from model.concurrency import bounded_imap
+from model.delta_upload import DEFAULT_DELTA_THRESHOLD, DeltaUnavailable, chunk_size_for, hash_chunks
+from model.journal import JOURNAL_FILENAME, OperationJournal
+from model.scheduler import SCHEDULE_FILENAME, TransferScheduler, iter_schedule
+
+# How often metadata is written to disk during a run
+CHECKPOINT_SECONDS = 10
+# Plan actions executed by the worker pool; deletes run separately at the end
+EXECUTED_ACTIONS = ("upload", "upload_and_remove", "copy", "remove_local")
+DEFAULT_UPLOAD_WORKERS = 4
+# Keys per DeleteObjects call when deletes are replayed from the plan
+DELETE_BATCH_SIZE = 1000
+# Messages of each kind kept in memory for display; the log file has all of them
+LOG_SAMPLE_SIZE = 100
+ERROR_LOG_FILENAME = ".wasabi_sync_errors.log"
+HEALTH_LOG_FILENAME = ".wasabi_sync_health.log"
+
+
+class SyncLog:
+    """Counts messages, keeps the first few for display and writes all of them to a file"""
+
+    def __init__(self, path=None, sample_size=LOG_SAMPLE_SIZE):
+        self.path = path
+        self.sample_size = sample_size
+        self.count = 0
+        self.sample = []
+        self._file = None
+
+    def append(self, message):
+        self.count += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append(message)
+        if self.path:
+            if self._file is None:
+                self._file = open(self.path, "w", buffering=1)
+            self._file.write(message + "\n")
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    @property
+    def truncated(self):
+        return self.count > len(self.sample)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.sample)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SyncProgress:
+    """Exact progress and ETA for a plan, measured in planned bytes"""
+
+    def __init__(self, plan):
+        self.total_files = plan.transfer_count
+        self.total_bytes = plan.transfer_bytes
+        self.done_files = 0
+        self.done_bytes = 0
+        # Uploads and copies that succeeded in this run; done_files also counts failures and resumed actions
+        self.synced = 0
+        self.current = None
+        self.started = time.time()
+
+    def advance(self, entry):
+        self.done_files += 1
+        self.done_bytes += entry.get("size", 0)
+        self.current = entry["relpath"]
+
+    @property
+    def fraction(self):
+        if self.total_bytes:
+            return self.done_bytes / self.total_bytes
+        if self.total_files:
+            return self.done_files / self.total_files
+        return 1.0
+
+    @property
+    def eta(self):
+        """Estimated seconds remaining, or None until there is enough data"""
+        elapsed = time.time() - self.started
+        if not self.done_bytes or elapsed <= 0:
+            return None
+        rate = self.done_bytes / elapsed
+        return (self.total_bytes - self.done_bytes) / rate
+
+
+def keep_local_copy(entry):
+    """The plan entry with upload_and_remove downgraded to a plain upload"""
+    if entry["action"] == "upload_and_remove":
+        return dict(entry, action="upload")
+    return entry
+
+
+def keep_local_copies(actions, removable=None):
+    """actions with every local removal dropped, except for the relpaths in removable"""
+    for entry in actions:
+        if removable is not None and entry["relpath"] in removable:
+            yield entry
+        elif entry["action"] != "remove_local":
+            yield keep_local_copy(entry)
+
+
+class SyncEngine:
+    """Execute a SyncPlan against the bucket without rescanning the folder
+
+    The plan is streamed from disk into a small pool of upload workers
+    through a bounded queue. Workers only talk to the bucket and the
+    filesystem; every metadata write happens on the calling thread.
+    """
+
+    def __init__(self, client, sync_meta, verify_uploads=True, upload_workers=DEFAULT_UPLOAD_WORKERS,
+                 delta_threshold=DEFAULT_DELTA_THRESHOLD, scheduler=None,
+                 bandwidth_policy=None):
+        self.client = client
+        self.sync_meta = sync_meta
+        self.verify_uploads = verify_uploads
+        self.upload_workers = upload_workers
+        # Files this large are re-uploaded as deltas against their previous version; 0 disables
+        self.delta_threshold = delta_threshold
+        # Bytes copied server-side by delta uploads instead of being sent again
+        self.bytes_reused = 0
+        self.scheduler = scheduler or TransferScheduler()
+        # Upload and download caps put in force for the whole process when a run starts
+        self.bandwidth_policy = bandwidth_policy
+        self.schedule_path = os.path.join(sync_meta.folder, SCHEDULE_FILENAME)
+        self.journal = OperationJournal(os.path.join(sync_meta.folder, JOURNAL_FILENAME))
+        # Actions an interrupted earlier run had already finished
+        self.resumed = 0
+        self.errors = SyncLog(os.path.join(sync_meta.folder, ERROR_LOG_FILENAME))
+        self.health_issues = SyncLog(os.path.join(sync_meta.folder, HEALTH_LOG_FILENAME))
+        self.progress = None
+        self._last_checkpoint = 0
+
+    @classmethod
+    def from_config(cls, client, sync_meta, cfg=None):
+        """Build an engine from the "verify_uploads", "upload_workers", "delta_threshold", "schedule"
+        and "bandwidth" settings
+        """
+        cfg = cfg or {}
+        return cls(
+            client,
+            sync_meta,
+            verify_uploads=cfg.get("verify_uploads", True),
+            upload_workers=cfg.get("upload_workers", DEFAULT_UPLOAD_WORKERS),
+            delta_threshold=cfg.get("delta_threshold", DEFAULT_DELTA_THRESHOLD),
+            scheduler=TransferScheduler.from_config(cfg.get("schedule")),
+            bandwidth_policy=bandwidth.BandwidthPolicy.from_config(cfg),
+        )
+
+    def path_for(self, entry):
+        return os.path.join(self.sync_meta.folder, entry["relpath"])
+
+    def planned_hash(self, entry, path, algorithm):
+        """The hash recorded in the plan, if the file is unchanged since planning"""
+        if entry.get("algorithm") != algorithm:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size == entry["size"] and st.st_mtime_ns == entry.get("mtime_ns"):
+            return entry["hash"]
+        return None
+
+    def upload(self, entry):
+        """Worker side of an upload; returns what record() needs"""
+        path = self.path_for(entry)
+        if self.delta_threshold and entry["size"] >= self.delta_threshold:
+            result = self.upload_large(entry, path)
+        else:
+            sha256 = self.planned_hash(entry, path, "sha256") or self.sync_meta.get_file_hash(path, "sha256")
+            self.client.upload_file(path, entry["key"], sha256)
+            result = {"sha256": sha256}
+        if entry["algorithm"] == "sha256":
+            result["hash"] = result["sha256"]
+        else:
+            result["hash"] = self.planned_hash(entry, path, entry["algorithm"]) or self.sync_meta.get_file_hash(
+                path, entry["algorithm"])
+        return result
+
+    def upload_large(self, entry, path):
+        """Upload a large file, sending only the chunks changed since its last upload when possible"""
+        previous = self.sync_meta.get_chunk_info(path)
+        with tracing.span("hash_chunks", "sync", path=path):
+            chunks = hash_chunks(path, chunk_size_for(entry["size"], previous))
+        result = {"sha256": chunks["sha256"], "chunks": chunks}
+        if previous:
+            try:
+                stats = self.client.upload_delta(path, entry["key"], chunks, previous)
+                result["copied_bytes"] = stats["copied_bytes"]
+                return result
+            except DeltaUnavailable:
+                pass
+        self.client.upload_file(path, entry["key"], chunks["sha256"])
+        return result
+
+    def copy(self, entry):
+        self.client.copy_object(entry["source_key"], entry["key"])
+        return {"sha256": entry["sha256"], "hash": entry["hash"]}
+
+    def remove_local(self, entry):
+        self.remove_verified(entry, self.client.verify_object(entry["key"], entry.get("sha256")))
+        return {}
+
+    def remove_verified(self, entry, verify):
+        """Delete the local copy of a file, but only if the bucket confirmed its remote copy"""
+        if verify not in ("ok", "unverified"):
+            raise Exception("remote copy could not be confirmed; local file kept")
+        os.remove(self.path_for(entry))
+
+    def finish_interrupted(self, entry):
+        """Result of an action that was in flight when the last run died, or None to run it again
+
+        Uploads the bucket already holds are not sent a second time.
+        """
+        path = self.path_for(entry)
+        action = entry["action"]
+        if action in ("upload_and_remove", "remove_local") and not os.path.exists(path):
+            # The local copy is only removed once the upload is confirmed
+            return {}
+        if action not in ("upload", "upload_and_remove"):
+            return None
+        sha256 = self.planned_hash(entry, path, "sha256") or self.sync_meta.get_file_hash(path, "sha256")
+        if self.client.verify_object(entry["key"], sha256) != "ok":
+            return None
+        file_hash = sha256 if entry["algorithm"] == "sha256" else (
+            self.planned_hash(entry, path, entry["algorithm"]) or self.sync_meta.get_file_hash(path, entry["algorithm"]))
+        if action == "upload_and_remove":
+            os.remove(path)
+        return {"sha256": sha256, "hash": file_hash}
+
+    def run_action(self, entry):
+        """Runs on a worker thread"""
+        with tracing.span(entry["action"], "sync", path=entry["relpath"], size=entry.get("size", 0)):
+            return self._run_action(entry)
+
+    def _run_action(self, entry):
+        if entry.get("interrupted"):
+            result = self.finish_interrupted(entry)
+            if result is not None:
+                return result
+        action = entry["action"]
+        if action in ("upload", "upload_and_remove"):
+            result = self.upload(entry)
+        elif action == "copy":
+            result = self.copy(entry)
+        elif action == "remove_local":
+            return self.remove_local(entry)
+        else:
+            raise Exception(f"unknown plan action '{action}'")
+        # A local copy is only removed once its upload checks out, whatever verify_uploads says
+        if self.verify_uploads or action == "upload_and_remove":
+            result["verify"] = self.client.verify_object(entry["key"], result["sha256"])
+        if action == "upload_and_remove":
+            self.remove_verified(entry, result["verify"])
+        return result
+
+    def small_upload_hashes(self, entry, path):
+        """(sha256, hash) for an upload the async transport can send whole, or None if it cannot"""
+        if entry.get("interrupted") or (self.delta_threshold and entry["size"] >= self.delta_threshold):
+            return None
+        if not self.client.uses_transport(path, entry["size"]):
+            return None
+        sha256 = self.planned_hash(entry, path, "sha256") or self.sync_meta.get_file_hash(path, "sha256")
+        if entry["algorithm"] == "sha256":
+            return sha256, sha256
+        return sha256, self.planned_hash(entry, path, entry["algorithm"]) or self.sync_meta.get_file_hash(
+            path, entry["algorithm"])
+
+    async def run_action_async(self, entry, threads):
+        """run_action for clients with an async transport; runs on its event loop
+
+        Small plain uploads and their checks are sent on the loop, with
+        disk work offloaded to the transport's I/O threads. Every other
+        action runs the ordinary run_action on threads.
+        """
+        loop = asyncio.get_running_loop()
+        transport = self.client.transport
+        hashes = None
+        if entry["action"] in ("upload", "upload_and_remove"):
+            hashes = await transport.offload(self.small_upload_hashes, entry, self.path_for(entry))
+        if hashes is None:
+            return await loop.run_in_executor(threads, self.run_action, entry)
+        sha256, file_hash = hashes
+        path = self.path_for(entry)
+        await self.client.upload_file_async(path, entry["key"], sha256)
+        result = {"sha256": sha256, "hash": file_hash}
+        if self.verify_uploads or entry["action"] == "upload_and_remove":
+            result["verify"] = await self.client.verify_object_async(entry["key"], sha256)
+        if entry["action"] == "upload_and_remove":
+            await transport.offload(self.remove_verified, entry, result["verify"])
+        return result
+
+    def run_actions(self, actions):
+        """Run actions on the async transport if the client has one, else on the upload thread pool
+
+        Yields (entry, result, error) like bounded_imap.
+        """
+        transport = getattr(self.client, "transport", None)
+        if transport is None:
+            yield from bounded_imap(self.run_action, actions, self.upload_workers, thread_name_prefix="sync")
+            return
+        # Actions the transport does not take still run on upload_workers threads
+        with ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="sync") as threads:
+            yield from transport.imap(lambda entry: self.run_action_async(entry, threads), actions)
+
+    def record(self, entry, result):
+        """Apply a finished action to the metadata; runs on the calling thread"""
+        action = entry["action"]
+        if action in ("upload_and_remove", "remove_local"):
+            self.sync_meta.set_status(entry["relpath"], "object_storage_only")
+        elif result.get("hash"):
+            self.sync_meta.update_file_info(self.path_for(entry), result["hash"], time.time(), entry["algorithm"],
+                                            sha256=result["sha256"], chunks=result.get("chunks"))
+            self.bytes_reused += result.get("copied_bytes", 0)
+        if result.get("verify", "ok") != "ok":
+            self.health_issues.append(f"{entry['relpath']}: remote check {result['verify']}")
+
+    def delete(self, entries):
+        if not entries:
+            return
+        keys = {entry["key"]: entry["relpath"] for entry in entries}
+        removed, errors = self.client.delete_objects(list(keys))
+        for key in removed:
+            self.sync_meta.remove_file_info(keys[key])
+        self.errors.extend(errors)
+
+    def replay(self):
+        """Re-apply completions the journal holds but the metadata may have missed"""
+        for record in self.journal.iter_done():
+            if record["action"] in ("upload_and_remove", "remove_local"):
+                if self.sync_meta.get_status(record["relpath"]) != "object_storage_only":
+                    self.sync_meta.set_status(record["relpath"], "object_storage_only")
+            elif record.get("hash"):
+                path = os.path.join(self.sync_meta.folder, record["relpath"])
+                info = self.sync_meta.get_file_info(path)
+                if info.get("hash") != record["hash"] or info.get("sha256") != record["sha256"]:
+                    self.sync_meta.update_file_info(path, record["hash"], time.time(), record["algorithm"],
+                                                    sha256=record["sha256"])
+
+    def schedule(self, plan, keep_local, remove_only=None):
+        """Write the plan's executed actions to the schedule file in the order they will run"""
+        actions = plan.iter_actions(*EXECUTED_ACTIONS)
+        if keep_local:
+            actions = keep_local_copies(actions)
+        elif remove_only is not None:
+            actions = keep_local_copies(actions, set(remove_only))
+        self.scheduler.schedule(actions, self.schedule_path)
+
+    def pending_actions(self, progress, state):
+        """Scheduled entries still to run, each journaled as an intent before it is handed out"""
+        for seq, entry in enumerate(iter_schedule(self.schedule_path)):
+            entry["seq"] = seq
+            if state is not None and seq <= state.high_seq:
+                if state.is_done(seq):
+                    self.resumed += 1
+                    if entry["action"] != "remove_local":
+                        progress.advance(entry)
+                    continue
+                entry["interrupted"] = True
+            self.journal.intent(entry)
+            yield entry
+
+    def execute(self, plan, progress_callback=None, keep_local=False, remove_only=None):
+        """Run every action in plan; returns the SyncProgress
+
+        With keep_local, cloud-only files are uploaded but no local copy is
+        removed; with remove_only, only the local copies of those relpaths
+        are. If the journal shows an earlier run of this same plan was
+        interrupted, it is resumed: finished actions are skipped, and the
+        ones that were in flight are checked against the bucket first.
+        Actions run in the order decided by the scheduler; a resumed run
+        reuses the schedule it started with.
+        """
+        if self.bandwidth_policy is not None:
+            bandwidth.activate(self.bandwidth_policy)
+        try:
+            with self.sync_meta.batch():
+                actions = self.begin(plan, keep_local, remove_only)
+                for entry, result, error in self.run_actions(actions):
+                    self.complete(entry, result, error, progress_callback)
+                self.run_deletes(plan)
+            self.retire()
+        finally:
+            self.close()
+        return self.progress
+
+    def begin(self, plan, keep_local=False, remove_only=None):
+        """Start or resume a run of plan; returns the actions still to run
+
+        Call inside sync_meta.batch(), hand each result to complete(), then
+        run_deletes(), retire() and close(). execute() does all of this;
+        the steps are separate so one pool can drive several engines.
+        Raises before anything is sent if the folder has synced under
+        another key prefix than the client's, journal or not.
+        """
+        self.sync_meta.check_remote_prefix(self.client.key_prefix, record=True)
+        self.progress = SyncProgress(plan)
+        self._last_checkpoint = time.time()
+        for entry in plan.iter_actions("unreadable"):
+            self.errors.append(f"{entry['relpath']}: {entry['error']}")
+        state = self.journal.load()
+        if state is not None and (
+            (state.plan_path, state.plan_created) != (plan.path, plan.created)
+            or not os.path.exists(self.schedule_path)
+        ):
+            state = None
+        if state is not None:
+            self.replay()
+            self.sync_meta.checkpoint()
+            self.journal.reopen()
+        else:
+            self.schedule(plan, keep_local, remove_only)
+            self.journal.begin(plan, keep_local)
+        return self.pending_actions(self.progress, state)
+
+    def complete(self, entry, result, error, progress_callback=None):
+        """Record one finished action and advance progress; runs on the calling thread"""
+        if error is not None:
+            self.errors.append(f"{entry['relpath']}: {error}")
+        else:
+            with tracing.span("record", "metadata", path=entry["relpath"]):
+                self.record(entry, result)
+        self.journal.done(entry, result, error)
+        if entry["action"] != "remove_local":
+            if error is None:
+                self.progress.synced += 1
+            self.progress.advance(entry)
+            if progress_callback:
+                progress_callback(self.progress)
+        if time.time() - self._last_checkpoint >= CHECKPOINT_SECONDS:
+            self.journal.sync()
+            self.sync_meta.checkpoint()
+            self._last_checkpoint = time.time()
+
+    def run_deletes(self, plan):
+        """Send the plan's remote deletes in batches, after every other action
+
+        Deletes go last, in a second pass over the plan, so planned copies can still
+        read their source objects. They are idempotent, so a resumed run simply repeats them.
+        """
+        batch = []
+        for entry in plan.iter_actions("delete"):
+            batch.append(entry)
+            if len(batch) >= DELETE_BATCH_SIZE:
+                self._delete_batch(batch)
+                batch = []
+        self._delete_batch(batch)
+
+    def retire(self):
+        """Mark the run finished, so the next one starts from a new plan"""
+        self.journal.finish()
+        os.remove(self.schedule_path)
+
+    def close(self):
+        self.journal.close()
+        self.errors.close()
+        self.health_issues.close()
+        self.client.close()
+
+    def _delete_batch(self, entries):
+        try:
+            with tracing.span("delete_batch", "sync", count=len(entries)):
+                self.delete(entries)
+        except Exception as e:
+            self.errors.append(f"delete: {e}")
@@ -0,0 +1,94 @@
+import threading
+from model import tracing
+from model.journal import resume_or_build_plan
+from model.sync_plan import plan_options
+from model.sync_engine import SyncEngine
+
+PLANNING = "planning"
+PLANNED = "planned"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class SyncJob:
+    """One sync run on a background thread, for UIs that poll it from their own loop
+
+    plan() scans the folder on a worker thread and stops in the "planned"
+    state so the UI can ask one question about local removals; execute()
+    then runs the plan on another worker thread. The UI only reads state,
+    progress and the engine's logs, so its main loop never blocks. With the
+    "trace" setting on, both phases are traced into one file.
+    """
+
+    def __init__(self, client, sync_meta, cfg=None):
+        self.client = client
+        self.sync_meta = sync_meta
+        self.cfg = cfg or {}
+        self.state = None
+        self.plan_result = None
+        # True when continuing a run that was interrupted
+        self.resumed = False
+        self.progress = None
+        self.error = None
+        self.engine = SyncEngine.from_config(client, sync_meta, self.cfg)
+
+    @property
+    def busy(self):
+        return self.state in (PLANNING, RUNNING)
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+    def _start(self, state, target):
+        if self.busy:
+            raise Exception("A sync is already running.")
+        self.state = state
+        threading.Thread(target=target, name=f"sync-{state}", daemon=True).start()
+
+    def plan(self):
+        self._start(PLANNING, self._plan)
+
+    def _plan(self):
+        trace_path = tracing.trace_path(self.cfg, self.sync_meta.folder)
+        if trace_path:
+            tracing.start(trace_path)
+        try:
+            self.plan_result, self.resumed = resume_or_build_plan(self.sync_meta, **plan_options(self.cfg))
+            self.state = PLANNED
+        except Exception as e:
+            tracing.stop()
+            self.error = e
+            self.state = FAILED
+
+    @property
+    def local_removals(self):
+        """Local copies the plan would delete (cloud-only files)
+
+        A resumed run keeps the answer given when it first started, so this is 0.
+        """
+        if self.resumed:
+            return 0
+        totals = self.plan_result.totals() if self.plan_result else {}
+        return sum(totals.get(action, {}).get("count", 0) for action in ("upload_and_remove", "remove_local"))
+
+    def execute(self, keep_local=False, remove_only=None):
+        """Run the plan; keep_local and remove_only limit local removals as in SyncEngine.execute"""
+        if self.state != PLANNED:
+            raise Exception("Plan the sync before executing it.")
+        self._start(RUNNING, lambda: self._execute(keep_local, remove_only))
+
+    def _execute(self, keep_local, remove_only):
+        try:
+            self.progress = self.engine.execute(self.plan_result, self._on_progress, keep_local=keep_local,
+                                                remove_only=remove_only)
+            self.state = DONE
+        except Exception as e:
+            self.error = e
+            self.state = FAILED
+        finally:
+            tracing.stop()
+
+    def _on_progress(self, progress):
+        self.progress = progress
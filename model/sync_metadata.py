@@ -1,57 +1,273 @@
 import os
 import json
-import hashlib
-import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from model import tracing
+from model.hashing import DEFAULT_ALGORITHM, hash_file, hash_files, is_supported
+from model.ignore import IgnoreMatcher
+from model.metadata_store import FolderRollups, MetadataStore
+
+# Most recent hashes kept in memory; older ones are simply recomputed
+HASH_CACHE_SIZE = 10000
+
+
+def stored_status(store, relpath):
+    """Status recorded for relpath in a MetadataStore: 'both', 'object_storage_only' or 'no_sync'"""
+    return store.get(relpath, "both")
+
+
+def effective_status(store, relpath):
+    """Status of relpath, taking no_sync/object_storage_only on parent folders into account"""
+    parts = relpath.split(os.sep)
+    for i in range(1, len(parts)):
+        status = stored_status(store, os.path.join(*parts[:i]))
+        if status != "both":
+            return status
+    return stored_status(store, relpath)
+
+
+def _describe_prefix(prefix):
+    return f"keys under '{prefix}'" if prefix else "the top of the bucket"
+
 
 class SyncMetadata:
+    # Legacy JSON state file, imported into the database on first open
     SYNC_META_FILENAME = ".wasabi_sync.json"
+    SYNC_DB_FILENAME = ".wasabi_sync.db"
 
-    def __init__(self, folder):
+    def __init__(self, folder, hash_algorithm=None, ignore_patterns=None, default_ignores=True):
         self.folder = folder
+        self.hash_algorithm = hash_algorithm or DEFAULT_ALGORITHM
+        # Files and folders sync never looks at: built-in junk, configured patterns and .wasabiignore files
+        self.ignore = IgnoreMatcher.for_folder(folder, ignore_patterns, default_ignores)
+        # path -> (size, mtime_ns, algorithm, digest), least recently used first
+        self.hash_cache = OrderedDict()
+        self._hash_cache_lock = threading.Lock()
+        self._batch_depth = 0
+        self._dirty = False
         self.meta_path = os.path.join(folder, self.SYNC_META_FILENAME)
+        self.db_path = os.path.join(folder, self.SYNC_DB_FILENAME)
         self.metadata = self.load()
+        # Per-folder synced/pending/cloud-only/excluded totals, for badges without a walk
+        self.rollups = FolderRollups(self.metadata)
+
+    @classmethod
+    def from_config(cls, folder, cfg=None):
+        """Open folder's metadata with the "hash_algorithm", "ignore" and "default_ignores" settings"""
+        cfg = cfg or {}
+        return cls(
+            folder,
+            hash_algorithm=cfg.get("hash_algorithm"),
+            ignore_patterns=cfg.get("ignore"),
+            default_ignores=cfg.get("default_ignores", True),
+        )
 
     def load(self):
-        if os.path.exists(self.meta_path):
+        store = MetadataStore(self.db_path)
+        if os.path.exists(self.meta_path) and not len(store):
             with open(self.meta_path, "r") as f:
-                return json.load(f)
-        return {}
+                store.update(json.load(f).items())
+            store.commit()
+            # Keep the old file around, but out of the way of future loads
+            os.replace(self.meta_path, self.meta_path + ".migrated")
+        return store
 
     def save(self):
-        with open(self.meta_path, "w") as f:
-            json.dump(self.metadata, f, indent=2)
+        if self._batch_depth:
+            self._dirty = True
+            return
+        self._dirty = False
+        with tracing.span("flush", "metadata"):
+            self.rollups.flush()
+            self.metadata.commit()
+
+    def checkpoint(self):
+        """Write pending changes now, even inside a batch"""
+        if self._dirty:
+            self._dirty = False
+            with tracing.span("flush", "metadata"):
+                self.rollups.flush()
+                self.metadata.commit()
+
+    def close(self):
+        self.rollups.flush()
+        self.metadata.close()
+
+    @contextmanager
+    def batch(self):
+        """Defer saves until the outermost batch exits, then save once"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._dirty:
+                self.save()
+
+    @property
+    def remote_prefix(self):
+        """Key prefix this folder has synced to, "" for the top of the bucket; None before its first sync"""
+        return self.metadata.get_setting("remote_prefix")
+
+    def check_remote_prefix(self, prefix, record=False):
+        """Raise if this folder has synced under a key prefix other than prefix
+
+        With record, a folder that has not synced yet is bound to prefix,
+        so every later push, pull, cleanup or audit uses the same keys.
+        """
+        recorded = self.remote_prefix
+        if recorded is None:
+            if record:
+                self.metadata.set_setting("remote_prefix", prefix)
+                self.metadata.commit()
+            return
+        if recorded != prefix:
+            raise Exception(
+                f"{self.folder} syncs to {_describe_prefix(recorded)}, not {_describe_prefix(prefix)}; "
+                "syncing it both ways would split its files between the two.")
 
     def get_status(self, filename):
         # Now supports 'both', 'object_storage_only', and 'no_sync'
-        return self.metadata.get(filename, "both")
+        return stored_status(self.metadata, filename)
+
+    def get_effective_status(self, relpath):
+        """Status of relpath, taking no_sync/object_storage_only on parent folders into account"""
+        return effective_status(self.metadata, relpath)
 
     def set_status(self, filename, status):
         # status can be 'both', 'object_storage_only', or 'no_sync'
         self.metadata[filename] = status
+        self.restate(filename)
         self.save()
 
-    def get_file_hash(self, filepath):
-        """Calculate SHA256 hash of a file"""
-        if not os.path.exists(filepath):
+    def restate(self, relpath):
+        """Bring the rollup states of relpath and everything below it in line with their statuses
+
+        Only files a scan has recorded are touched. A file coming back into
+        sync counts as synced if it has sync info, else as pending, until
+        the next scan compares its content.
+        """
+        rows = list(self.rollups.iter_under(relpath))
+        own = self.rollups.get(relpath)
+        if own:
+            rows.append((relpath,) + own)
+        for path, state, size in rows:
+            status = self.get_effective_status(path)
+            if status == "no_sync":
+                new_state = "excluded"
+            elif not os.path.exists(os.path.join(self.folder, path)):
+                has_info = f"{path}_info" in self.metadata
+                new_state = "cloud" if status == "object_storage_only" or state == "cloud" or has_info else None
+            elif status == "object_storage_only":
+                # The local copy is still to be removed
+                new_state = "pending"
+            elif state in ("excluded", "cloud"):
+                new_state = "synced" if f"{path}_info" in self.metadata else "pending"
+            else:
+                new_state = state
+            if new_state is None:
+                self.rollups.remove(path)
+            elif new_state != state:
+                self.rollups.set(path, new_state)
+
+    def folder_rollup(self, folder_path=None):
+        """FolderRollup of folder_path (default: the sync root), as of the last scan and every change since"""
+        relpath = os.path.relpath(folder_path, self.folder) if folder_path else ""
+        return self.rollups.folder(relpath)
+
+    def get_file_hash(self, filepath, algorithm=None):
+        """Calculate the hash of a file (defaults to the configured algorithm)"""
+        algorithm = algorithm or self.hash_algorithm
+        try:
+            st = os.stat(filepath)
+        except OSError:
             return None
-        hash_sha256 = hashlib.sha256()
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_sha256.update(chunk)
-        return hash_sha256.hexdigest()
+        with self._hash_cache_lock:
+            cached = self.hash_cache.get(filepath)
+        if cached and cached[:3] == (st.st_size, st.st_mtime_ns, algorithm):
+            return cached[3]
+        digest = hash_file(filepath, algorithm)
+        self.cache_hash(filepath, algorithm, digest, st)
+        return digest
+
+    def cache_hash(self, filepath, algorithm, digest, st=None):
+        """Remember a computed hash until the file's size or mtime changes"""
+        if digest is None:
+            with self._hash_cache_lock:
+                self.hash_cache.pop(filepath, None)
+            return
+        if st is None:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                return
+        with self._hash_cache_lock:
+            self.hash_cache[filepath] = (st.st_size, st.st_mtime_ns, algorithm, digest)
+            self.hash_cache.move_to_end(filepath)
+            while len(self.hash_cache) > HASH_CACHE_SIZE:
+                self.hash_cache.popitem(last=False)
 
     def get_file_info(self, filepath):
         """Get stored file info (hash, timestamp)"""
         relpath = os.path.relpath(filepath, self.folder)
         return self.metadata.get(f"{relpath}_info", {})
 
-    def update_file_info(self, filepath, hash_value, timestamp):
+    def update_file_info(self, filepath, hash_value, timestamp, algorithm=None, sha256=None, chunks=None):
         """Update stored file info"""
         relpath = os.path.relpath(filepath, self.folder)
-        self.metadata[f"{relpath}_info"] = {
+        info = {
             "hash": hash_value,
+            "algorithm": algorithm or self.hash_algorithm,
             "timestamp": timestamp
         }
+        # SHA-256 of the uploaded content, for remote verification
+        if sha256:
+            info["sha256"] = sha256
+        # Per-chunk hashes of large files, the base for delta re-uploads
+        if chunks:
+            info["chunks"] = chunks
+        self.metadata[f"{relpath}_info"] = info
+        status = self.get_effective_status(relpath)
+        # Same states restate() gives a file that is on disk
+        state = {"no_sync": "excluded", "object_storage_only": "pending"}.get(status, "synced")
+        try:
+            self.rollups.set(relpath, state, os.path.getsize(filepath))
+        except OSError:
+            pass
+        self.save()
+
+    def get_chunk_info(self, filepath):
+        """Chunk hashes recorded at the last upload of filepath, or None"""
+        return self.get_file_info(filepath).get("chunks")
+
+    def iter_file_infos(self):
+        """Yield (relpath, info) for every file with recorded sync info"""
+        for key, value in self.metadata.items(suffix="_info"):
+            if isinstance(value, dict):
+                yield key[:-len("_info")], value
+
+    def find_content(self, algorithm, digest):
+        """Return (relpath, info) of a synced file with this content hash, or None"""
+        found = self.metadata.find_content(algorithm, digest)
+        if found is None:
+            return None
+        return found[0][:-len("_info")], found[1]
+
+    def remove_file_info(self, relpath):
+        """Forget a file's sync info, e.g. once its remote copy is deleted"""
+        if self.metadata.pop(f"{relpath}_info", None) is not None:
+            self.rollups.remove(relpath)
+            self.save()
+
+    def update_remote_info(self, filepath, etag, size, last_modified):
+        """Record the remote object state a local file was last reconciled with"""
+        relpath = os.path.relpath(filepath, self.folder)
+        info = self.metadata.get(f"{relpath}_info", {})
+        info["etag"] = etag
+        info["remote_size"] = size
+        info["remote_mtime"] = last_modified
+        self.metadata[f"{relpath}_info"] = info
         self.save()
 
     def needs_sync(self, filepath):
@@ -59,31 +275,87 @@ class SyncMetadata:
         if not os.path.exists(filepath):
             return False
         
-        current_hash = self.get_file_hash(filepath)
         stored_info = self.get_file_info(filepath)
         
         if not stored_info:
             return True  # New file, needs sync
         
+        # Entries written before algorithms were recorded are SHA-256
+        algorithm = stored_info.get("algorithm", "sha256")
+        if not is_supported(algorithm):
+            return True
+        current_hash = self.get_file_hash(filepath, algorithm)
         return current_hash != stored_info.get("hash")
 
-    def get_sync_stats(self, folder_path):
-        """Get sync statistics for a folder"""
+    def hash_algorithm_for(self, filepath):
+        """Algorithm that needs_sync will compare filepath with"""
+        stored_info = self.get_file_info(filepath)
+        if stored_info:
+            return stored_info.get("algorithm", "sha256")
+        return self.hash_algorithm
+
+    def get_sync_stats(self, folder_path, max_workers=None, max_open_files=None):
+        """Get sync statistics for a folder
+
+        Files are hashed on a thread pool; the digests land in hash_cache so
+        the upload phase that follows does not hash them a second time.
+        """
         total_files = 0
         needs_sync_count = 0
         synced_count = 0
-        
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                filepath = os.path.join(root, file)
-                total_files += 1
-                if self.needs_sync(filepath):
-                    needs_sync_count += 1
-                else:
-                    synced_count += 1
+
+        def jobs():
+            nonlocal total_files, needs_sync_count
+            for root, dirs, files in os.walk(folder_path):
+                reldir = os.path.relpath(root, self.folder)
+                reldir = "" if reldir == os.curdir else reldir
+                # Prune ignored folders before os.walk descends into them
+                dirs[:] = [d for d in dirs if not self.ignore.is_path_ignored(os.path.join(reldir, d), True)]
+                for file in files:
+                    filepath = os.path.join(root, file)
+                    if self.ignore.is_path_ignored(os.path.relpath(filepath, self.folder)):
+                        continue
+                    total_files += 1
+                    algorithm = self.hash_algorithm_for(filepath)
+                    if is_supported(algorithm):
+                        yield filepath, algorithm
+                    else:
+                        needs_sync_count += 1
+
+        for filepath, algorithm, digest, error in hash_files(jobs(), max_workers, max_open_files):
+            if error is not None:
+                needs_sync_count += 1
+                continue
+            self.cache_hash(filepath, algorithm, digest)
+            stored_info = self.get_file_info(filepath)
+            if not stored_info or digest != stored_info.get("hash"):
+                needs_sync_count += 1
+            else:
+                synced_count += 1
         
         return {
             "total_files": total_files,
             "needs_sync": needs_sync_count,
             "synced": synced_count
-        } 
\ No newline at end of file
+        } 
+
+
+class StatusReader:
+    """Sync statuses of a folder read through a database connection of its own
+
+    For readers on other threads, such as the listing cache's prefetch,
+    which must keep working while the folder's SyncMetadata is closed and
+    reopened (Sync All does that). It sees statuses once they are committed.
+    """
+
+    def __init__(self, folder):
+        self.metadata = MetadataStore(os.path.join(folder, SyncMetadata.SYNC_DB_FILENAME))
+
+    def get_status(self, relpath):
+        return stored_status(self.metadata, relpath)
+
+    def get_effective_status(self, relpath):
+        return effective_status(self.metadata, relpath)
+
+    def close(self):
+        self.metadata.close()
@@ -0,0 +1,260 @@
+import json
+import os
+import time
+from model import tracing
+from model.delete_sync import DEFAULT_MAX_DELETE_FRACTION, DeleteSync
+from model.hashing import hash_files, is_supported
+from model.pull_sync import relpath_to_key
+
+PLAN_VERSION = 2
+# Where the UI keeps the plan of the most recent sync for inspection
+LAST_PLAN_FILENAME = ".wasabi_last_plan.jsonl"
+# Actions that move data and therefore count towards progress
+TRANSFER_ACTIONS = ("upload", "upload_and_remove", "copy")
+
+
+class SyncPlan:
+    """The complete list of actions a sync will perform, computed in one pass
+
+    Each action is a plain dict, appended as one JSON line to the plan file
+    as soon as it is planned, so a plan over millions of files never has to
+    fit in memory. The file can be inspected or diffed before a large run and
+    is streamed back by SyncEngine without walking the tree again. Only the
+    per-action totals are kept in memory.
+    """
+
+    def __init__(self, folder, path, hash_algorithm=None, created=None):
+        self.folder = folder
+        self.path = path
+        self.hash_algorithm = hash_algorithm
+        self.created = created or time.time()
+        self._totals = {}
+        self._writer = None
+
+    @classmethod
+    def create(cls, folder, path, hash_algorithm=None):
+        """Start a new plan file at path; call finish() once every action is added"""
+        plan = cls(folder, path, hash_algorithm)
+        plan._writer = open(path + ".tmp", "w")
+        plan._writer.write(json.dumps(plan.header()) + "\n")
+        return plan
+
+    def header(self):
+        return {
+            "version": PLAN_VERSION,
+            "folder": self.folder,
+            "created": self.created,
+            "hash_algorithm": self.hash_algorithm,
+        }
+
+    def _count(self, entry):
+        bucket = self._totals.setdefault(entry["action"], {"count": 0, "bytes": 0})
+        bucket["count"] += 1
+        bucket["bytes"] += entry.get("size", 0)
+
+    def add(self, action, relpath, size=0, **extra):
+        if self._writer is None:
+            raise Exception("Sync plan is not open for writing.")
+        entry = {"action": action, "relpath": relpath, "key": relpath_to_key(relpath), "size": size}
+        entry.update(extra)
+        self._writer.write(json.dumps(entry) + "\n")
+        self._count(entry)
+        return entry
+
+    def finish(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        os.replace(self.path + ".tmp", self.path)
+
+    def abort(self):
+        """Discard a plan that could not be completed"""
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        os.remove(self.path + ".tmp")
+
+    def iter_actions(self, *names):
+        """Stream actions back from the plan file, optionally only the given kinds"""
+        with open(self.path, "r") as f:
+            f.readline()
+            for line in f:
+                entry = json.loads(line)
+                if not names or entry["action"] in names:
+                    yield entry
+
+    def totals(self):
+        """Return {action: {"count": n, "bytes": n}}"""
+        return {action: dict(t) for action, t in self._totals.items()}
+
+    @property
+    def action_count(self):
+        return sum(t["count"] for t in self._totals.values())
+
+    @property
+    def transfer_count(self):
+        return sum(self._totals.get(action, {}).get("count", 0) for action in TRANSFER_ACTIONS)
+
+    @property
+    def transfer_bytes(self):
+        return sum(self._totals.get(action, {}).get("bytes", 0) for action in TRANSFER_ACTIONS)
+
+    def summary(self):
+        totals = self.totals()
+        lines = []
+        for action in ("upload", "upload_and_remove", "copy", "remove_local", "delete", "skip", "unreadable"):
+            if action in totals:
+                t = totals[action]
+                lines.append(f"{action}: {t['count']} files, {t['bytes'] / (1024 * 1024):.1f} MB")
+        return "\n".join(lines) or "Nothing to do"
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("version") != PLAN_VERSION:
+                raise Exception(f"Unsupported sync plan version: {header.get('version')}")
+            plan = cls(header["folder"], path, header.get("hash_algorithm"), header.get("created"))
+            for line in f:
+                plan._count(json.loads(line))
+        return plan
+
+
+def walk_sync_tree(sync_meta, include_excluded=False):
+    """Yield (path, relpath, status) for every file sync should consider
+
+    Ignored entries are dropped by name before anything else is looked up,
+    and ignored or no_sync folders are never descended into. A folder's
+    object_storage_only status applies to everything below it. With
+    include_excluded, no_sync files and folders are walked too and
+    yielded with status no_sync, for counting.
+    """
+    stack = [(sync_meta.folder, "both", sync_meta.ignore)]
+    while stack:
+        folder, inherited, ignore = stack.pop()
+        try:
+            entries = os.scandir(folder)
+        except OSError:
+            continue
+        # Consumed as the OS returns them, so a huge folder is never listed into memory
+        with entries:
+            for entry in entries:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if ignore.is_ignored(entry.name, is_dir):
+                    continue
+                relpath = os.path.relpath(entry.path, sync_meta.folder)
+                status = sync_meta.get_status(relpath)
+                if status == "no_sync":
+                    if not include_excluded:
+                        continue
+                elif inherited != "both":
+                    status = inherited
+                if is_dir:
+                    stack.append((entry.path, status, ignore.child(entry.name)))
+                elif entry.is_file():
+                    yield entry.path, relpath, status
+
+
+def plan_options(cfg):
+    """build_plan keyword arguments from the "propagate_deletes", "max_delete_fraction" and
+    "max_delete_count" settings
+    """
+    cfg = cfg or {}
+    return {
+        "include_deletes": cfg.get("propagate_deletes", False),
+        "max_delete_fraction": cfg.get("max_delete_fraction", DEFAULT_MAX_DELETE_FRACTION),
+        "max_delete_count": cfg.get("max_delete_count"),
+    }
+
+
+def build_plan(sync_meta, path=None, max_workers=None, include_deletes=False,
+               max_delete_fraction=DEFAULT_MAX_DELETE_FRACTION, max_delete_count=None, force_deletes=False):
+    """Scan the folder once, hashing in parallel, and write a SyncPlan to path
+
+    Scanning, hashing and planning form one generator pipeline with bounded
+    queues, and each action goes straight to the plan file, so memory use
+    does not grow with the size of the tree. Every file's state is
+    recorded in the folder rollups on the way. Files that exist but
+    cannot be read are planned as "unreadable", which the run reports as
+    errors.
+
+    With include_deletes, remote copies of locally deleted files are
+    planned for deletion under the same safety limit as Clean Remote:
+    more than max_delete_fraction (or max_delete_count) of the tracked
+    files raises DeleteThresholdError and no plan is written, unless
+    force_deletes.
+    """
+    path = path or os.path.join(sync_meta.folder, LAST_PLAN_FILENAME)
+    plan = SyncPlan.create(sync_meta.folder, path, hash_algorithm=sync_meta.hash_algorithm)
+    rollups = sync_meta.rollups
+    scan = rollups.begin_scan()
+    # Only holds the files currently queued for hashing
+    statuses = {}
+
+    def jobs():
+        for path, relpath, status in walk_sync_tree(sync_meta, include_excluded=True):
+            if status == "no_sync":
+                # Counted, never hashed
+                try:
+                    rollups.set(relpath, "excluded", os.stat(path).st_size)
+                except OSError:
+                    pass
+                continue
+            statuses[path] = (relpath, status)
+            algorithm = sync_meta.hash_algorithm_for(path)
+            if not is_supported(algorithm):
+                algorithm = sync_meta.hash_algorithm
+            yield path, algorithm
+
+    try:
+        for path, algorithm, digest, error in hash_files(jobs(), max_workers):
+            relpath, status = statuses.pop(path)
+            if error is not None and not isinstance(error, FileNotFoundError):
+                # Permissions, I/O errors: never synced, so never silently skipped either
+                plan.add("unreadable", relpath, error=f"could not read file: {error}")
+                rollups.set(relpath, "pending", 0)
+                continue
+            if digest is None:
+                # Vanished between the scan and the hash
+                continue
+            sync_meta.cache_hash(path, algorithm, digest)
+            try:
+                with tracing.span("stat", "scan", path=path):
+                    st = os.stat(path)
+            except OSError:
+                continue
+            stored_info = sync_meta.get_file_info(path)
+            if stored_info and stored_info.get("hash") == digest:
+                if status == "object_storage_only":
+                    # Already in the bucket; only the local copy has to go
+                    plan.add("remove_local", relpath, st.st_size, sha256=stored_info.get("sha256"))
+                    rollups.set(relpath, "pending", st.st_size)
+                else:
+                    plan.add("skip", relpath, st.st_size)
+                    rollups.set(relpath, "synced", st.st_size)
+                continue
+            rollups.set(relpath, "pending", st.st_size)
+            record = {"hash": digest, "algorithm": algorithm, "mtime_ns": st.st_mtime_ns}
+            # Content already in the bucket turns duplicates/renames into server-side copies
+            source = None if stored_info or status != "both" else sync_meta.find_content(algorithm, digest)
+            if source and source[1].get("sha256"):
+                plan.add("copy", relpath, st.st_size, source_key=relpath_to_key(source[0]),
+                         sha256=source[1]["sha256"], **record)
+            elif status == "object_storage_only":
+                plan.add("upload_and_remove", relpath, st.st_size, **record)
+            else:
+                plan.add("upload", relpath, st.st_size, **record)
+
+        if include_deletes:
+            deleter = DeleteSync(None, sync_meta, max_fraction=max_delete_fraction, max_count=max_delete_count)
+            for relpath in deleter.iter_deleted(force=force_deletes):
+                plan.add("delete", relpath)
+    except BaseException:
+        plan.abort()
+        raise
+    rollups.end_scan(scan)
+    sync_meta.save()
+    plan.finish()
+    return plan
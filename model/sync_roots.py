@@ -0,0 +1,349 @@
+import heapq
+import json
+import os
+import time
+from contextlib import ExitStack
+from model import bandwidth
+from model.concurrency import bounded_imap
+from model.journal import resume_or_build_plan
+from model.sync_engine import DEFAULT_UPLOAD_WORKERS, SyncEngine
+from model.sync_metadata import SyncMetadata
+from model.sync_plan import plan_options
+from model.wasabi_client import WasabiClient
+
+# Bytes a file counts for on top of its size when sharing the pool, for its requests' round trips
+FILE_COST = 64 * 1024
+
+
+class SyncRoot:
+    """A folder synced on its own, with its own metadata, profile and key prefix
+
+    profile names an app_config.json profile (None for the default
+    .wasabi_config.json target). prefix is put in front of every key, so
+    several roots can share one bucket; it defaults to the folder's name,
+    and "" puts keys at the top of the bucket. weight is the root's share
+    of the transfer pool when other roots are busy too.
+    """
+
+    def __init__(self, folder, profile=None, prefix=None, weight=1, enabled=True):
+        self.folder = os.path.abspath(folder)
+        self.profile = profile or None
+        if prefix is None:
+            prefix = os.path.basename(self.folder)
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.weight = max(weight, 0.01)
+        self.enabled = enabled
+
+    @property
+    def name(self):
+        return os.path.basename(self.folder) or self.folder
+
+    def to_dict(self):
+        return {"folder": self.folder, "profile": self.profile, "prefix": self.prefix,
+                "weight": self.weight, "enabled": self.enabled}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["folder"], profile=data.get("profile"), prefix=data.get("prefix"),
+                   weight=data.get("weight", 1), enabled=data.get("enabled", True))
+
+    def create_client(self, base_client, profiles=None):
+        """The client this root syncs through: its profile's, or base_client, prefixed if need be"""
+        client = base_client
+        if self.profile:
+            profiles = profiles if profiles is not None else {
+                profile["name"]: profile for profile in WasabiClient.load_profiles()}
+            if self.profile not in profiles:
+                raise Exception(f"Profile '{self.profile}' not found in {WasabiClient.APP_CONFIG_FILE}.")
+            client = WasabiClient.from_profile(profiles[self.profile], base_client.config)
+            # Parts in flight count against one budget, whichever root they belong to
+            client.memory_budget = base_client.memory_budget
+        if self.prefix:
+            client = PrefixedClient(client, self.prefix)
+        return client
+
+
+class SyncRootRegistry:
+    """The "sync_roots" list in app_config.json; other keys in the file are kept as they are"""
+
+    def __init__(self, path=None):
+        self.path = path or WasabiClient.APP_CONFIG_FILE
+
+    def _load_file(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def list(self):
+        return [SyncRoot.from_dict(data) for data in self._load_file().get("sync_roots", [])]
+
+    def save(self, roots):
+        data = self._load_file()
+        data["sync_roots"] = [root.to_dict() for root in roots]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _target(root, profiles, base_config):
+        """(endpoint, bucket) root syncs to; base_config is the .wasabi_config.json target"""
+        if root.profile is None:
+            cfg = base_config or {}
+            return cfg.get("endpoint"), cfg.get("bucket_name")
+        profile = profiles.get(root.profile)
+        if profile is None:
+            return None, root.profile
+        return profile.get("endpoint_url"), profile.get("bucket_name")
+
+    def add(self, root, base_config=None):
+        """Register root, replacing any root for the same folder
+
+        Raises if root's folder is inside another root or contains one, or
+        if its keys would land among another root's in the same bucket,
+        where each root's sync and deletes would fight over them.
+        """
+        data = self._load_file()
+        profiles = {profile["name"]: profile for profile in data.get("profiles", [])}
+        target = self._target(root, profiles, base_config)
+        roots = [existing for existing in self.list() if existing.folder != root.folder]
+        for existing in roots:
+            if os.path.commonpath([existing.folder, root.folder]) in (existing.folder, root.folder):
+                raise Exception(f"{root.folder} overlaps the sync root {existing.folder}.")
+            if (self._target(existing, profiles, base_config) == target
+                    and (root.prefix.startswith(existing.prefix) or existing.prefix.startswith(root.prefix))):
+                raise Exception(
+                    f"{root.folder} would share keys with the sync root {existing.folder} "
+                    f"(prefixes '{root.prefix}' and '{existing.prefix}' in the same bucket).")
+        roots.append(root)
+        self.save(roots)
+        return root
+
+    def remove(self, folder):
+        folder = os.path.abspath(folder)
+        roots = self.list()
+        kept = [root for root in roots if root.folder != folder]
+        self.save(kept)
+        return len(kept) != len(roots)
+
+
+def folder_client(folder, base_client, sync_meta, registry=None):
+    """The client every action on folder goes through: Sync Now, Pull, Clean Remote and Verify
+
+    That is its sync root's client when folder is registered, else
+    base_client under the prefix folder has synced to. Raises if a root's
+    prefix disagrees with the one folder's metadata records.
+    """
+    folder = os.path.abspath(folder)
+    roots = [root for root in (registry or SyncRootRegistry()).list() if root.folder == folder]
+    if roots:
+        client = roots[0].create_client(base_client)
+    else:
+        prefix = sync_meta.remote_prefix
+        client = PrefixedClient(base_client, prefix) if prefix else base_client
+    sync_meta.check_remote_prefix(client.key_prefix)
+    return client
+
+
+class PrefixedClient:
+    """A client whose keys all live under prefix, for roots sharing a bucket
+
+    The calls sync, pull, cleanup and verification make are translated, so
+    they all see keys relative to prefix; everything else is passed to the
+    wrapped client untouched.
+    """
+
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+        # Push sync sends through the wrapped client's methods, which pick the transport themselves
+        self.transport = None
+
+    @property
+    def key_prefix(self):
+        return self.prefix
+
+    def upload_file(self, filepath, filename, sha256=None):
+        return self.client.upload_file(filepath, self.prefix + filename, sha256)
+
+    def upload_delta(self, filepath, filename, chunks, previous):
+        return self.client.upload_delta(filepath, self.prefix + filename, chunks, previous)
+
+    def copy_object(self, source_key, filename):
+        return self.client.copy_object(self.prefix + source_key, self.prefix + filename)
+
+    def verify_object(self, filename, sha256):
+        return self.client.verify_object(self.prefix + filename, sha256)
+
+    def delete_objects(self, keys):
+        removed, errors = self.client.delete_objects([self.prefix + key for key in keys])
+        return [key[len(self.prefix):] for key in removed], errors
+
+    def head_object(self, filename):
+        return self.client.head_object(self.prefix + filename)
+
+    def download_file(self, filename, filepath, size=None):
+        return self.client.download_file(self.prefix + filename, filepath, size)
+
+    def list_objects(self, prefix=""):
+        for obj in self.client.list_objects(self.prefix + prefix):
+            yield dict(obj, Key=obj["Key"][len(self.prefix):])
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class MultiRootProgress:
+    """SyncProgress summed over every root of a MultiRootSync"""
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.current = None
+        self.started = time.time()
+
+    def _sum(self, name):
+        return sum(getattr(run.engine.progress, name) for run in self.runs)
+
+    @property
+    def total_files(self):
+        return self._sum("total_files")
+
+    @property
+    def total_bytes(self):
+        return self._sum("total_bytes")
+
+    @property
+    def done_files(self):
+        return self._sum("done_files")
+
+    @property
+    def done_bytes(self):
+        return self._sum("done_bytes")
+
+    @property
+    def synced(self):
+        return self._sum("synced")
+
+    @property
+    def fraction(self):
+        total_bytes, total_files = self.total_bytes, self.total_files
+        if total_bytes:
+            return self.done_bytes / total_bytes
+        if total_files:
+            return self.done_files / total_files
+        return 1.0
+
+    @property
+    def eta(self):
+        """Estimated seconds remaining, or None until there is enough data"""
+        elapsed = time.time() - self.started
+        done_bytes = self.done_bytes
+        if not done_bytes or elapsed <= 0:
+            return None
+        return (self.total_bytes - done_bytes) / (done_bytes / elapsed)
+
+
+class RootRun:
+    """One root's part of a MultiRootSync: its client, metadata, plan and engine"""
+
+    def __init__(self, root, client, sync_meta, plan, resumed, engine):
+        self.root = root
+        self.client = client
+        self.sync_meta = sync_meta
+        self.plan = plan
+        self.resumed = resumed
+        self.engine = engine
+        # Bytes handed to the pool so far, over weight; the root furthest behind goes next
+        self.share = 0.0
+
+
+class MultiRootSync:
+    """Syncs several roots at once through one shared pool of upload workers
+
+    Each root is planned with its own metadata and journal, exactly as a
+    single Sync Now would, then the actions of all roots are interleaved
+    into one bounded_imap pool of "upload_workers" threads. The next slot
+    goes to the root with the fewest bytes dispatched for its weight, so
+    a media folder of large files cannot crowd out a folder of small ones,
+    and one root's idle spells are filled by the others. Every transfer in
+    the process shares the caps of the "bandwidth" setting.
+    Results are recorded by each root's own engine on the calling thread.
+    """
+
+    def __init__(self, roots, base_client, workers=None, bandwidth_policy=None):
+        self.roots = [root for root in roots if root.enabled]
+        self.base_client = base_client
+        cfg = base_client.config or {}
+        self.workers = workers or cfg.get("upload_workers", DEFAULT_UPLOAD_WORKERS)
+        self.bandwidth_policy = bandwidth_policy or bandwidth.BandwidthPolicy.from_config(cfg)
+        self.runs = []
+        self.progress = None
+
+    def prepare(self):
+        """Plan every root; a root whose plan cannot be built fails the whole run before anything is sent"""
+        profiles = {profile["name"]: profile for profile in WasabiClient.load_profiles()}
+        try:
+            for root in self.roots:
+                client = root.create_client(self.base_client, profiles)
+                sync_meta = SyncMetadata.from_config(root.folder, client.config)
+                try:
+                    sync_meta.check_remote_prefix(client.key_prefix)
+                    plan, resumed = resume_or_build_plan(sync_meta, **plan_options(client.config))
+                except Exception:
+                    sync_meta.close()
+                    raise
+                engine = SyncEngine.from_config(client, sync_meta, client.config)
+                self.runs.append(RootRun(root, client, sync_meta, plan, resumed, engine))
+        except Exception:
+            self.close()
+            raise
+        return self.runs
+
+    def interleave(self, actions):
+        """Yield (run, entry) from each run's actions, weighted-fair in bytes dispatched"""
+        heap = [(run.share, index) for index, run in enumerate(self.runs)]
+        heapq.heapify(heap)
+        while heap:
+            _, index = heapq.heappop(heap)
+            run = self.runs[index]
+            entry = next(actions[index], None)
+            if entry is None:
+                continue
+            run.share += (entry.get("size", 0) + FILE_COST) / run.root.weight
+            heapq.heappush(heap, (run.share, index))
+            yield run, entry
+
+    def execute(self, progress_callback=None):
+        """Run every root's plan; returns the MultiRootProgress"""
+        if not self.runs:
+            self.prepare()
+        bandwidth.activate(self.bandwidth_policy)
+        try:
+            with ExitStack() as stack:
+                actions = []
+                for run in self.runs:
+                    stack.enter_context(run.sync_meta.batch())
+                    actions.append(run.engine.begin(run.plan))
+                self.progress = MultiRootProgress(self.runs)
+                jobs = self.interleave(actions)
+                for (run, entry), result, error in bounded_imap(
+                        lambda job: job[0].engine.run_action(job[1]), jobs, self.workers,
+                        thread_name_prefix="sync"):
+                    run.engine.complete(entry, result, error)
+                    if entry["action"] != "remove_local":
+                        self.progress.current = f"{run.root.name}: {entry['relpath']}"
+                        if progress_callback:
+                            progress_callback(self.progress)
+                for run in self.runs:
+                    run.engine.run_deletes(run.plan)
+            for run in self.runs:
+                run.engine.retire()
+        finally:
+            self.close()
+        return self.progress
+
+    def close(self):
+        for run in self.runs:
+            run.engine.close()
+            run.sync_meta.close()
@@ -0,0 +1,180 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+# Written to the synced folder when "trace" is true; a path string puts it elsewhere
+TRACE_FILENAME = ".wasabi_sync_trace.json"
+
+# The active Tracer, or None; every hook checks this first so disabled tracing costs one lookup
+_tracer = None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.args["error"] = str(exc)
+        self.tracer.complete(self.name, self.cat, self.start, self.tracer.now(), self.args)
+        return False
+
+
+class Tracer:
+    """Writes spans to a Chrome trace file (chrome://tracing, ui.perfetto.dev)
+
+    Events are streamed to disk in the JSON array format as they finish, so
+    a trace of millions of files never sits in memory, and a run that
+    dies midway still leaves a file the viewers can open. Each span carries
+    the thread it ran on, and threads are labelled with their pool names.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        # Thread ids are numbered per trace; OS idents are reused once a thread exits
+        self._local = threading.local()
+        self._tids = itertools.count(1)
+        self._ids = itertools.count(1)
+        self._file = open(path, "w")
+        self._file.write("[\n")
+        self._write({"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": "Wasabi sync"}})
+
+    def now(self):
+        """Microseconds since the trace started"""
+        return (time.perf_counter() - self.started) * 1000000
+
+    def _write(self, event):
+        self._file.write(json.dumps(event) + ",\n")
+
+    def _emit(self, *events):
+        tid = getattr(self._local, "tid", None)
+        with self._lock:
+            if self._file is None:
+                return
+            if tid is None:
+                tid = self._local.tid = next(self._tids)
+                self._write({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                             "args": {"name": threading.current_thread().name}})
+            for event in events:
+                event["pid"] = self.pid
+                event["tid"] = tid
+                self._write(event)
+
+    def complete(self, name, cat, start, end, args=None):
+        """Record a span that ran on the current thread from start to end"""
+        self._emit({"name": name, "cat": cat, "ph": "X", "ts": start, "dur": end - start, "args": args or {}})
+
+    def interval(self, name, cat, start, end, args=None):
+        """Record a span that is not bound to a thread, such as time spent waiting in a queue
+
+        Written as an async begin/end pair, which viewers draw on its own track.
+        """
+        span_id = next(self._ids)
+        self._emit(
+            {"name": name, "cat": cat, "ph": "b", "id": span_id, "ts": start, "args": args or {}},
+            {"name": name, "cat": cat, "ph": "e", "id": span_id, "ts": end},
+        )
+
+    def dequeued(self, fn, item, queued_at, queue):
+        """Run fn(item) on a pool worker, first recording how long it waited for one"""
+        self.interval("queued", queue, queued_at, self.now())
+        return fn(item)
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps({"name": "trace_end", "ph": "i", "s": "g", "pid": self.pid, "tid": 0,
+                                         "ts": self.now()}) + "\n]\n")
+            self._file.close()
+            self._file = None
+
+
+def active():
+    return _tracer
+
+
+def span(name, cat="sync", **args):
+    """Context manager timing a block on the current thread; a no-op unless tracing is on"""
+    tracer = _tracer
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, cat, args)
+
+
+def start(path):
+    global _tracer
+    stop()
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def stop():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+
+
+def trace_path(cfg, folder):
+    """Where the "trace" setting sends the trace of a sync of folder, or None if tracing is off"""
+    setting = (cfg or {}).get("trace")
+    if not setting:
+        return None
+    if isinstance(setting, str):
+        return setting
+    return os.path.join(folder, TRACE_FILENAME)
+
+
+def _before_call(model, params, context, **kwargs):
+    if _tracer is not None:
+        context["trace_call"] = (_tracer.now(), model.name, params.get("url_path"))
+
+
+def _after_call(context, http_response=None, exception=None, **kwargs):
+    tracer = _tracer
+    call = context.pop("trace_call", None)
+    if tracer is None or call is None:
+        return
+    began, operation, url_path = call
+    args = {"path": url_path}
+    if http_response is not None:
+        args["status"] = http_response.status_code
+    if exception is not None:
+        args["error"] = str(exception)
+    tracer.complete(operation, "s3", began, tracer.now(), args)
+
+
+def instrument_client(s3):
+    """Hook a boto3 S3 client so every API call it makes is traced while tracing is on
+
+    Calls made by managed transfers from their own thread pools show up
+    on those threads.
+    """
+    events = s3.meta.events
+    events.register("before-call.s3", _before_call)
+    events.register("after-call.s3", _after_call)
+    events.register("after-call-error.s3", _after_call)
@@ -0,0 +1,117 @@
+import json
+import os
+import time
+from model.concurrency import bounded_imap
+from model.pull_sync import relpath_to_key
+
+REPORT_FILENAME = ".wasabi_verify.jsonl"
+# Results that count as healthy in the summary
+OK_RESULTS = ("ok", "present")
+
+
+class RemoteVerifier:
+    """Verify that tracked files exist intact in the bucket without downloading them
+
+    One listing pass establishes which keys exist (1000 keys
+    per request); objects that are present are then checked with concurrent
+    HeadObject calls against the SHA-256 (for encrypted objects, its MAC)
+    stored in their metadata at upload time. Each result is appended to a JSONL report as soon as it is known,
+    so an interrupted audit resumes where it stopped.
+    """
+
+    def __init__(self, client, sync_meta, max_workers=32, report_path=None):
+        self.client = client
+        self.sync_meta = sync_meta
+        self.max_workers = max_workers
+        self.report_path = report_path or os.path.join(sync_meta.folder, REPORT_FILENAME)
+
+    def load_report(self):
+        """Return {key: result} for everything already in the report"""
+        done = {}
+        if not os.path.exists(self.report_path):
+            return done
+        with open(self.report_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line from an interrupted run; it will be redone
+                    continue
+                done[entry["key"]] = entry["result"]
+        return done
+
+    def expected_sha256(self, info):
+        if info.get("sha256"):
+            return info["sha256"]
+        if info.get("algorithm", "sha256") == "sha256":
+            return info.get("hash")
+        return None
+
+    def targets(self, prefix=""):
+        """Yield (key, expected_sha256) for every tracked file that should be remote"""
+        for relpath, info in self.sync_meta.iter_file_infos():
+            if self.sync_meta.get_effective_status(relpath) == "no_sync":
+                continue
+            key = relpath_to_key(relpath)
+            if key.startswith(prefix):
+                yield key, self.expected_sha256(info)
+
+    def check(self, target):
+        key, expected = target
+        if not expected:
+            return "present"
+        head = self.client.head_object(key)
+        if head is None:
+            return "missing"
+        result = self.client.check_metadata(head.get("Metadata", {}), expected)
+        if result == "unverified":
+            # Uploaded before hashes were stored in object metadata
+            return "present"
+        return result
+
+    def run(self, prefix="", resume=True, progress_callback=None):
+        """Verify every tracked file under prefix; returns {result: count}"""
+        self.sync_meta.check_remote_prefix(self.client.key_prefix)
+        done = {}
+        if resume:
+            # Errors were transient failures to check, not results; retry them
+            done = {key: result for key, result in self.load_report().items() if result != "error"}
+        summary = {}
+        for result in done.values():
+            summary[result] = summary.get(result, 0) + 1
+
+        remote_keys = {obj["Key"] for obj in self.client.list_objects(prefix)}
+        mode = "a" if resume else "w"
+        with open(self.report_path, mode) as report:
+
+            def record(key, result, detail=None):
+                entry = {"key": key, "result": result, "checked": time.time()}
+                if detail:
+                    entry["detail"] = detail
+                report.write(json.dumps(entry) + "\n")
+                report.flush()
+                summary[result] = summary.get(result, 0) + 1
+                if progress_callback:
+                    progress_callback(key, result, summary)
+
+            def pending():
+                for key, expected in self.targets(prefix):
+                    if key in done:
+                        continue
+                    if key not in remote_keys:
+                        record(key, "missing")
+                        continue
+                    yield key, expected
+
+            for (key, expected), result, error in bounded_imap(
+                self.check, pending(), self.max_workers, thread_name_prefix="verify"
+            ):
+                if error:
+                    record(key, "error", str(error))
+                else:
+                    record(key, result)
+        return summary
+
+    def problems(self):
+        """Return [(key, result)] for every unhealthy entry in the report"""
+        return [(key, result) for key, result in self.load_report().items() if result not in OK_RESULTS]
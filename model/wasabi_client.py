@@ -1,13 +1,117 @@
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import json
+import math
+import mimetypes
 import os
+from model import tracing
+from model.async_transport import AsyncTransport
+from model.bandwidth import DOWNLOADS, UPLOADS
+from model.compression import (
+    CHUNK_SIZE,
+    CODEC_METADATA_KEY,
+    CompressingReader,
+    CompressionPolicy,
+    decompress_stream,
+)
+from model.concurrency import bounded_imap
+from model.delta_upload import DEFAULT_CHUNK_SIZE, MAX_PARTS, DeltaUnavailable, plan_parts
+from model.encryption import (
+    CHUNK_OVERHEAD,
+    CONTENT_MAC_METADATA_KEY,
+    ENCRYPTION_METADATA_KEY,
+    KEY_ID_METADATA_KEY,
+    OBJECT_ID_METADATA_KEY,
+    ChunkCipher,
+    EncryptingReader,
+    chunk_range,
+    encrypted_size,
+)
+from model.hashing import hash_file
+from model.ignore import PARTIAL_SUFFIX
+from model.part_reader import DEFAULT_MEMORY_BUDGET, MemoryBudget, PacedBytes, PartWindow
+
+# Object metadata key holding the SHA-256 of the original (uncompressed) file; encrypted objects hold a MAC of it
+SHA256_METADATA_KEY = "wasabi-sha256"
+# Uncompressed files at least this large are sent as multipart uploads from mmap windows
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_PART_CONCURRENCY = 8
+# S3 rejects smaller parts (except the last)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def _paced(chunks, limiter):
+    for chunk in chunks:
+        limiter.consume(len(chunk))
+        yield chunk
+
+
+def _compare_sha256(remote_sha256, sha256):
+    if not remote_sha256:
+        return "unverified"
+    return "ok" if remote_sha256 == sha256 else "mismatch"
+
 
 class WasabiClient:
     CONFIG_FILE = ".wasabi_config.json"
+    APP_CONFIG_FILE = "app_config.json"
+    SERVICE_NAME = "WasabiFileManager"
+    # DeleteObjects accepts at most this many keys per request
+    DELETE_BATCH_SIZE = 1000
+    # Put in front of sync keys by a PrefixedClient; a plain client keys files from the bucket top
+    key_prefix = ""
 
-    def __init__(self):
-        self.config = self.load_config()
+    def __init__(self, config=None):
+        self.config = config if config is not None else self.load_config()
+        self.name = (self.config or {}).get("name", "default")
         self.s3 = self.create_client() if self.config else None
+        self.compression = CompressionPolicy.from_config((self.config or {}).get("compression"))
+        # Event-loop transport for small objects when "transport" is "async"; None means boto3 only
+        self.transport = AsyncTransport.from_config(self.config)
+        cfg = self.config or {}
+        self.multipart_threshold = cfg.get("multipart_threshold", DEFAULT_MULTIPART_THRESHOLD)
+        self.part_size = max(MIN_PART_SIZE, cfg.get("part_size", DEFAULT_CHUNK_SIZE))
+        self.part_concurrency = cfg.get("part_concurrency", DEFAULT_PART_CONCURRENCY)
+        # Shared by every multipart upload of this client, whatever the worker counts
+        self.memory_budget = MemoryBudget(cfg.get("memory_budget", DEFAULT_MEMORY_BUDGET))
+        # Client-side encryption when "encryption" is enabled; None stores objects as they are
+        self.encryption = ChunkCipher.from_config(cfg.get("encryption"))
+
+    @classmethod
+    def load_profiles(cls):
+        """Return the profiles list from app_config.json"""
+        if not os.path.exists(cls.APP_CONFIG_FILE):
+            return []
+        with open(cls.APP_CONFIG_FILE, "r") as f:
+            return json.load(f).get("profiles", [])
+
+    @classmethod
+    def from_profile(cls, profile, base_config=None):
+        """Build a client for an app_config.json profile, with credentials from the keyring
+
+        Settings other than the target (compression, pool sizes, ...) are
+        taken from base_config so every profile behaves the same way.
+        """
+        import keyring
+
+        name = profile["name"]
+        access_key = keyring.get_password(cls.SERVICE_NAME, f"{name}_access")
+        secret_key = keyring.get_password(cls.SERVICE_NAME, f"{name}_secret")
+        if not access_key or not secret_key:
+            raise Exception(f"No credentials found in keyring for profile '{name}'.")
+        config = dict(base_config or {})
+        config.update({
+            "name": name,
+            "access_key": access_key,
+            "secret_key": secret_key,
+            "bucket_name": profile["bucket_name"],
+            "region": profile.get("region", "us-east-1"),
+            "endpoint": profile["endpoint_url"],
+            "ssl_verify": profile.get("ssl_verify", True),
+            "ca_file": profile.get("ca_file", ""),
+        })
+        return cls(config)
 
     def load_config(self):
         if os.path.exists(self.CONFIG_FILE):
@@ -17,15 +121,386 @@ class WasabiClient:
 
     def create_client(self):
         cfg = self.config
-        return boto3.client(
+        s3 = boto3.client(
             's3',
             aws_access_key_id=cfg["access_key"],
             aws_secret_access_key=cfg["secret_key"],
             region_name=cfg["region"],
-            endpoint_url=cfg["endpoint"]
+            endpoint_url=cfg["endpoint"],
+            verify=cfg.get("ca_file") or cfg.get("ssl_verify", True),
+            # Sized for the parallel transfer pools; botocore defaults to 10
+            config=Config(max_pool_connections=cfg.get("max_pool_connections", 32))
         )
+        tracing.instrument_client(s3)
+        return s3
+
+    def close(self):
+        """Shut the async transport's session and event loop down; a later request reopens them"""
+        if self.transport is not None:
+            self.transport.close()
+
+    def upload_file(self, filepath, filename, sha256=None):
+        """Upload a file, storing its SHA-256 in the object metadata; returns the SHA-256"""
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        sha256 = sha256 or hash_file(filepath, "sha256")
+        if self.uses_transport(filepath):
+            self.transport.run(self.upload_file_async(filepath, filename, sha256))
+            return sha256
+        if self.uses_parts(filepath):
+            self.upload_parts(filepath, filename, sha256)
+            return sha256
+        codec = self.compression.choose_codec(filepath)
+        if not codec and not self.encryption:
+            extra_args = {"Metadata": {SHA256_METADATA_KEY: sha256}}
+            self.s3.upload_file(filepath, self.config["bucket_name"], filename, ExtraArgs=extra_args,
+                                Callback=UPLOADS.consume)
+            return sha256
+        with open(filepath, "rb") as f:
+            self.upload_stream(f, filepath, filename, sha256)
+        return sha256
+
+    def uses_parts(self, filepath, size=None):
+        """Whether filepath is sent with upload_parts: it is large and stays uncompressed"""
+        if size is None:
+            size = os.path.getsize(filepath)
+        return size >= self.multipart_threshold and not self.compression.choose_codec(filepath)
+
+    def uses_transport(self, filepath, size=None):
+        """Whether filepath is sent through the async transport: it is on, the file is small and stays uncompressed"""
+        if self.transport is None or self.encryption:
+            return False
+        if size is None:
+            size = os.path.getsize(filepath)
+        return size <= self.transport.max_object_size and not self.compression.choose_codec(filepath)
+
+    async def upload_file_async(self, filepath, filename, sha256):
+        """Coroutine form of upload_file for files uses_transport() accepts"""
+        await self.transport.upload_file(filepath, filename, {SHA256_METADATA_KEY: sha256})
+        return sha256
+
+    def upload_stream(self, fileobj, filepath, filename, sha256, callback=None):
+        """Upload the contents of fileobj (the data of filepath) as filename
+
+        filepath is only used to pick the codec and content type; the data
+        itself is read from fileobj, which need not be seekable. With
+        encryption on, the (possibly compressed) stream is sealed chunk by
+        chunk on the cipher's thread pool as it is sent.
+        """
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        extra_args = {"Metadata": self.new_object_metadata(sha256)}
+        codec = self.compression.choose_codec(filepath)
+        if codec:
+            extra_args["Metadata"][CODEC_METADATA_KEY] = codec
+            content_type = mimetypes.guess_type(filepath)[0]
+            if content_type:
+                extra_args["ContentType"] = content_type
+            fileobj = CompressingReader(fileobj, codec, self.compression.level)
+        if self.encryption:
+            object_id = bytes.fromhex(extra_args["Metadata"][OBJECT_ID_METADATA_KEY])
+            fileobj = EncryptingReader(fileobj, self.encryption, object_id)
+
+        def sent(nbytes):
+            UPLOADS.consume(nbytes)
+            if callback:
+                callback(nbytes)
+
+        self.s3.upload_fileobj(
+            fileobj, self.config["bucket_name"], filename, ExtraArgs=extra_args, Callback=sent
+        )
+
+    def new_object_metadata(self, sha256):
+        """Metadata for a new object of content sha256: the SHA-256 itself, or the cipher's metadata with a MAC of it"""
+        if self.encryption:
+            return self.encryption.new_object(sha256)
+        return {SHA256_METADATA_KEY: sha256}
+
+    def check_metadata(self, metadata, sha256):
+        """Whether object metadata records content sha256: 'ok', 'mismatch' or 'unverified' if it records none"""
+        if self.encryption and metadata.get(ENCRYPTION_METADATA_KEY):
+            return self.encryption.check_content(metadata, sha256)
+        return _compare_sha256(metadata.get(SHA256_METADATA_KEY), sha256)
+
+    def _multipart_upload(self, filename, metadata, parts, send_part, max_workers):
+        """Create a multipart upload, send parts with send_part(upload_id, part) -> ETag, and complete it
+
+        parts are tuples starting with the part number. Parts are sent
+        max_workers at a time and the upload is aborted if any fails.
+        """
+        bucket = self.config["bucket_name"]
+        upload = self.s3.create_multipart_upload(Bucket=bucket, Key=filename, Metadata=metadata)
+        upload_id = upload["UploadId"]
+        etags = {}
+        try:
+            for part, etag, error in bounded_imap(lambda part: send_part(upload_id, part), parts, max_workers,
+                                                  max_queued=max_workers, thread_name_prefix="part"):
+                if error is not None:
+                    raise error
+                etags[part[0]] = etag
+            self.s3.complete_multipart_upload(
+                Bucket=bucket, Key=filename, UploadId=upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": n, "ETag": etags[n]} for n in sorted(etags)]},
+            )
+        except BaseException:
+            self.s3.abort_multipart_upload(Bucket=bucket, Key=filename, UploadId=upload_id)
+            raise
+
+    def _upload_window(self, filepath, filename, upload_id, number, offset, length, seal=None):
+        """Send one part straight from an mmap window, within the memory budget
+
+        seal(offset, window) -> bytes, if given, encrypts the window on this
+        part's worker thread; the sealed copy counts against the budget too.
+        """
+        reserved = length + (encrypted_size(length, self.encryption.chunk_size) if seal else 0)
+        with self.memory_budget.reserve(reserved):
+            if seal:
+                with PartWindow(filepath, offset, length) as window:
+                    body = PacedBytes(seal(offset, window.read()), on_read=UPLOADS.consume)
+            else:
+                body = PartWindow(filepath, offset, length, on_read=UPLOADS.consume)
+            with body:
+                resp = self.s3.upload_part(
+                    Bucket=self.config["bucket_name"], Key=filename, UploadId=upload_id, PartNumber=number, Body=body,
+                )
+        return resp["ETag"]
+
+    def upload_parts(self, filepath, filename, sha256, max_workers=None):
+        """Multipart upload of a large uncompressed file, sending each part from a mapped window
+
+        Parts are never copied into Python buffers, and no more than the
+        client's memory budget is mapped at once across all its uploads, so
+        part_concurrency can go high without memory growing with it. With
+        encryption on, parts are whole numbers of encryption chunks and are
+        sealed in parallel by the part workers.
+        """
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        size = os.path.getsize(filepath)
+        part_size = max(self.part_size, math.ceil(size / MAX_PARTS))
+        metadata = self.new_object_metadata(sha256)
+        if self.encryption:
+            chunk_size = self.encryption.chunk_size
+            part_size = math.ceil(part_size / chunk_size) * chunk_size
+            object_id = bytes.fromhex(metadata[OBJECT_ID_METADATA_KEY])
+            last_index = max(0, math.ceil(size / chunk_size) - 1)
+
+            def seal(offset, window):
+                return self.encryption.seal_range(object_id, window, offset // chunk_size, last_index)
+        else:
+            seal = None
+
+        parts = [(n + 1, offset, min(part_size, size - offset)) for n, offset in enumerate(range(0, size, part_size))]
+
+        def send(upload_id, part):
+            number, offset, length = part
+            return self._upload_window(filepath, filename, upload_id, number, offset, length, seal)
+
+        self._multipart_upload(filename, metadata, parts, send, max_workers or self.part_concurrency)
+
+    def upload_delta(self, filepath, filename, chunks, previous, max_workers=None):
+        """Re-upload a large file as a multipart upload that copies unchanged chunks
+
+        chunks describes the file now and previous the object currently
+        stored under filename (both from hash_chunks). Unchanged chunks
+        become UploadPartCopy calls against the existing object; only the
+        changed ones are sent. Raises DeltaUnavailable if the stored object
+        is not the one previous describes. Returns {"copied_bytes", "uploaded_bytes"}.
+        """
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        if self.compression.choose_codec(filepath):
+            # Compressed objects do not keep the file's byte offsets
+            raise DeltaUnavailable("file would be uploaded compressed")
+        if self.encryption:
+            # Sealed chunks are tied to their object, so they cannot be copied into a new one
+            raise DeltaUnavailable("objects are encrypted")
+        head = self.head_object(filename)
+        if (
+            head is None
+            or head.get("Metadata", {}).get(CODEC_METADATA_KEY)
+            or head.get("Metadata", {}).get(SHA256_METADATA_KEY) != previous["sha256"]
+            or head["ContentLength"] != previous["file_size"]
+        ):
+            raise DeltaUnavailable("remote object is not the previously uploaded version")
+        parts = list(plan_parts(chunks, previous))
+        if not any(copy for _, _, _, copy in parts):
+            raise DeltaUnavailable("no chunks can be reused")
+
+        bucket = self.config["bucket_name"]
+
+        def send(upload_id, part):
+            number, offset, length, copy = part
+            if not copy:
+                return self._upload_window(filepath, filename, upload_id, number, offset, length)
+            resp = self.s3.upload_part_copy(
+                Bucket=bucket, Key=filename, UploadId=upload_id, PartNumber=number,
+                CopySource={"Bucket": bucket, "Key": filename},
+                CopySourceRange=f"bytes={offset}-{offset + length - 1}",
+                # Fail rather than stitch in parts of an object replaced meanwhile
+                CopySourceIfMatch=head["ETag"],
+            )
+            return resp["CopyPartResult"]["ETag"]
+
+        self._multipart_upload(filename, self.new_object_metadata(chunks["sha256"]), parts, send,
+                               max_workers or self.part_concurrency)
+        stats = {"copied_bytes": 0, "uploaded_bytes": 0}
+        for _, _, length, copy in parts:
+            stats["copied_bytes" if copy else "uploaded_bytes"] += length
+        return stats
+
+    def copy_object(self, source_key, filename):
+        """Server-side copy within the bucket; object metadata is carried over"""
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        bucket = self.config["bucket_name"]
+        # The managed copy switches to multipart UploadPartCopy for large objects
+        self.s3.copy({"Bucket": bucket, "Key": source_key}, bucket, filename)
+
+    def head_object(self, filename):
+        """Return the HeadObject response for a key, or None if it does not exist"""
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        try:
+            return self.s3.head_object(Bucket=self.config["bucket_name"], Key=filename)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def verify_object(self, filename, sha256):
+        """Check the remote object's recorded SHA-256; returns 'ok', 'missing', 'mismatch' or 'unverified'"""
+        head = self.head_object(filename)
+        if head is None:
+            return "missing"
+        return self.check_metadata(head.get("Metadata", {}), sha256)
+
+    async def verify_object_async(self, filename, sha256):
+        """verify_object through the async transport"""
+        headers = await self.transport.head_object(filename)
+        if headers is None:
+            return "missing"
+        names = (SHA256_METADATA_KEY, ENCRYPTION_METADATA_KEY, KEY_ID_METADATA_KEY, CONTENT_MAC_METADATA_KEY)
+        return self.check_metadata({name: headers.get(f"x-amz-meta-{name}") for name in names}, sha256)
+
+    def download_file(self, filename, filepath, size=None):
+        """Download an object, transparently decompressing it if needed
+
+        size is the stored size when known, e.g. from a listing; only
+        objects up to the async transport's max_object_size go through it.
+        """
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        if self.transport is not None and not self.encryption:
+            if size is None:
+                head = self.head_object(filename)
+                size = head["ContentLength"] if head else None
+            if size is not None and size <= self.transport.max_object_size:
+                self.transport.run(self.transport.download_file(filename, filepath))
+                return
+        resp = self.s3.get_object(Bucket=self.config["bucket_name"], Key=filename)
+        metadata = resp.get("Metadata", {})
+        codec = metadata.get(CODEC_METADATA_KEY)
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        tmp_path = filepath + PARTIAL_SUFFIX
+        try:
+            with open(tmp_path, "wb") as out:
+                chunks = _paced(resp["Body"].iter_chunks(CHUNK_SIZE), DOWNLOADS)
+                if metadata.get(ENCRYPTION_METADATA_KEY):
+                    object_id, chunk_size = self._cipher_for(metadata)
+                    chunks = self.encryption.open_stream(object_id, chunk_size, chunks)
+                if codec:
+                    decompress_stream(chunks, out, codec)
+                else:
+                    for chunk in chunks:
+                        out.write(chunk)
+            os.replace(tmp_path, filepath)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _cipher_for(self, metadata):
+        if not self.encryption:
+            raise Exception("Object is encrypted, but encryption is not enabled in the configuration.")
+        return self.encryption.check(metadata)
+
+    def read_range(self, filename, start, length):
+        """length bytes of an object's original content from start, fetched with a ranged GET
+
+        For encrypted objects only the sealed chunks covering the range are
+        fetched and opened. Compressed objects cannot be read by range.
+        """
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        if length <= 0:
+            return b""
+        bucket = self.config["bucket_name"]
+        head = self.head_object(filename)
+        if head is None:
+            raise Exception(f"{filename} not found")
+        metadata = head.get("Metadata", {})
+        if metadata.get(CODEC_METADATA_KEY):
+            raise Exception(f"{filename} is stored compressed and cannot be read by range")
+        if not metadata.get(ENCRYPTION_METADATA_KEY):
+            resp = self.s3.get_object(Bucket=bucket, Key=filename, Range=f"bytes={start}-{start + length - 1}",
+                                      IfMatch=head["ETag"])
+            return resp["Body"].read()
+        object_id, chunk_size = self._cipher_for(metadata)
+        first, range_start, range_end = chunk_range(start, length, chunk_size)
+        last_index = max(0, math.ceil(head["ContentLength"] / (chunk_size + CHUNK_OVERHEAD)) - 1)
+        resp = self.s3.get_object(Bucket=bucket, Key=filename, Range=f"bytes={range_start}-{range_end}",
+                                  IfMatch=head["ETag"])
+        chunks = self.encryption.open_stream(object_id, chunk_size, resp["Body"].iter_chunks(CHUNK_SIZE), first,
+                                             last_index)
+        data = b"".join(chunks)
+        skip = start - first * chunk_size
+        return data[skip:skip + length]
+
+    def list_objects(self, prefix=""):
+        """Yield every object under prefix as dicts with Key, Size, ETag, LastModified"""
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.config["bucket_name"], Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj
+
+    def list_page(self, prefix="", delimiter="/", continuation_token=None, max_keys=1000):
+        """List one page directly under prefix
+
+        Returns a dict with "prefixes" (child folder prefixes), "objects" and
+        "next_token" (None on the last page).
+        """
+        if not self.s3:
+            raise Exception("Wasabi config not loaded.")
+        params = {
+            "Bucket": self.config["bucket_name"],
+            "Prefix": prefix,
+            "Delimiter": delimiter,
+            "MaxKeys": max_keys,
+        }
+        if continuation_token:
+            params["ContinuationToken"] = continuation_token
+        resp = self.s3.list_objects_v2(**params)
+        return {
+            "prefixes": [p["Prefix"] for p in resp.get("CommonPrefixes", [])],
+            "objects": resp.get("Contents", []),
+            "next_token": resp.get("NextContinuationToken") if resp.get("IsTruncated") else None,
+        }
 
-    def upload_file(self, filepath, filename):
+    def delete_objects(self, keys):
+        """Delete keys in DeleteObjects batches; returns (deleted_keys, errors)"""
         if not self.s3:
             raise Exception("Wasabi config not loaded.")
-        self.s3.upload_file(filepath, self.config["bucket_name"], filename) 
\ No newline at end of file
+        deleted = []
+        errors = []
+        for i in range(0, len(keys), self.DELETE_BATCH_SIZE):
+            batch = keys[i:i + self.DELETE_BATCH_SIZE]
+            resp = self.s3.delete_objects(
+                Bucket=self.config["bucket_name"],
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+            failed = {err["Key"] for err in resp.get("Errors", [])}
+            errors.extend(f"{err['Key']}: {err.get('Message', err.get('Code'))}" for err in resp.get("Errors", []))
+            deleted.extend(key for key in batch if key not in failed)
+        return deleted, errors
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Search bucket keys through the local key index
+
+Usage:
+    python search_bucket.py --refresh            # (re)build the index from a bucket listing
+    python search_bucket.py report_2024          # substring search
+    python search_bucket.py "logs/*/app-*.log"   # glob search
+"""
+
+import argparse
+import datetime
+import sys
+
+from model.key_index import INDEX_FILE, KeyIndex
+from model.wasabi_client import WasabiClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search bucket keys through the local key index")
+    parser.add_argument("query", nargs="?", help="substring, or glob pattern if it contains * ? [")
+    parser.add_argument("--refresh", action="store_true", help="re-list the bucket into the index first")
+    parser.add_argument("--prefix", default="", help="only refresh keys under this prefix")
+    parser.add_argument("--limit", type=int, default=200, help="maximum number of results")
+    parser.add_argument("--index", default=INDEX_FILE, help="index database path")
+    args = parser.parse_args()
+
+    client = WasabiClient()
+    if not client.s3:
+        print("Wasabi config not loaded.")
+        return 1
+    bucket = client.config["bucket_name"]
+    index = KeyIndex(args.index)
+
+    if args.refresh or index.last_refreshed(bucket) is None:
+        print(f"Indexing bucket '{bucket}'...")
+        seen = index.refresh(client, args.prefix, lambda n: print(f"  {n} keys", end="\r"))
+        print(f"✓ Indexed {seen} keys")
+
+    if args.query:
+        for obj in index.query(bucket, args.query, args.limit):
+            modified = datetime.datetime.fromtimestamp(obj["LastModified"] or 0).strftime("%Y-%m-%d %H:%M")
+            print(f"{modified}  {obj['Size'] or 0:>14}  {obj['Key']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Change the bandwidth caps of a running File Manager, or show the ones in force
+
+Writes .wasabi_bandwidth.json in the current folder (where .wasabi_config.json
+lives); a running sync picks it up within a few seconds.
+
+    python set_bandwidth.py --upload 2 --download 10   # MB/s
+    python set_bandwidth.py --upload none               # no upload limit
+    python set_bandwidth.py --clear                     # back to the configured schedule
+    python set_bandwidth.py                             # show the current caps
+"""
+
+import argparse
+import sys
+
+from model import bandwidth
+from model.wasabi_client import WasabiClient
+
+MB = 1024 * 1024
+
+
+def parse_rate(text):
+    """MB/s, or 'none' for no limit"""
+    if text.lower() in ("none", "off", "0"):
+        return None
+    return int(float(text) * MB)
+
+
+def describe(rate):
+    return f"{rate / MB:g} MB/s" if rate else "unlimited"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Set live upload/download caps for the File Manager")
+    # Left unset unless given, so "--upload none" can be told apart from no --upload at all
+    parser.add_argument("--upload", type=parse_rate, default=argparse.SUPPRESS, help="upload cap in MB/s, or 'none'")
+    parser.add_argument("--download", type=parse_rate, default=argparse.SUPPRESS,
+                        help="download cap in MB/s, or 'none'")
+    parser.add_argument("--clear", action="store_true", help="remove overrides and follow the configuration")
+    args = parser.parse_args()
+
+    if args.clear:
+        bandwidth.clear_override()
+    limits = {name: getattr(args, name) for name in ("upload", "download") if hasattr(args, name)}
+    if limits:
+        bandwidth.set_override(**limits)
+
+    policy = bandwidth.BandwidthPolicy.from_config(WasabiClient().config)
+    upload, download = policy.limits()
+    override = bandwidth.read_override()
+    source = "override" if override else "configuration"
+    print(f"Upload: {describe(upload)}, download: {describe(download)} (from {source})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
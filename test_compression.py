@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Tests for upload compression: codec choice and gzip/zstd round trips
+
+    python -m pytest -q test_compression.py
+"""
+
+import io
+import os
+import random
+
+import pytest
+
+from local_s3_server import DEFAULT_BUCKET, LocalS3Server
+from model.compression import (
+    CODEC_METADATA_KEY, CompressingReader, CompressionPolicy, available_codecs, decompress_stream, zstandard,
+)
+from test_sync_scenarios import make_client
+
+CODECS = ["gzip", pytest.param("zstd", marks=pytest.mark.skipif(zstandard is None, reason="zstandard not installed"))]
+
+
+def text(size, seed=0):
+    rng = random.Random(seed)
+    words = [b"alpha", b"beta", b"gamma", b"delta", b"\n", b"2024-01-01T00:00:00Z", b"ERROR", b"INFO"]
+    out = bytearray()
+    while len(out) < size:
+        out += rng.choice(words) + b" "
+    return bytes(out[:size])
+
+
+def write(folder, name, data):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def round_trip(data, codec, read_size=-1, chunk_size=64 * 1024):
+    reader = CompressingReader(io.BytesIO(data), codec, chunk_size=chunk_size)
+    compressed = bytearray()
+    while True:
+        piece = reader.read(read_size)
+        if not piece:
+            break
+        compressed += piece
+    out = io.BytesIO()
+    # Feed the decompressor odd-sized pieces, as a network body would arrive
+    pieces = [bytes(compressed[i:i + 777]) for i in range(0, len(compressed), 777)]
+    decompress_stream(pieces, out, codec)
+    return bytes(compressed), out.getvalue()
+
+
+def reader_counts(data, codec):
+    reader = CompressingReader(io.BytesIO(data), codec, chunk_size=4096)
+    while reader.read(1000):
+        pass
+    return reader.bytes_in, reader.bytes_out
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("size", [0, 1, 64 * 1024, 64 * 1024 + 1, 3 * 1024 * 1024 + 5])
+def test_round_trip(codec, size):
+    data = text(size)
+    compressed, restored = round_trip(data, codec)
+    assert restored == data
+    if size >= 64 * 1024:
+        assert len(compressed) < size / 2
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip_small_reads(codec):
+    data = text(200 * 1024)
+    compressed, restored = round_trip(data, codec, read_size=1000, chunk_size=4096)
+    assert restored == data
+    assert reader_counts(data, codec) == (len(data), len(compressed))
+
+
+def test_gzip_output_is_a_gzip_file():
+    import gzip
+    data = text(10000)
+    compressed, _ = round_trip(data, "gzip")
+    assert gzip.decompress(compressed) == data
+
+
+def test_unknown_codec_raises():
+    with pytest.raises(Exception):
+        CompressingReader(io.BytesIO(b"x"), "lz4")
+    with pytest.raises(Exception):
+        decompress_stream([b"x"], io.BytesIO(), "lz4")
+
+
+def test_skips_already_compressed_formats(tmp_path):
+    policy = CompressionPolicy()
+    for name in ("photo.jpg", "movie.MP4", "archive.zip", "backup.tar.gz", "song.mp3", "doc.pdf"):
+        path = write(tmp_path, name, text(10000))
+        assert policy.choose_codec(path) is None, name
+
+
+def test_compresses_text_like_files(tmp_path):
+    policy = CompressionPolicy()
+    for name in ("app.log", "data.csv", "notes.txt", "config.json", "script.py", "README.md"):
+        path = write(tmp_path, name, text(10000))
+        assert policy.choose_codec(path) == available_codecs()[0], name
+
+
+def test_unknown_types_are_sent_raw(tmp_path):
+    path = write(tmp_path, "blob.bin", text(10000))
+    assert CompressionPolicy().choose_codec(path) is None
+    path = write(tmp_path, "no_extension", text(10000))
+    assert CompressionPolicy().choose_codec(path) is None
+
+
+def test_small_files_and_disabled_policy(tmp_path):
+    small = write(tmp_path, "small.txt", text(100))
+    large = write(tmp_path, "large.txt", text(10000))
+    assert CompressionPolicy().choose_codec(small) is None
+    assert CompressionPolicy(min_size=0).choose_codec(small) is not None
+    assert CompressionPolicy(enabled=False).choose_codec(large) is None
+    assert CompressionPolicy.from_config({"enabled": False}).choose_codec(large) is None
+
+
+def test_requested_codec_falls_back_to_gzip(tmp_path):
+    path = write(tmp_path, "notes.txt", text(10000))
+    assert CompressionPolicy(codec="gzip").choose_codec(path) == "gzip"
+    expected = "zstd" if zstandard is not None else "gzip"
+    assert CompressionPolicy(codec="zstd").choose_codec(path) == expected
+    assert CompressionPolicy(codec="brotli").choose_codec(path) == "gzip"
+
+
+@pytest.fixture
+def server():
+    server = LocalS3Server()
+    endpoint = server.start()
+    yield server, endpoint
+    server.stop()
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_upload_and_download(server, tmp_path, codec):
+    server, endpoint = server
+    client = make_client(endpoint, compression={"enabled": True, "codec": codec})
+    data = text(2 * 1024 * 1024 + 3)
+    path = write(tmp_path, "big.log", data)
+    client.upload_file(path, "logs/big.log")
+    stored = server.buckets[DEFAULT_BUCKET].objects["logs/big.log"]
+    assert stored.metadata.get(CODEC_METADATA_KEY) == codec
+    assert len(stored.data) < len(data) / 2
+    client.download_file("logs/big.log", str(tmp_path / "restored.log"))
+    with open(tmp_path / "restored.log", "rb") as f:
+        assert f.read() == data
+
+
+def test_media_is_stored_as_is(server, tmp_path):
+    server, endpoint = server
+    client = make_client(endpoint, compression={"enabled": True})
+    data = os.urandom(50000)
+    client.upload_file(write(tmp_path, "photo.jpg", data), "photo.jpg")
+    stored = server.buckets[DEFAULT_BUCKET].objects["photo.jpg"]
+    assert CODEC_METADATA_KEY not in stored.metadata
+    assert stored.data == data
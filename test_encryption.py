@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Tests for client-side encryption: chunked AES-GCM round trips, ranged reads and tamper detection
+
+    python -m pytest -q test_encryption.py
+"""
+
+import hashlib
+import os
+
+import pytest
+
+from local_s3_server import DEFAULT_BUCKET, LocalS3Server
+from model.compression import CODEC_METADATA_KEY
+from model.encryption import (
+    AESGCM, BUNDLED_KEY_FILE, CHUNK_OVERHEAD, CONTENT_MAC_METADATA_KEY, ENCRYPTION_METADATA_KEY, ChunkCipher,
+    encrypted_size, plaintext_size,
+)
+from model.wasabi_client import SHA256_METADATA_KEY
+from test_sync_scenarios import make_client
+
+pytestmark = pytest.mark.skipif(AESGCM is None, reason="cryptography not installed")
+
+CHUNK = 64 * 1024
+MB = 1024 * 1024
+
+
+def write(folder, name, data):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def key_file(folder, name="objects.key"):
+    return write(folder, name, os.urandom(32))
+
+
+@pytest.fixture
+def server():
+    server = LocalS3Server()
+    endpoint = server.start()
+    yield server, endpoint
+    server.stop()
+
+
+def encrypted_client(endpoint, key_path, **settings):
+    return make_client(endpoint, encryption={"enabled": True, "key_file": key_path, "chunk_size": CHUNK}, **settings)
+
+
+def stored(server, key):
+    return server.buckets[DEFAULT_BUCKET].objects[key]
+
+
+def download(client, key, folder):
+    path = os.path.join(folder, "restored.bin")
+    client.download_file(key, path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("size", [0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 3 * CHUNK, 3 * CHUNK + 17])
+def test_round_trip(server, tmp_path, size):
+    server, endpoint = server
+    client = encrypted_client(endpoint, key_file(tmp_path))
+    data = os.urandom(size)
+    client.upload_file(write(tmp_path, "file.bin", data), "file.bin")
+    obj = stored(server, "file.bin")
+    assert len(obj.data) == encrypted_size(size, CHUNK)
+    assert plaintext_size(len(obj.data), CHUNK) == size
+    if size >= 16:
+        assert data not in obj.data
+    assert download(client, "file.bin", tmp_path) == data
+
+
+def test_multipart_round_trip(server, tmp_path):
+    server, endpoint = server
+    client = encrypted_client(endpoint, key_file(tmp_path), multipart_threshold=8 * MB, part_size=5 * MB)
+    data = os.urandom(12 * MB + 3)
+    client.upload_file(write(tmp_path, "big.bin", data), "big.bin")
+    assert len(stored(server, "big.bin").data) == encrypted_size(len(data), CHUNK)
+    assert download(client, "big.bin", tmp_path) == data
+    # A range straddling the first part boundary
+    start = 5 * MB - 100
+    assert client.read_range("big.bin", start, 300) == data[start:start + 300]
+
+
+def test_compressed_and_encrypted(server, tmp_path):
+    server, endpoint = server
+    client = encrypted_client(endpoint, key_file(tmp_path), compression={"enabled": True, "codec": "gzip"})
+    data = b"2024-01-01T00:00:00Z INFO request served\n" * 20000
+    client.upload_file(write(tmp_path, "app.txt", data), "app.txt")
+    obj = stored(server, "app.txt")
+    assert obj.metadata.get(CODEC_METADATA_KEY) == "gzip"
+    assert obj.metadata.get(ENCRYPTION_METADATA_KEY)
+    assert len(obj.data) < len(data) / 2
+    assert download(client, "app.txt", tmp_path) == data
+
+
+@pytest.mark.parametrize("start, length", [
+    (0, 1), (CHUNK - 10, 20), (CHUNK, CHUNK), (CHUNK - 1, 2 * CHUNK + 2), (3 * CHUNK, 17), (0, 3 * CHUNK + 17),
+])
+def test_read_range(server, tmp_path, start, length):
+    server, endpoint = server
+    client = encrypted_client(endpoint, key_file(tmp_path))
+    data = os.urandom(3 * CHUNK + 17)
+    client.upload_file(write(tmp_path, "file.bin", data), "file.bin")
+    assert client.read_range("file.bin", start, length) == data[start:start + length]
+
+
+def test_tampered_and_truncated_objects_fail(server, tmp_path):
+    server, endpoint = server
+    client = encrypted_client(endpoint, key_file(tmp_path))
+    data = os.urandom(3 * CHUNK)
+    client.upload_file(write(tmp_path, "file.bin", data), "file.bin")
+    obj = stored(server, "file.bin")
+    original = obj.data
+
+    obj.data = original[:CHUNK + 100] + bytes([original[CHUNK + 100] ^ 1]) + original[CHUNK + 101:]
+    with pytest.raises(Exception, match="failed authentication"):
+        download(client, "file.bin", tmp_path)
+    # Cut off at a chunk boundary, so the last chunk left is not marked as the last one
+    obj.data = original[:2 * (CHUNK + CHUNK_OVERHEAD)]
+    with pytest.raises(Exception, match="failed authentication"):
+        download(client, "file.bin", tmp_path)
+    assert not os.path.exists(tmp_path / "restored.bin")
+
+
+def test_wrong_key_is_refused(server, tmp_path):
+    server, endpoint = server
+    client = encrypted_client(endpoint, key_file(tmp_path))
+    client.upload_file(write(tmp_path, "file.bin", os.urandom(1000)), "file.bin")
+    other = encrypted_client(endpoint, key_file(tmp_path, "other.key"))
+    with pytest.raises(Exception, match="different key"):
+        download(other, "file.bin", tmp_path)
+
+
+def test_metadata_holds_a_mac_not_the_sha256(server, tmp_path):
+    server, endpoint = server
+    client = encrypted_client(endpoint, key_file(tmp_path))
+    data = os.urandom(5000)
+    sha256 = hashlib.sha256(data).hexdigest()
+    client.upload_file(write(tmp_path, "file.bin", data), "file.bin")
+    metadata = stored(server, "file.bin").metadata
+    assert SHA256_METADATA_KEY not in metadata
+    assert sha256 not in metadata.values()
+    assert metadata[CONTENT_MAC_METADATA_KEY] != sha256
+    assert client.verify_object("file.bin", sha256) == "ok"
+    assert client.verify_object("file.bin", hashlib.sha256(b"other").hexdigest()) == "mismatch"
+    other = encrypted_client(endpoint, key_file(tmp_path, "other.key"))
+    assert other.verify_object("file.bin", sha256) == "unverified"
+
+
+def test_key_file_must_be_set_and_not_bundled(tmp_path):
+    with pytest.raises(Exception, match="key_file"):
+        ChunkCipher.from_config({"enabled": True})
+    with pytest.raises(Exception, match="not secret"):
+        ChunkCipher.from_config({"enabled": True, "key_file": BUNDLED_KEY_FILE})
+    with pytest.raises(Exception, match="not found"):
+        ChunkCipher.from_config({"enabled": True, "key_file": str(tmp_path / "missing.key")})
+    assert ChunkCipher.from_config({"enabled": False}) is None
+
+
+def test_chunks_cannot_be_reordered(tmp_path):
+    cipher = ChunkCipher.from_key_file(key_file(tmp_path), chunk_size=1024)
+    object_id = os.urandom(16)
+    data = os.urandom(4096)
+    sealed = list(cipher.seal_stream(object_id, [data[i:i + 1024] for i in range(0, 4096, 1024)]))
+    assert b"".join(cipher.open_stream(object_id, 1024, sealed)) == data
+    with pytest.raises(Exception, match="failed authentication"):
+        list(cipher.open_stream(object_id, 1024, [sealed[1], sealed[0]] + sealed[2:]))
+    with pytest.raises(Exception, match="failed authentication"):
+        list(cipher.open_stream(os.urandom(16), 1024, sealed))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Tests for .wasabiignore rules: gitignore pattern semantics and the built-in lists
+
+    python -m pytest -q test_ignore.py
+"""
+
+import os
+
+from model.ignore import IGNORE_FILENAME, PARTIAL_SUFFIX, IgnoreMatcher, IgnoreRules
+
+
+def write(folder, relpath, data=""):
+    path = os.path.join(folder, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+    return path
+
+
+def matcher(root, patterns=None, use_defaults=True):
+    return IgnoreMatcher.for_folder(str(root), patterns, use_defaults)
+
+
+def test_name_patterns_match_at_any_depth():
+    rules = IgnoreRules(["*.iso", "build"])
+    assert rules.match("disk.iso", False) is True
+    assert rules.match("a/b/disk.iso", False) is True
+    assert rules.match("a/build", True) is True
+    assert rules.match("a/build", False) is True
+    assert rules.match("disk.iso.txt", False) is None
+    assert rules.match("builder", True) is None
+
+
+def test_anchored_patterns():
+    rules = IgnoreRules(["/top.txt", "docs/*.pdf"])
+    assert rules.match("top.txt", False) is True
+    assert rules.match("sub/top.txt", False) is None
+    assert rules.match("docs/a.pdf", False) is True
+    # A single * does not cross folders
+    assert rules.match("docs/old/a.pdf", False) is None
+    assert rules.match("other/docs/a.pdf", False) is None
+
+
+def test_double_star():
+    rules = IgnoreRules(["**/cache", "logs/**", "a/**/z"])
+    assert rules.match("cache", True) is True
+    assert rules.match("x/y/cache", True) is True
+    assert rules.match("logs/x", False) is True
+    assert rules.match("logs/x/y.log", False) is True
+    assert rules.match("logs", True) is None
+    assert rules.match("a/z", False) is True
+    assert rules.match("a/b/c/z", False) is True
+
+
+def test_dir_only_patterns():
+    rules = IgnoreRules(["node_modules/"])
+    assert rules.match("node_modules", True) is True
+    assert rules.match("src/node_modules", True) is True
+    assert rules.match("node_modules", False) is None
+
+
+def test_negation_and_last_rule_wins():
+    rules = IgnoreRules(["*.iso", "!keep.iso"])
+    assert rules.match("drop.iso", False) is True
+    assert rules.match("keep.iso", False) is False
+    rules = IgnoreRules(["!keep.iso", "*.iso"])
+    assert rules.match("keep.iso", False) is True
+
+
+def test_comments_escapes_and_classes():
+    rules = IgnoreRules(["# a comment", "", "\\#hash", "\\!bang", "file[0-9].txt", "x[!a].log", "?.bak"])
+    assert rules.match("# a comment", False) is None
+    assert rules.match("#hash", False) is True
+    assert rules.match("!bang", False) is True
+    assert rules.match("file7.txt", False) is True
+    assert rules.match("fileA.txt", False) is None
+    assert rules.match("xb.log", False) is True
+    assert rules.match("xa.log", False) is None
+    assert rules.match("a.bak", False) is True
+    assert rules.match("ab.bak", False) is None
+
+
+def test_configured_patterns_and_root_file(tmp_path):
+    write(tmp_path, IGNORE_FILENAME, "*.log\n")
+    m = matcher(tmp_path, ["*.iso", "!keep.iso"])
+    assert m.is_ignored("disk.iso", False)
+    assert not m.is_ignored("keep.iso", False)
+    assert m.is_ignored("app.log", False)
+    assert not m.is_ignored("notes.txt", False)
+
+
+def test_nested_file_overrides_parent(tmp_path):
+    write(tmp_path, IGNORE_FILENAME, "*.log\n")
+    write(tmp_path, os.path.join("keep", IGNORE_FILENAME), "!*.log\n/local.txt\n")
+    m = matcher(tmp_path)
+    assert m.is_path_ignored("app.log")
+    assert m.is_path_ignored("other/app.log")
+    assert not m.is_path_ignored("keep/app.log")
+    assert not m.is_path_ignored("keep/deeper/app.log")
+    # Anchored to the folder holding the .wasabiignore
+    assert m.is_path_ignored("keep/local.txt")
+    assert not m.is_path_ignored("keep/deeper/local.txt")
+    assert not m.is_path_ignored("local.txt")
+
+
+def test_ignored_folder_hides_its_contents(tmp_path):
+    m = matcher(tmp_path, ["build/"])
+    assert m.is_path_ignored("build", True)
+    assert m.is_path_ignored("build/out/a.bin")
+    assert m.is_path_ignored(os.path.join("src", "build", "a.bin"))
+    assert not m.is_path_ignored("src/builds/a.bin")
+
+
+def test_default_ignores_can_be_turned_off(tmp_path):
+    assert matcher(tmp_path).is_path_ignored(".git/config")
+    assert matcher(tmp_path).is_path_ignored("notes.txt~")
+    assert not matcher(tmp_path, use_defaults=False).is_path_ignored(".git/config")
+    assert not matcher(tmp_path, use_defaults=False).is_path_ignored("notes.txt~")
+
+
+def test_internal_files_are_always_ignored(tmp_path):
+    m = matcher(tmp_path, use_defaults=False)
+    for name in (".wasabi_sync.db", ".wasabi_sync.db-wal", ".wasabi_sync_journal.jsonl",
+                 ".wasabi_last_plan.jsonl", ".wasabi_index.db", "movie.mkv" + PARTIAL_SUFFIX):
+        assert m.is_path_ignored(name), name
+    assert m.is_path_ignored("videos/movie.mkv" + PARTIAL_SUFFIX)
+
+
+def test_user_part_files_are_not_ignored(tmp_path):
+    for use_defaults in (True, False):
+        m = matcher(tmp_path, use_defaults=use_defaults)
+        assert not m.is_path_ignored("archive.7z.part")
+        assert not m.is_path_ignored("videos/episode.part")
+
+
+def test_scan_skips_ignored_entries(tmp_path):
+    from model.sync_metadata import SyncMetadata
+    from model.sync_plan import walk_sync_tree
+
+    write(tmp_path, "keep.txt", "a")
+    write(tmp_path, "video.part", "b")
+    write(tmp_path, "video.mp4" + PARTIAL_SUFFIX, "c")
+    write(tmp_path, "node_modules/pkg/index.js", "d")
+    write(tmp_path, IGNORE_FILENAME, "node_modules/\n")
+    meta = SyncMetadata(str(tmp_path))
+    try:
+        found = sorted(relpath for _, relpath, _ in walk_sync_tree(meta))
+    finally:
+        meta.close()
+    assert "keep.txt" in found
+    assert "video.part" in found
+    assert "video.mp4" + PARTIAL_SUFFIX not in found
+    assert not any(path.startswith("node_modules") for path in found)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Tests for the local S3 server the scenarios run against: listing pagination
+
+    python -m pytest -q test_local_s3_server.py
+"""
+
+import pytest
+
+from local_s3_server import DEFAULT_BUCKET, LocalS3Server
+from test_sync_scenarios import make_client
+
+KEYS = ["a/1", "a/2", "b", "c/1", "c/d/2", "d", "e/"]
+
+
+@pytest.fixture
+def s3():
+    server = LocalS3Server()
+    endpoint = server.start()
+    client = make_client(endpoint)
+    for key in KEYS:
+        client.s3.put_object(Bucket=DEFAULT_BUCKET, Key=key, Body=b"x")
+    yield client.s3
+    server.stop()
+
+
+def paged(s3, page_size, **params):
+    keys, prefixes, pages = [], [], 0
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=DEFAULT_BUCKET, PaginationConfig={"PageSize": page_size}, **params):
+        pages += 1
+        assert pages <= len(KEYS) + 1, "listing does not terminate"
+        keys += [obj["Key"] for obj in page.get("Contents", [])]
+        prefixes += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+    return keys, prefixes
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 1000])
+def test_paged_listing(s3, page_size):
+    assert paged(s3, page_size) == (KEYS, [])
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 1000])
+def test_paged_delimiter_listing(s3, page_size):
+    keys, prefixes = paged(s3, page_size, Delimiter="/")
+    assert keys == ["b", "d"]
+    assert prefixes == ["a/", "c/", "e/"]
+
+
+@pytest.mark.parametrize("page_size", [1, 1000])
+def test_paged_delimiter_listing_under_prefix(s3, page_size):
+    keys, prefixes = paged(s3, page_size, Prefix="c/", Delimiter="/")
+    assert keys == ["c/1"]
+    assert prefixes == ["c/d/"]
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+End-to-end sync scenarios against the local fault-injecting S3 server
+
+Each scenario builds a synthetic folder tree, runs it through the real sync
+path (SyncMetadata, plan, SyncEngine, WasabiClient over HTTP) against
+local_s3_server.py, and checks what ended up in the bucket, plus
+throughput where that is the point. No network or credentials needed.
+
+    python test_sync_scenarios.py                  # all scenarios
+    python test_sync_scenarios.py --files 20000 small_files
+"""
+
+import argparse
+import gc
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from local_s3_server import DEFAULT_BUCKET, Faults, LocalS3Server
+from model.journal import resume_or_build_plan
+from model.delete_sync import DeleteSync
+from model.pull_sync import PullSync, relpath_to_key
+from model.sync_engine import SyncEngine
+from model.sync_metadata import SyncMetadata
+from model.sync_plan import plan_options
+from model.sync_roots import MultiRootSync, SyncRoot, SyncRootRegistry, folder_client
+from model.verify import RemoteVerifier
+from model.wasabi_client import SHA256_METADATA_KEY, WasabiClient
+
+MB = 1024 * 1024
+
+
+class ScenarioFailed(Exception):
+    pass
+
+
+class Interrupted(BaseException):
+    """Raised from the progress callback to kill a run midway, like closing the app"""
+
+
+def check(condition, message):
+    if not condition:
+        raise ScenarioFailed(message)
+
+
+def make_tree(folder, files, min_size=100, max_size=64 * 1024, depth=3, seed=0):
+    """Write files random files spread over nested folders; returns their total size"""
+    rng = random.Random(seed)
+    total = 0
+    for i in range(files):
+        parts = [f"d{rng.randrange(8)}" for _ in range(rng.randrange(depth + 1))]
+        path = os.path.join(folder, *parts, f"file{i:06}.bin")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = rng.randint(min_size, max_size)
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(size))
+        total += size
+    return total
+
+
+def make_client(endpoint, **settings):
+    config = {
+        "access_key": "local",
+        "secret_key": "local",
+        "region": "us-east-1",
+        "endpoint": endpoint,
+        "bucket_name": DEFAULT_BUCKET,
+        # Random bytes do not compress; keeping stored bytes equal to the files makes checks simple
+        "compression": {"enabled": False},
+        "upload_workers": 16,
+        "max_pool_connections": 64,
+    }
+    config.update(settings)
+    return WasabiClient(config)
+
+
+def run_sync(folder, client, progress_callback=None):
+    """One Sync Now, the way the UIs run it; returns the engine"""
+    sync_meta = SyncMetadata.from_config(folder, client.config)
+    try:
+        plan, _ = resume_or_build_plan(sync_meta, **plan_options(client.config))
+        engine = SyncEngine.from_config(client, sync_meta, client.config)
+        engine.execute(plan, progress_callback)
+        return engine
+    finally:
+        sync_meta.close()
+
+
+def check_bucket(server, folder, prefix=""):
+    """Every file in folder is in the bucket, under prefix, with the same bytes and SHA-256 metadata"""
+    objects = server.buckets[DEFAULT_BUCKET].objects
+    count = 0
+    for root, dirs, names in os.walk(folder):
+        for name in names:
+            if name.startswith(".wasabi"):
+                continue
+            path = os.path.join(root, name)
+            key = prefix + relpath_to_key(os.path.relpath(path, folder))
+            obj = objects.get(key)
+            check(obj is not None, f"{key} missing from the bucket")
+            with open(path, "rb") as f:
+                data = f.read()
+            check(obj.data == data, f"{key} differs from the local file")
+            check(obj.metadata.get(SHA256_METADATA_KEY) == hashlib.sha256(data).hexdigest(),
+                  f"{key} has wrong {SHA256_METADATA_KEY} metadata")
+            count += 1
+    return count
+
+
+@contextmanager
+def no_orphaned_tasks():
+    """Fail if the asyncio loop reports a task destroyed while still pending"""
+    reports = []
+    handler = logging.Handler(logging.ERROR)
+    handler.emit = reports.append
+    logger = logging.getLogger("asyncio")
+    logger.addHandler(handler)
+    try:
+        yield
+        gc.collect()
+        check(not reports, f"asyncio reported: {reports[0].getMessage() if reports else ''}")
+    finally:
+        logger.removeHandler(handler)
+
+
+def check_no_errors(engine):
+    check(engine.errors.count == 0, f"{engine.errors.count} sync errors, e.g. {engine.errors.sample[:3]}")
+    check(engine.health_issues.count == 0, f"{engine.health_issues.count} health issues, e.g. {engine.health_issues.sample[:3]}")
+
+
+def scenario_small_files(folder, args, **settings):
+    """Many small objects with some per-request latency"""
+    server = LocalS3Server(faults=Faults(latency=0.002, seed=args.seed))
+    client = make_client(server.start(), **settings)
+    try:
+        total = make_tree(folder, args.files, seed=args.seed)
+        started = time.time()
+        engine = run_sync(folder, client)
+        elapsed = time.time() - started
+        check_no_errors(engine)
+        count = check_bucket(server, folder)
+        check(count == args.files, f"{count} of {args.files} files in the bucket")
+        rate = count / elapsed
+        check(rate >= args.min_files_per_second, f"{rate:.0f} files/s, expected at least {args.min_files_per_second}")
+        return f"{count} files, {total / MB:.1f} MB in {elapsed:.1f}s ({rate:.0f} files/s)"
+    finally:
+        server.stop()
+
+
+def scenario_flaky(folder, args):
+    """SlowDown replies and dropped connections are retried until every file is in"""
+    faults = Faults(slowdown_rate=0.05, drop_rate=0.03, seed=args.seed)
+    server = LocalS3Server(faults=faults)
+    # Small parts and a tight memory budget, so many mmap-windowed parts get retried
+    client = make_client(server.start(), multipart_threshold=8 * MB, part_size=5 * MB, memory_budget=16 * MB)
+    try:
+        make_tree(folder, max(args.files // 4, 50), seed=args.seed)
+        # Large enough for multipart uploads, so parts get retried too
+        make_tree(os.path.join(folder, "large"), 3, min_size=12 * MB, max_size=20 * MB, depth=0, seed=args.seed)
+        engine = run_sync(folder, client)
+        check_no_errors(engine)
+        count = check_bucket(server, folder)
+        stats = server.stats
+        check(stats.get("slowdowns", 0) and stats.get("dropped", 0), "no faults were injected")
+        return f"{count} files, {stats.get('slowdowns', 0)} SlowDowns and {stats.get('dropped', 0)} drops absorbed"
+    finally:
+        server.stop()
+
+
+def scenario_bandwidth(folder, args):
+    """With the link capped, sync keeps it busy"""
+    cap = args.bandwidth * MB
+    server = LocalS3Server(faults=Faults(bandwidth=cap, seed=args.seed))
+    client = make_client(server.start())
+    try:
+        total = make_tree(folder, 40, min_size=MB // 2, max_size=MB, seed=args.seed)
+        started = time.time()
+        engine = run_sync(folder, client)
+        elapsed = time.time() - started
+        check_no_errors(engine)
+        check_bucket(server, folder)
+        rate = total / elapsed
+        check(rate >= 0.6 * cap, f"{rate / MB:.1f} MB/s on a {args.bandwidth} MB/s link")
+        check(rate <= 1.1 * cap, f"{rate / MB:.1f} MB/s exceeds the {args.bandwidth} MB/s cap")
+    finally:
+        server.stop()
+
+    # The client's own cap, on a multipart upload whose part bodies botocore reads more than once
+    server = LocalS3Server()
+    client = make_client(server.start(), max_bandwidth=cap, multipart_threshold=8 * MB, part_size=5 * MB)
+    try:
+        capped = os.path.join(folder, "capped")
+        large = make_tree(capped, 1, min_size=20 * MB, max_size=20 * MB, depth=0, seed=args.seed)
+        started = time.time()
+        engine = run_sync(capped, client)
+        capped_elapsed = time.time() - started
+        check_no_errors(engine)
+        check_bucket(server, capped)
+        check(server.stats.get("UploadPart"), "the large file was not sent in parts")
+        capped_rate = large / capped_elapsed
+        check(capped_rate >= 0.6 * cap, f"{capped_rate / MB:.1f} MB/s under a {args.bandwidth} MB/s upload cap")
+        check(capped_rate <= 1.1 * cap, f"{capped_rate / MB:.1f} MB/s exceeds the {args.bandwidth} MB/s upload cap")
+        return (f"{total / MB:.1f} MB at {rate / MB:.1f} MB/s ({rate / cap:.0%} of the cap); "
+                f"{large / MB:.0f} MB in parts at {capped_rate / MB:.1f} MB/s ({capped_rate / cap:.0%})")
+    finally:
+        server.stop()
+
+
+def scenario_resume(folder, args, **settings):
+    """A run killed halfway resumes without sending finished files again"""
+    server = LocalS3Server(faults=Faults(latency=0.002, seed=args.seed))
+    client = make_client(server.start(), **settings)
+    try:
+        files = max(args.files // 4, 100)
+        make_tree(folder, files, seed=args.seed)
+
+        def die_halfway(progress):
+            if progress.done_files >= files // 2:
+                raise Interrupted()
+
+        try:
+            run_sync(folder, client, die_halfway)
+            raise ScenarioFailed("the first run was not interrupted")
+        except Interrupted:
+            pass
+        first_puts = server.stats.get("PutObject", 0)
+        engine = run_sync(folder, client)
+        second_puts = server.stats.get("PutObject", 0) - first_puts
+        check_no_errors(engine)
+        count = check_bucket(server, folder)
+        check(engine.resumed >= files // 2, f"only {engine.resumed} actions were carried over")
+        # Carried-over actions are progress, but were synced by the first run
+        check(engine.progress.synced == files - engine.resumed,
+              f"{engine.progress.synced} reported synced after resuming {engine.resumed} of {files}")
+        # Uploads in flight at the kill may be confirmed with a HEAD or sent again; nothing else is
+        check(second_puts <= files - engine.resumed, f"{second_puts} uploads after resuming {engine.resumed} of {files}")
+        return f"{count} files; {engine.resumed} carried over, {second_puts} uploaded after resume"
+    finally:
+        server.stop()
+
+
+def scenario_small_files_async(folder, args):
+    """small_files over the aiohttp transport"""
+    with no_orphaned_tasks():
+        return scenario_small_files(folder, args, transport="async")
+
+
+def scenario_resume_async(folder, args):
+    """resume over the aiohttp transport; the killed run leaves no requests pending"""
+    with no_orphaned_tasks():
+        return scenario_resume(folder, args, transport="async")
+
+
+def scenario_delta(folder, args):
+    """A large file edited in place is re-uploaded as a delta of its changed chunk"""
+    server = LocalS3Server()
+    client = make_client(server.start(), delta_threshold=32 * MB)
+    try:
+        path = os.path.join(folder, "disk.img")
+        size = 48 * MB
+        with open(path, "wb") as f:
+            f.write(random.Random(args.seed).randbytes(size))
+        check_no_errors(run_sync(folder, client))
+        with open(path, "r+b") as f:
+            f.seek(20 * MB)
+            f.write(b"changed")
+        sent_before = server.stats.get("bytes_in", 0)
+        engine = run_sync(folder, client)
+        sent = server.stats.get("bytes_in", 0) - sent_before
+        check_no_errors(engine)
+        check_bucket(server, folder)
+        check(server.stats.get("UploadPartCopy", 0) > 0, "no parts were copied server-side")
+        check(sent < size / 2, f"{sent / MB:.1f} MB sent for a one-chunk change")
+        return f"{sent / MB:.1f} MB sent, {engine.bytes_reused / MB:.0f} MB copied server-side"
+    finally:
+        server.stop()
+
+
+def scenario_copies_and_deletes(folder, args):
+    """Duplicates become server-side copies and local deletions reach the bucket"""
+    server = LocalS3Server()
+    client = make_client(server.start(), propagate_deletes=True)
+    try:
+        make_tree(folder, 20, seed=args.seed)
+        check_no_errors(run_sync(folder, client))
+        source = next(os.path.join(root, name) for root, _, names in os.walk(folder) for name in names
+                      if not name.startswith(".wasabi"))
+        shutil.copy(source, os.path.join(folder, "duplicate.bin"))
+        victim = next(os.path.join(root, name) for root, _, names in os.walk(folder) for name in names
+                      if not name.startswith(".wasabi") and os.path.join(root, name) != source
+                      and name != "duplicate.bin")
+        os.remove(victim)
+        puts_before = server.stats.get("PutObject", 0)
+        engine = run_sync(folder, client)
+        check_no_errors(engine)
+        check_bucket(server, folder)
+        check(server.stats.get("CopyObject", 0) == 1, "the duplicate was not copied server-side")
+        check(server.stats.get("PutObject", 0) == puts_before, "the duplicate was uploaded again")
+        victim_key = relpath_to_key(os.path.relpath(victim, folder))
+        check(victim_key not in server.buckets[DEFAULT_BUCKET].objects, "the deleted file is still in the bucket")
+        return "1 server-side copy, 1 remote delete"
+    finally:
+        server.stop()
+
+
+def scenario_multi_root(folder, args):
+    """Several roots share one bucket and one worker pool, and a small-file root is not starved"""
+    server = LocalS3Server(faults=Faults(latency=0.002, seed=args.seed))
+    client = make_client(server.start(), upload_workers=8)
+    try:
+        home, media = os.path.join(folder, "home"), os.path.join(folder, "media")
+        make_tree(home, max(args.files // 4, 100), seed=args.seed)
+        make_tree(media, 8, min_size=4 * MB, max_size=6 * MB, depth=0, seed=args.seed)
+        roots = [SyncRoot(media, prefix="media"), SyncRoot(home, prefix="home")]
+        finished = []
+        sync = MultiRootSync(roots, client)
+        sync.execute(lambda progress: finished.append(progress.current.split(":")[0]))
+        for run in sync.runs:
+            check_no_errors(run.engine)
+        count = check_bucket(server, home, "home/") + check_bucket(server, media, "media/")
+        # With fair sharing, small files keep completing while the large ones are in flight
+        early = finished[:len(finished) // 4]
+        check(early.count("home") > len(early) // 2, "the small-file root waited behind the large files")
+        return f"{count} files from {len(roots)} roots"
+    finally:
+        server.stop()
+
+
+def check_every_path(folder, name, args, start_as_root):
+    """Sync folder/name once through each of Sync Now, Sync All, Clean Remote, Pull and Verify
+
+    It starts out either with Sync Now, at the top of the bucket, or as a
+    sync root under its name; every later path has to keep those keys.
+    """
+    server = LocalS3Server()
+    client = make_client(server.start())
+    registry = SyncRootRegistry(os.path.join(folder, f"{name}.json"))
+    path = os.path.join(folder, name)
+    try:
+        make_tree(path, max(args.files // 20, 20), seed=args.seed)
+
+        def through_ui(action):
+            """action(client, sync_meta) with the client the UIs pick for path"""
+            sync_meta = SyncMetadata.from_config(path, client.config)
+            try:
+                return action(folder_client(path, client, sync_meta, registry), sync_meta)
+            finally:
+                sync_meta.close()
+
+        def sync_now(path_client, sync_meta):
+            plan, _ = resume_or_build_plan(sync_meta, **plan_options(client.config))
+            engine = SyncEngine.from_config(path_client, sync_meta, client.config)
+            engine.execute(plan)
+            check_no_errors(engine)
+
+        def sync_all(roots):
+            for run in MultiRootSync(roots, client).execute().runs:
+                check_no_errors(run.engine)
+
+        def refused(run, what):
+            try:
+                run()
+            except Exception as e:
+                check("split" in str(e), f"{what} failed with: {e}")
+            else:
+                raise ScenarioFailed(f"{what} was not refused")
+
+        if start_as_root:
+            registry.add(SyncRoot(path), client.config)
+            sync_all(registry.list())
+            refused(lambda: run_sync(path, client), "Sync Now at the top of the bucket")
+        else:
+            through_ui(sync_now)
+            refused(lambda: sync_all([SyncRoot(path)]), f"Sync All under {name}/")
+            # What Add Root registers: the prefix Sync Now has used
+            prefix = through_ui(lambda path_client, sync_meta: sync_meta.remote_prefix)
+            registry.add(SyncRoot(path, prefix=prefix), client.config)
+        prefix = registry.list()[0].prefix
+
+        # One more file for whichever path the folder did not start with
+        make_tree(os.path.join(path, "new"), 1, seed=args.seed + 1)
+        if start_as_root:
+            through_ui(sync_now)
+        else:
+            sync_all(registry.list())
+        os.remove(os.path.join(path, "new", "file000000.bin"))
+        result = through_ui(lambda path_client, sync_meta: DeleteSync(path_client, sync_meta).run())
+        check(len(result["deleted"]) == 1 and not result["errors"], f"Clean Remote: {result}")
+        source = os.path.join(folder, "remote.bin")
+        with open(source, "wb") as f:
+            f.write(os.urandom(1000))
+        client.upload_file(source, prefix + "remote.bin")
+        result = through_ui(lambda path_client, sync_meta: PullSync(path_client, sync_meta).run())
+        check(result["downloaded"] == 1 and os.path.exists(os.path.join(path, "remote.bin")), f"Pull: {result}")
+        summary = through_ui(lambda path_client, sync_meta: RemoteVerifier(path_client, sync_meta).run(resume=False))
+        check(set(summary) == {"ok"}, f"Verify: {summary}")
+
+        count = check_bucket(server, path, prefix)
+        keys = len(server.buckets[DEFAULT_BUCKET].objects)
+        check(keys == count, f"{keys} keys in the bucket for {count} files of {name}")
+        return count
+    finally:
+        server.stop()
+
+
+def scenario_one_folder_every_path(folder, args):
+    """A folder keeps one key space whichever of Sync Now, Sync All, Pull, Clean Remote and Verify runs on it"""
+    synced_first = check_every_path(folder, "home", args, start_as_root=False)
+    root_first = check_every_path(folder, "media", args, start_as_root=True)
+    return f"{synced_first} files at the bucket top after Sync Now, {root_first} under a root's prefix"
+
+
+SCENARIOS = {
+    "small_files": scenario_small_files,
+    "flaky": scenario_flaky,
+    "bandwidth": scenario_bandwidth,
+    "resume": scenario_resume,
+    "small_files_async": scenario_small_files_async,
+    "resume_async": scenario_resume_async,
+    "delta": scenario_delta,
+    "copies_and_deletes": scenario_copies_and_deletes,
+    "multi_root": scenario_multi_root,
+    "one_folder_every_path": scenario_one_folder_every_path,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic trees through sync against a local S3 server")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--files", type=int, default=2000, help="files in the small-file tree")
+    parser.add_argument("--min-files-per-second", type=float, default=50)
+    parser.add_argument("--bandwidth", type=float, default=8, help="link cap in MB/s for the bandwidth scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+
+    failed = 0
+    for name in args.scenarios or list(SCENARIOS):
+        folder = tempfile.mkdtemp(prefix=f"wasabi-scenario-{name}-")
+        try:
+            summary = SCENARIOS[name](folder, args)
+            print(f"✓ {name}: {summary}")
+        except ScenarioFailed as e:
+            failed += 1
+            print(f"✗ {name}: {e}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,24 +6,44 @@ from kivy.uix.popup import Popup
 from kivy.uix.filechooser import FileChooserIconView
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.progressbar import ProgressBar
+from kivy.uix.textinput import TextInput
 from kivy.clock import Clock
-from model.sync_metadata import SyncMetadata
-from model.wasabi_client import WasabiClient
+from model.sync_metadata import StatusReader, SyncMetadata
+from model.replication import create_sync_client
+from model.pull_sync import DEFAULT_CONFLICT_RULE, PullSync
+from model.delete_sync import DEFAULT_MAX_DELETE_FRACTION, DeleteSync, DeleteThresholdError
+from model.verify import RemoteVerifier
+from model import bandwidth, tracing
+from model.journal import resume_or_build_plan
+from model.sync_plan import plan_options
+from model.sync_engine import SyncEngine
+from model.sync_roots import MultiRootSync, SyncRoot, SyncRootRegistry, folder_client
+from model.local_listing import DirectoryCache
 import os
-import time
+
+# Rows shown per folder before a "Show more" button
+FILE_LIST_PAGE = 500
 
 class FileManagerScreen(Screen):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.folder = None
         self.sync_meta = None
-        self.client = WasabiClient()
+        self.listing_cache = None
+        self.client = create_sync_client()
         self.layout = BoxLayout(orientation='vertical', padding=10, spacing=10)
         self.add_widget(self.layout)
         top_bar = BoxLayout(size_hint_y=None, height=40, spacing=10)
         top_bar.add_widget(Button(text="Select Folder", on_press=self.select_folder))
         top_bar.add_widget(Button(text="Sync Now", on_press=self.sync_now))
-        top_bar.add_widget(Button(text="Refresh", on_press=lambda x: self.refresh_file_list()))
+        top_bar.add_widget(Button(text="Add Root", on_press=self.add_sync_root))
+        top_bar.add_widget(Button(text="Sync All", on_press=self.sync_all))
+        top_bar.add_widget(Button(text="Pull", on_press=self.pull_now))
+        top_bar.add_widget(Button(text="Clean Remote", on_press=self.propagate_deletes))
+        top_bar.add_widget(Button(text="Verify", on_press=self.verify_remote))
+        top_bar.add_widget(Button(text="Bandwidth", on_press=self.open_bandwidth))
+        top_bar.add_widget(Button(text="Refresh", on_press=lambda x: self.refresh_file_list(force=True)))
+        top_bar.add_widget(Button(text="Remote", on_press=self.open_remote_browser))
         top_bar.add_widget(Button(text="Wasabi Config", on_press=self.open_config))
         self.layout.add_widget(top_bar)
         self.folder_label = Label(text="No folder selected", size_hint_y=None, height=30)
@@ -49,18 +69,32 @@ class FileManagerScreen(Screen):
                 if os.path.isdir(selected):
                     self.folder = selected
                     self.folder_label.text = self.folder
-                    self.sync_meta = SyncMetadata(self.folder)
+                    if self.sync_meta:
+                        self.sync_meta.close()
+                    self.sync_meta = SyncMetadata.from_config(self.folder, self.client.config)
+                    self.open_listing_cache()
                     self.refresh_file_list()
                     popup.dismiss()
         btn.bind(on_press=on_select)
         popup.open()
 
-    def refresh_file_list(self):
+    def open_listing_cache(self):
+        if self.listing_cache:
+            self.listing_cache.close()
+        folder = self.folder
+        self.listing_cache = DirectoryCache(folder, lambda: StatusReader(folder), page_size=FILE_LIST_PAGE)
+        self.listing_cache.watch()
+
+    def refresh_file_list(self, limit=FILE_LIST_PAGE, force=False):
         self.file_list.clear_widgets()
         if not self.folder:
             return
         if self.current_folder is None:
             self.current_folder = self.folder
+        if force:
+            self.listing_cache.invalidate()
+        # Totals come from the rollups kept by sync, so even a huge folder shows them at once
+        self.folder_label.text = f"{self.current_folder} - {self.sync_meta.folder_rollup(self.current_folder).summary()}"
         # Add '..' row if not at root
         if os.path.abspath(self.current_folder) != os.path.abspath(self.folder):
             row = BoxLayout(size_hint_y=None, height=30)
@@ -72,56 +106,99 @@ class FileManagerScreen(Screen):
             row.add_widget(up_btn)
             row.add_widget(Label(text="Go up", size_hint_x=0.8))
             self.file_list.add_widget(row)
-        for fname in os.listdir(self.current_folder):
-            fpath = os.path.join(self.current_folder, fname)
-            is_folder = os.path.isdir(fpath)
-            status = self.sync_meta.get_status(os.path.relpath(fpath, self.folder))
-            label_text = f"[DIR] {fname}" if is_folder else fname
-            row = BoxLayout(size_hint_y=None, height=30)
-            # Folder navigation
-            if is_folder:
-                folder_btn = Button(text=label_text, size_hint_x=0.7)
-                def make_folder_callback(fpath=fpath):
-                    def callback(instance):
-                        self.current_folder = fpath
-                        self.refresh_file_list()
-                    return callback
-                folder_btn.bind(on_press=make_folder_callback())
-                row.add_widget(folder_btn)
-            else:
-                row.add_widget(Label(text=label_text, size_hint_x=0.7))
-            # Three-state toggle
-            toggle_states = ["both", "object_storage_only", "no_sync"]
-            toggle_labels = {"both": "Both", "object_storage_only": "Cloud Only", "no_sync": "No Sync"}
-            toggle = Button(text=toggle_labels.get(status, "Both"), size_hint_x=0.3)
-            def make_toggle_callback(fpath=fpath, toggle=toggle):
+        # Unchanged folders come from the cache; only the first `limit` entries are listed at all
+        snapshot = self.listing_cache.get(self.current_folder, limit)
+        for entry in snapshot.entries[:limit]:
+            self.add_file_row(entry.name, entry.path, entry.is_dir, entry.status)
+        if not snapshot.complete or len(snapshot.entries) > limit:
+            more_btn = Button(text=f"Show more (first {limit} shown)", size_hint_y=None, height=30)
+            more_btn.bind(on_press=lambda instance: self.refresh_file_list(limit + FILE_LIST_PAGE))
+            self.file_list.add_widget(more_btn)
+
+    def add_file_row(self, fname, fpath, is_folder, status=None):
+        if status is None:
+            status = self.sync_meta.get_effective_status(os.path.relpath(fpath, self.folder))
+        label_text = f"[DIR] {fname}" if is_folder else fname
+        if is_folder:
+            rollup = self.sync_meta.folder_rollup(fpath)
+            if rollup.files("pending"):
+                label_text += f"  ({rollup.files('pending')} to sync)"
+            elif rollup.total_files:
+                label_text += "  (synced)"
+        row = BoxLayout(size_hint_y=None, height=30)
+        # Folder navigation
+        if is_folder:
+            folder_btn = Button(text=label_text, size_hint_x=0.7)
+            def make_folder_callback(fpath=fpath):
                 def callback(instance):
-                    relpath = os.path.relpath(fpath, self.folder)
-                    current = self.sync_meta.get_status(relpath)
-                    idx = toggle_states.index(current) if current in toggle_states else 0
-                    new_status = toggle_states[(idx + 1) % len(toggle_states)]
-                    toggle.text = toggle_labels[new_status]
-                    self.sync_meta.set_status(relpath, new_status)
+                    self.current_folder = fpath
+                    self.refresh_file_list()
                 return callback
-            toggle.bind(on_press=make_toggle_callback())
-            row.add_widget(toggle)
-            self.file_list.add_widget(row)
+            folder_btn.bind(on_press=make_folder_callback())
+            row.add_widget(folder_btn)
+        else:
+            row.add_widget(Label(text=label_text, size_hint_x=0.7))
+        # Three-state toggle
+        toggle_states = ["both", "object_storage_only", "no_sync"]
+        toggle_labels = {"both": "Both", "object_storage_only": "Cloud Only", "no_sync": "No Sync"}
+        toggle = Button(text=toggle_labels.get(status, "Both"), size_hint_x=0.3)
+        def make_toggle_callback(fpath=fpath, toggle=toggle):
+            def callback(instance):
+                relpath = os.path.relpath(fpath, self.folder)
+                current = self.sync_meta.get_status(relpath)
+                idx = toggle_states.index(current) if current in toggle_states else 0
+                new_status = toggle_states[(idx + 1) % len(toggle_states)]
+                self.sync_meta.set_status(relpath, new_status)
+                # A status set on a parent folder still wins
+                toggle.text = toggle_labels[self.sync_meta.get_effective_status(relpath)]
+                self.listing_cache.invalidate_path(fpath)
+            return callback
+        toggle.bind(on_press=make_toggle_callback())
+        row.add_widget(toggle)
+        self.file_list.add_widget(row)
+
+    def folder_client(self):
+        """The open folder's client, keyed like every other sync of it; None, with a popup, on a prefix mismatch"""
+        try:
+            return folder_client(self.folder, self.client, self.sync_meta)
+        except Exception as e:
+            self.show_popup("Remote Prefix", str(e))
+            return None
 
     def sync_now(self, *args):
         if not self.folder or not self.sync_meta:
             self.show_popup("No folder", "Please select a folder first.")
             return
+        client = self.folder_client()
+        if client is None:
+            return
+        config = client.config or {}
+        
+        # Traces planning and execution when the "trace" setting is on
+        trace_path = tracing.trace_path(config, self.folder)
+        if trace_path:
+            tracing.start(trace_path)
         
-        # Show sync analysis popup
-        stats = self.sync_meta.get_sync_stats(self.folder)
-        analysis_text = f"Total files: {stats['total_files']}\nNeeds sync: {stats['needs_sync']}\nAlready synced: {stats['synced']}"
+        # One pass over the tree produces the complete plan, unless an interrupted run is resumed
+        try:
+            plan, resumed = resume_or_build_plan(self.sync_meta, **plan_options(config))
+        except DeleteThresholdError as e:
+            tracing.stop()
+            self.show_popup("Sync Stopped", f"{e}\nUse Clean Remote to review and confirm the deletions.")
+            return
+        except Exception:
+            tracing.stop()
+            raise
+        analysis_text = f"Total files: {plan.action_count}\n{plan.summary()}"
+        if resumed:
+            analysis_text = "Resuming interrupted sync\n" + analysis_text
         
         # Create progress popup
         progress_layout = BoxLayout(orientation='vertical', padding=20, spacing=10)
         progress_layout.add_widget(Label(text="Sync Progress", font_size=18))
         progress_layout.add_widget(Label(text=analysis_text))
         
-        progress_bar = ProgressBar(max=stats['needs_sync'])
+        progress_bar = ProgressBar(max=1.0)
         progress_layout.add_widget(progress_bar)
         
         status_label = Label(text="Preparing sync...")
@@ -130,83 +207,277 @@ class FileManagerScreen(Screen):
         progress_popup = Popup(title="Sync Progress", content=progress_layout, size_hint=(0.8, 0.6))
         progress_popup.open()
         
-        errors = []
-        synced_count = 0
-        health_issues = []
-        
-        def sync_path(path, status):
-            nonlocal synced_count
-            relpath = os.path.relpath(path, self.folder)
-            if status == "no_sync":
-                return  # Skip this file/folder and its children
-            
-            if os.path.isdir(path):
-                for child in os.listdir(path):
-                    child_path = os.path.join(path, child)
-                    child_status = self.sync_meta.get_status(os.path.relpath(child_path, self.folder))
-                    # Inherit parent status if child is not explicitly set to no_sync
-                    if child_status == "no_sync":
-                        continue
-                    sync_path(child_path, status)
-            elif os.path.isfile(path):
-                # Only sync if file needs syncing
-                if self.sync_meta.needs_sync(path):
-                    try:
-                        if status == "both":
-                            self.client.upload_file(path, relpath)
-                            # Update file info after successful upload
-                            file_hash = self.sync_meta.get_file_hash(path)
-                            self.sync_meta.update_file_info(path, file_hash, time.time())
-                        elif status == "object_storage_only":
-                            self.client.upload_file(path, relpath)
-                            if os.path.exists(path):
-                                os.remove(path)
-                                self.sync_meta.set_status(relpath, "object_storage_only")
-                            else:
-                                # File was uploaded, update info
-                                file_hash = self.sync_meta.get_file_hash(path)
-                                self.sync_meta.update_file_info(path, file_hash, time.time())
-                        
-                        synced_count += 1
-                        progress_bar.value = synced_count
-                        status_label.text = f"Synced: {synced_count}/{stats['needs_sync']} - {relpath}"
-                        
-                        # Verify upload by checking hash
-                        if os.path.exists(path):
-                            current_hash = self.sync_meta.get_file_hash(path)
-                            stored_info = self.sync_meta.get_file_info(path)
-                            if stored_info and current_hash != stored_info.get("hash"):
-                                health_issues.append(f"{relpath}: Hash mismatch")
-                        
-                    except Exception as e:
-                        errors.append(f"{relpath}: {e}")
+        def on_progress(progress):
+            progress_bar.value = progress.fraction
+            eta = progress.eta
+            eta_text = f" - ETA {int(eta)}s" if eta is not None else ""
+            status_label.text = (
+                f"Synced: {progress.done_files}/{progress.total_files}{eta_text} - {progress.current}"
+            )
         
-        # Start sync process
-        for fname in os.listdir(self.folder):
-            fpath = os.path.join(self.folder, fname)
-            status = self.sync_meta.get_status(os.path.relpath(fpath, self.folder))
-            sync_path(fpath, status)
+        engine = SyncEngine.from_config(client, self.sync_meta, config)
+        try:
+            progress = engine.execute(plan, on_progress)
+        finally:
+            tracing.stop()
+        errors = engine.errors
+        health_issues = engine.health_issues
+        synced_count = progress.synced
         
         progress_popup.dismiss()
         self.refresh_file_list()
+        self.invalidate_remote_listing()
         
         # Show results
         result_text = f"Sync Complete!\nSynced: {synced_count} files"
+        if engine.resumed:
+            result_text += f"\nAlready done by the interrupted run: {engine.resumed} files"
+        if engine.bytes_reused:
+            result_text += f"\nReused unchanged chunks: {engine.bytes_reused // (1024 * 1024)} MB"
         if errors:
-            result_text += f"\nErrors: {len(errors)}"
+            result_text += f"\nErrors: {errors.count}"
         if health_issues:
-            result_text += f"\nHealth Issues: {len(health_issues)}"
+            result_text += f"\nHealth Issues: {health_issues.count}"
+        # Per-target totals when replicating to several profiles
+        for target in getattr(client, "progress", {}).values():
+            result_text += (
+                f"\n{target.name}: {target.files_done} ok, {target.files_failed} failed, "
+                f"{target.bytes_sent // (1024 * 1024)} MB sent"
+            )
         
         self.show_popup("Sync Results", result_text)
         
         if errors:
-            error_text = "Sync Errors:\n" + "\n".join(errors)
+            error_text = "Sync Errors:\n" + "\n".join(errors.sample)
+            if errors.truncated:
+                error_text += f"\n... full list in {errors.path}"
             self.show_popup("Sync Errors", error_text)
         
         if health_issues:
-            health_text = "Health Issues:\n" + "\n".join(health_issues)
+            health_text = "Health Issues:\n" + "\n".join(health_issues.sample)
+            if health_issues.truncated:
+                health_text += f"\n... full list in {health_issues.path}"
             self.show_popup("Health Issues", health_text)
 
+    def add_sync_root(self, *args):
+        if not self.folder:
+            self.show_popup("No folder", "Please select a folder first.")
+            return
+        registry = SyncRootRegistry()
+        try:
+            # A folder that has synced already keeps its keys; a new one goes under its name
+            root = registry.add(SyncRoot(self.folder, prefix=self.sync_meta.remote_prefix), self.client.config)
+        except Exception as e:
+            self.show_popup("Sync Roots", str(e))
+            return
+        names = ", ".join(r.name for r in registry.list())
+        self.show_popup("Sync Roots", f"Added {root.name}.\nSync All covers: {names}")
+
+    def sync_all(self, *args):
+        roots = [root for root in SyncRootRegistry().list() if root.enabled]
+        if not roots:
+            self.show_popup("No sync roots", "Use Add Root to register folders for Sync All.")
+            return
+        # Another root may be the open folder; its metadata is reopened by the run
+        if self.sync_meta:
+            self.sync_meta.close()
+        sync = MultiRootSync(roots, self.client)
+        try:
+            progress = sync.execute()
+        except DeleteThresholdError as e:
+            self.show_popup("Sync Stopped", f"{e}\nNothing was synced. Review the deletions with Clean Remote.")
+            return
+        except Exception as e:
+            self.show_popup("Sync Stopped", f"{e}\nNothing was synced.")
+            return
+        finally:
+            if self.folder:
+                self.sync_meta = SyncMetadata.from_config(self.folder, self.client.config)
+        self.refresh_file_list()
+        self.invalidate_remote_listing()
+
+        result_text = f"Synced {progress.synced} files in {len(sync.runs)} roots"
+        for run in sync.runs:
+            engine = run.engine
+            result_text += f"\n{run.root.name}: {engine.progress.synced} synced"
+            if engine.errors:
+                result_text += f", {engine.errors.count} errors (see {engine.errors.path})"
+            if engine.health_issues:
+                result_text += f", {engine.health_issues.count} health issues"
+        self.show_popup("Sync All Results", result_text)
+
+    def pull_now(self, *args):
+        if not self.folder or not self.sync_meta:
+            self.show_popup("No folder", "Please select a folder first.")
+            return
+        client = self.folder_client()
+        if client is None:
+            return
+        config = client.config or {}
+        try:
+            puller = PullSync(
+                client,
+                self.sync_meta,
+                conflict_rule=config.get("pull_conflict_rule", DEFAULT_CONFLICT_RULE),
+                max_workers=config.get("transfer_workers", 8),
+            )
+            result = puller.run()
+        except Exception as e:
+            self.show_popup("Pull Error", f"Pull failed: {e}")
+            return
+        self.refresh_file_list()
+        result_text = (
+            f"Pull Complete!\nDownloaded: {result['downloaded']} files"
+            f"\nUnchanged: {result['skipped'] + result['adopted']}"
+        )
+        if result["conflicts"]:
+            result_text += f"\nConflict copies: {result['conflicts']}"
+        if result["errors"]:
+            result_text += f"\nErrors: {len(result['errors'])}"
+        self.show_popup("Pull Results", result_text)
+        if result["errors"]:
+            self.show_popup("Pull Errors", "Pull Errors:\n" + "\n".join(result["errors"]))
+
+    def propagate_deletes(self, *args):
+        if not self.folder or not self.sync_meta:
+            self.show_popup("No folder", "Please select a folder first.")
+            return
+        client = self.folder_client()
+        if client is None:
+            return
+        config = client.config or {}
+        deleter = DeleteSync(
+            client,
+            self.sync_meta,
+            max_fraction=config.get("max_delete_fraction", DEFAULT_MAX_DELETE_FRACTION),
+            max_count=config.get("max_delete_count"),
+        )
+        preview = deleter.preview()
+        keys = preview["keys"]
+        if not keys:
+            self.show_popup("Clean Remote", "No locally deleted files to remove from the bucket.")
+            return
+
+        # Dry-run preview; nothing is deleted until the user confirms
+        preview_text = f"{len(keys)} files were deleted locally:\n" + "\n".join(keys[:15])
+        if len(keys) > 15:
+            preview_text += f"\n... and {len(keys) - 15} more"
+        if preview["exceeds_threshold"]:
+            preview_text += (
+                f"\n\nWARNING: this exceeds the safety limit of {preview['limit']} "
+                f"of {preview['tracked']} tracked files."
+            )
+        layout = BoxLayout(orientation='vertical', padding=10, spacing=10)
+        layout.add_widget(Label(text=preview_text))
+        buttons = BoxLayout(size_hint_y=None, height=40, spacing=10)
+        confirm_btn = Button(text=f"Delete {len(keys)} remote objects")
+        cancel_btn = Button(text="Cancel")
+        buttons.add_widget(confirm_btn)
+        buttons.add_widget(cancel_btn)
+        layout.add_widget(buttons)
+        popup = Popup(title="Clean Remote (preview)", content=layout, size_hint=(0.8, 0.8))
+
+        def on_confirm(instance):
+            popup.dismiss()
+            try:
+                result = deleter.run(force=preview["exceeds_threshold"])
+            except Exception as e:
+                self.show_popup("Delete Error", f"Remote cleanup failed: {e}")
+                return
+            self.invalidate_remote_listing()
+            result_text = f"Deleted {len(result['deleted'])} remote objects"
+            if result["errors"]:
+                result_text += f"\nErrors: {len(result['errors'])}\n" + "\n".join(result["errors"][:10])
+            self.show_popup("Clean Remote", result_text)
+
+        confirm_btn.bind(on_press=on_confirm)
+        cancel_btn.bind(on_press=lambda instance: popup.dismiss())
+        popup.open()
+
+    def open_bandwidth(self, *args):
+        """Set upload/download caps in MB/s that apply at once, even to a sync already running"""
+        policy = bandwidth.BandwidthPolicy.from_config(self.client.config)
+        upload, download = policy.limits()
+
+        def to_text(rate):
+            return f"{rate / (1024 * 1024):g}" if rate else ""
+
+        layout = BoxLayout(orientation='vertical', padding=10, spacing=10)
+        layout.add_widget(Label(text="Limits in MB/s; leave empty for no limit"))
+        upload_input = TextInput(text=to_text(upload), hint_text="Upload MB/s", multiline=False)
+        download_input = TextInput(text=to_text(download), hint_text="Download MB/s", multiline=False)
+        layout.add_widget(upload_input)
+        layout.add_widget(download_input)
+        buttons = BoxLayout(size_hint_y=None, height=40, spacing=10)
+        apply_btn = Button(text="Apply")
+        reset_btn = Button(text="Use Schedule")
+        buttons.add_widget(apply_btn)
+        buttons.add_widget(reset_btn)
+        layout.add_widget(buttons)
+        popup = Popup(title="Bandwidth", content=layout, size_hint=(0.6, 0.5))
+
+        def on_apply(instance):
+            try:
+                limits = {
+                    name: int(float(field.text) * 1024 * 1024) if field.text.strip() else None
+                    for name, field in (("upload", upload_input), ("download", download_input))
+                }
+            except ValueError:
+                self.show_popup("Bandwidth", "Limits must be numbers of MB/s.")
+                return
+            bandwidth.set_override(**limits)
+            bandwidth.activate(policy)
+            popup.dismiss()
+
+        def on_reset(instance):
+            bandwidth.clear_override()
+            bandwidth.activate(policy)
+            popup.dismiss()
+
+        apply_btn.bind(on_press=on_apply)
+        reset_btn.bind(on_press=on_reset)
+        popup.open()
+
+    def verify_remote(self, *args):
+        if not self.folder or not self.sync_meta:
+            self.show_popup("No folder", "Please select a folder first.")
+            return
+        client = self.folder_client()
+        if client is None:
+            return
+        verifier = RemoteVerifier(
+            client,
+            self.sync_meta,
+            max_workers=(client.config or {}).get("verify_workers", 32),
+        )
+        try:
+            # resume=False: an explicit click starts a fresh audit
+            summary = verifier.run(resume=False)
+        except Exception as e:
+            self.show_popup("Verify Error", f"Verification failed: {e}")
+            return
+        result_text = "Remote Verification\n" + "\n".join(
+            f"{result}: {count}" for result, count in sorted(summary.items())
+        )
+        self.show_popup("Verify Results", result_text)
+        problems = verifier.problems()
+        if problems:
+            problem_text = "Problems:\n" + "\n".join(f"{key}: {result}" for key, result in problems[:20])
+            self.show_popup("Verify Problems", problem_text)
+
+    def open_remote_browser(self, *args):
+        browser = self.manager.get_screen('remote_browser')
+        if browser.client is not self.client:
+            browser.set_client(self.client)
+        self.manager.current = 'remote_browser'
+
+    def invalidate_remote_listing(self):
+        """Bucket contents changed; drop cached remote listings"""
+        if self.manager and self.manager.has_screen('remote_browser'):
+            cache = self.manager.get_screen('remote_browser').cache
+            if cache:
+                cache.invalidate()
+
     def open_config(self, *args):
         self.manager.current = 'wasabi_config'
 
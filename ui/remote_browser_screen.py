@@ -0,0 +1,207 @@
+from kivy.uix.screenmanager import Screen
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.button import Button
+from kivy.uix.label import Label
+from kivy.uix.scrollview import ScrollView
+from kivy.uix.textinput import TextInput
+from kivy.clock import Clock
+from model.key_index import KeyIndex
+from model.remote_listing import ListingCache, parent_prefix
+import datetime
+import threading
+
+# Load the next page once the list is scrolled this close to the bottom
+LOAD_MORE_THRESHOLD = 0.05
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+class RemoteBrowserScreen(Screen):
+    """Browse the bucket one prefix and one page at a time"""
+
+    def __init__(self, client=None, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+        self.cache = None
+        self.index = None
+        self.prefix = ""
+        # Generation of the listing on screen; pages for any other copy are not appended
+        self.shown_generation = None
+        self.loading = False
+        self.layout = BoxLayout(orientation='vertical', padding=10, spacing=10)
+        self.add_widget(self.layout)
+        top_bar = BoxLayout(size_hint_y=None, height=40, spacing=10)
+        top_bar.add_widget(Button(text="Back", on_press=self.go_back))
+        top_bar.add_widget(Button(text="Refresh", on_press=lambda x: self.refresh(force=True)))
+        self.search_input = TextInput(hint_text="Search keys (substring or glob)", multiline=False)
+        self.search_input.bind(on_text_validate=self.search)
+        top_bar.add_widget(self.search_input)
+        top_bar.add_widget(Button(text="Search", on_press=self.search))
+        top_bar.add_widget(Button(text="Index Bucket", on_press=self.rebuild_index))
+        self.layout.add_widget(top_bar)
+        self.prefix_label = Label(text="/", size_hint_y=None, height=30)
+        self.layout.add_widget(self.prefix_label)
+        self.scrollview = ScrollView(size_hint=(1, 1))
+        self.scrollview.bind(scroll_y=self.on_scroll)
+        self.file_list = BoxLayout(orientation='vertical', size_hint_y=None)
+        self.file_list.bind(minimum_height=self.file_list.setter('height'))
+        self.scrollview.add_widget(self.file_list)
+        self.layout.add_widget(self.scrollview)
+        self.status_label = Label(text="", size_hint_y=None, height=30)
+        self.layout.add_widget(self.status_label)
+
+    def set_client(self, client):
+        if self.cache:
+            self.cache.close()
+        self.client = client
+        config = client.config or {}
+        if self.index is None:
+            self.index = KeyIndex()
+        self.cache = ListingCache(client, ttl=config.get("listing_cache_ttl", 60), index=self.index)
+
+    def on_enter(self, *args):
+        if self.cache is None and self.client is not None:
+            self.set_client(self.client)
+        self.refresh()
+
+    def go_back(self, *args):
+        self.manager.current = 'filemanager'
+
+    def navigate(self, prefix):
+        self.prefix = prefix
+        self.refresh()
+
+    def refresh(self, force=False):
+        if not self.cache:
+            self.status_label.text = "Wasabi config not loaded."
+            return
+        if force:
+            self.cache.invalidate(self.prefix)
+        self.file_list.clear_widgets()
+        self.prefix_label.text = "/" + self.prefix
+        if self.prefix:
+            row = BoxLayout(size_hint_y=None, height=30)
+            up_btn = Button(text="..", size_hint_x=0.2)
+            up_btn.bind(on_press=lambda instance: self.navigate(parent_prefix(self.prefix)))
+            row.add_widget(up_btn)
+            row.add_widget(Label(text="Go up", size_hint_x=0.8))
+            self.file_list.add_widget(row)
+        prefix = self.prefix
+        self.run_in_background(prefix, lambda: self.cache.get(prefix), self.show_listing)
+
+    def run_in_background(self, prefix, fetch, on_done):
+        """Fetch off the UI thread, then apply the result on the Kivy clock"""
+        self.loading = True
+        self.status_label.text = "Loading..."
+
+        def worker():
+            try:
+                result, error = fetch(), None
+            except Exception as e:
+                result, error = None, e
+
+            def apply(dt):
+                self.loading = False
+                # Ignore results for a prefix the user already navigated away from
+                if prefix != self.prefix:
+                    return
+                if error:
+                    self.status_label.text = f"Listing failed: {error}"
+                else:
+                    on_done(result)
+            Clock.schedule_once(apply)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def show_listing(self, listing):
+        self.shown_generation = listing.generation
+        for page in listing.pages:
+            self.add_page(page)
+        self.update_status(listing)
+
+    def add_page(self, page):
+        for child in page["prefixes"]:
+            row = BoxLayout(size_hint_y=None, height=30)
+            name = child[len(self.prefix):]
+            btn = Button(text=f"[DIR] {name}")
+            btn.bind(on_press=lambda instance, child=child: self.navigate(child))
+            row.add_widget(btn)
+            self.file_list.add_widget(row)
+        for obj in page["objects"]:
+            name = obj["Key"][len(self.prefix):]
+            if not name:
+                continue
+            row = BoxLayout(size_hint_y=None, height=30)
+            row.add_widget(Label(text=name, size_hint_x=0.6))
+            row.add_widget(Label(text=format_size(obj["Size"]), size_hint_x=0.15))
+            row.add_widget(Label(text=obj["LastModified"].strftime("%Y-%m-%d %H:%M"), size_hint_x=0.25))
+            self.file_list.add_widget(row)
+
+    def update_status(self, listing):
+        count = len(listing.prefixes) + len(listing.objects)
+        more = "" if listing.complete else " (scroll for more)"
+        self.status_label.text = f"{count} entries{more}"
+
+    def on_scroll(self, instance, value):
+        if self.loading or not self.cache or value > LOAD_MORE_THRESHOLD:
+            return
+        listing = self.cache.cached(self.prefix)
+        if listing is None or listing.complete:
+            return
+        prefix = self.prefix
+        generation = self.shown_generation
+
+        def on_page(page):
+            current = self.cache.cached(prefix)
+            if page is None and current is not None and current.generation != generation:
+                # Reloaded meanwhile; show the new copy rather than mixing pages of both
+                self.refresh()
+                return
+            if page:
+                self.add_page(page)
+            self.update_status(current or listing)
+
+        self.run_in_background(prefix, lambda: self.cache.load_more(prefix, generation), on_page)
+
+    def search(self, *args):
+        query = self.search_input.text.strip()
+        if not query or not self.index:
+            self.refresh()
+            return
+        bucket = self.client.config["bucket_name"]
+        results = self.index.query(bucket, query)
+        self.file_list.clear_widgets()
+        self.prefix_label.text = f"Search: {query}"
+        for obj in results:
+            row = BoxLayout(size_hint_y=None, height=30)
+            folder = parent_prefix(obj["Key"])
+            btn = Button(text=obj["Key"], size_hint_x=0.6)
+            btn.bind(on_press=lambda instance, folder=folder: self.navigate(folder))
+            row.add_widget(btn)
+            row.add_widget(Label(text=format_size(obj["Size"] or 0), size_hint_x=0.15))
+            modified = datetime.datetime.fromtimestamp(obj["LastModified"] or 0)
+            row.add_widget(Label(text=modified.strftime("%Y-%m-%d %H:%M"), size_hint_x=0.25))
+            self.file_list.add_widget(row)
+        indexed = self.index.count(bucket)
+        self.status_label.text = f"{len(results)} matches in {indexed} indexed keys"
+
+    def rebuild_index(self, *args):
+        if not self.index:
+            return
+        self.status_label.text = "Indexing bucket..."
+
+        def worker():
+            try:
+                seen = self.index.refresh(self.client)
+                message = f"Indexed {seen} keys"
+            except Exception as e:
+                message = f"Indexing failed: {e}"
+            Clock.schedule_once(lambda dt: setattr(self.status_label, "text", message))
+
+        threading.Thread(target=worker, daemon=True).start()